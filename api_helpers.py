@@ -0,0 +1,213 @@
+"""Request parsing helpers shared by the Flask app (app.py) and the async app (async_app.py)."""
+
+import base64
+import hashlib
+import json
+
+from models import Cupcake, CUPCAKE_COLUMNS
+
+
+def encode_cursor(cursor_values):
+    """ Returns an opaque, url safe cursor string for the dictionary cursor_values. """
+
+    cursor_json = json.dumps(cursor_values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor_json.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """ Returns the dictionary held in a cursor created by encode_cursor.
+
+        ValueError is raised when cursor was not created by encode_cursor.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError(f"Cursor '{cursor}' is not valid.")
+
+    if (type(cursor_values) != dict):
+        raise ValueError(f"Cursor '{cursor}' is not valid.")
+
+    return cursor_values
+
+
+def is_cursor_value(column, value):
+    """ Returns True when value, from a decoded cursor, can be compared with column: an
+        integer for integer columns, a number for float columns, a string for text columns
+        and None only for nullable columns. JSON true / false are not numbers here.
+    """
+
+    column = Cupcake.__table__.c[column]
+    if (value is None):
+        return column.nullable
+    if (type(value) == bool):
+        return False
+
+    python_type = column.type.python_type
+    if (python_type == float):
+        return type(value) in (int, float)
+    return type(value) == python_type
+
+
+def cupcake_etag(cupcake_id, version):
+    """ Returns the strong ETag value for version of the cupcake identified by cupcake_id. """
+
+    return f"{cupcake_id}-{version}"
+
+
+def list_etag(query_string, results):
+    """ Returns the ETag value for a page of cupcakes from db_list_cupcakes. The ETag
+        changes when the query string, the cupcakes on the page or their versions change.
+    """
+
+    digest = hashlib.sha1(query_string)
+    for cupcake_id, version in results["versions"]:
+        digest.update(f"{cupcake_etag(cupcake_id, version)};".encode())
+    if (results["more"]):
+        digest.update(b"more")
+
+    return digest.hexdigest()
+
+
+def if_match_version(if_match, cupcake_id):
+    """ Returns the cupcake version a PATCH must find, from the parsed If-Match header
+        (werkzeug ETags).
+
+        None means any version may be updated (no If-Match or If-Match: *). 0 means no
+        ETag in the header belongs to cupcake_id, which never matches a version.
+    """
+
+    if (not if_match or if_match.star_tag):
+        return None
+
+    versions = [etag.split("-", 1)[1] for etag in if_match.as_set()
+                if etag.startswith(f"{int(cupcake_id)}-")]
+    if (len(versions) == 0 or not versions[0].isnumeric()):
+        return 0
+
+    return int(versions[0])
+
+
+def get_list_params(args, page_limit=100, page_limit_max=1000):
+    """ Validates the query string values used by the cupcake list route: limit=, after=,
+        fields=, sort= and the filters flavor=, flavor_prefix=, size=, rating_min= and
+        rating_max=. page_limit is the limit when limit= is not provided and
+        page_limit_max the largest limit allowed.
+
+        Returns keyword arguments for db_list_cupcakes: {"limit": int, "after": cursor
+        position or None, "fields": [column names], "filters": {...}, "sort": str}.
+        ValueError with a descriptive message is raised for a bad value.
+    """
+
+    limit = args.get("limit", str(page_limit))
+    if (not limit.isnumeric() or int(limit) < 1 or int(limit) > page_limit_max):
+        raise ValueError(
+            f"limit='{limit}' must be an integer from 1 to {page_limit_max}.")
+
+    sort = args.get("sort", "id")
+    if (sort.lstrip("-") not in CUPCAKE_COLUMNS):
+        raise ValueError(
+            f"sort='{sort}' is not valid. Sort by one of {', '.join(CUPCAKE_COLUMNS)}, prefixed with - for descending order.")
+
+    filters = {}
+    for key in ("flavor", "flavor_prefix", "size"):
+        if (args.get(key)):
+            filters[key] = args[key]
+    for key in ("rating_min", "rating_max"):
+        if (args.get(key)):
+            try:
+                filters[key] = float(args[key])
+            except ValueError:
+                raise ValueError(f"{key}='{args[key]}' is not a number.")
+
+    after = None
+    if (args.get("after")):
+        # the cursor holds the sort it was created for and the position of the last row.
+        cursor_values = decode_cursor(args["after"])
+        if (type(cursor_values.get("id")) != int or "value" not in cursor_values or
+                cursor_values.get("sort", "id") != sort or
+                not is_cursor_value(sort.lstrip("-"), cursor_values["value"])):
+            raise ValueError(f"Cursor '{args['after']}' is not valid.")
+        after = {"id": cursor_values["id"], "value": cursor_values["value"]}
+
+    return {"limit": int(limit), "after": after, "fields": get_fields_param(args),
+            "filters": filters, "sort": sort}
+
+
+def get_ids_param(args, ids_max=100):
+    """ Returns the list of values in the comma separated ids= query string value, as
+        given: each is checked as it is looked up, so a bad id only fails its own result.
+
+        ValueError with a descriptive message is raised when ids= is empty or has more than
+        ids_max values.
+    """
+
+    ids = [cupcake_id.strip() for cupcake_id in args.get("ids", "").split(",")]
+    if (ids == [""]):
+        raise ValueError("ids='' must list at least one cupcake id.")
+    if (len(ids) > ids_max):
+        raise ValueError(f"ids= lists {len(ids)} cupcake ids; at most {ids_max} are allowed.")
+
+    return ids
+
+
+def get_fields_param(args):
+    """ Validates the fields= query string value and returns the list of requested column
+        names. All columns are returned when fields= was not provided.
+
+        ValueError with a descriptive message is raised for an unknown field.
+    """
+
+    fields = list(CUPCAKE_COLUMNS)
+    if (args.get("fields")):
+        fields = [field.strip() for field in args["fields"].split(",")]
+        unknown = [field for field in fields if field not in CUPCAKE_COLUMNS]
+        if (unknown):
+            raise ValueError(
+                f"fields='{args['fields']}' contains unknown field(s) {', '.join(unknown)}. Valid fields are {', '.join(CUPCAKE_COLUMNS)}.")
+
+    return fields
+
+
+def get_changes_params(args, last_event_id=None, page_limit=500, page_limit_max=1000):
+    """ Validates the since= and limit= query string values of the change feed routes.
+        since falls back to last_event_id (the Last-Event-ID header of a reconnecting
+        EventSource).
+
+        Returns {"since": int or None, "limit": int}. ValueError with a descriptive message
+        is raised for a bad value.
+    """
+
+    limit = args.get("limit", str(page_limit))
+    if (not limit.isnumeric() or int(limit) < 1 or int(limit) > page_limit_max):
+        raise ValueError(
+            f"limit='{limit}' must be an integer from 1 to {page_limit_max}.")
+
+    since = args.get("since") or last_event_id
+    if (since is not None and not since.isnumeric()):
+        raise ValueError(f"since='{since}' is not a change cursor.")
+
+    return {"since": int(since) if since is not None else None, "limit": int(limit)}
+
+
+def get_suggest_params(args, fields, limit=10, limit_max=50):
+    """ Validates the q=, field= and limit= query string values of the suggest route. field
+        must be one of fields; without it every field is suggested.
+
+        Returns {"prefix": str, "fields": tuple, "limit": int}. ValueError with a descriptive
+        message is raised for a bad value.
+    """
+
+    count = args.get("limit", str(limit))
+    if (not count.isnumeric() or int(count) < 1 or int(count) > limit_max):
+        raise ValueError(
+            f"limit='{count}' must be an integer from 1 to {limit_max}.")
+
+    field = args.get("field")
+    if (field is not None and field not in fields):
+        raise ValueError(f"field='{field}' must be one of {', '.join(fields)}.")
+
+    return {"prefix": args.get("q", "").strip(),
+            "fields": (field,) if field else tuple(fields),
+            "limit": int(count)}
@@ -1,17 +1,35 @@
 """Flask app for Cupcakes"""
 
-from flask import Flask, jsonify, request, redirect, render_template, redirect, flash, session
+import json
+import threading
+import time
+from datetime import datetime
+
+from flask import Flask, Response, request, redirect, render_template, redirect, flash, session, stream_with_context
+from markupsafe import Markup
 # from flask_debugtoolbar import DebugToolbarExtension
-from models import db, connect_db, Cupcake, CUPCAKE_FIELDS, db_add_cupcake, db_update_cupcake, db_delete_cupcake
+from models import db, connect_db, cupcake_cache, Cupcake, db_list_cupcakes, db_get_cupcake, db_get_cupcakes, get_error_message, db_get_cupcake_stats, db_stream_cupcakes, db_add_cupcake, db_add_validated_cupcakes, db_add_cupcakes, db_update_cupcake, db_update_cupcakes, db_delete_cupcake, db_delete_cupcakes, db_pool_status, db_list_cupcake_changes, db_latest_change, suggest_index
+from api_helpers import encode_cursor, cupcake_etag, list_etag, if_match_version, get_list_params, get_fields_param, get_changes_params, get_suggest_params, get_ids_param
+from serializers import dumps, json_response, ndjson_chunks
+from config import get_config
+from instrumentation import init_instrumentation
+from compression import init_compression
+from assets import init_assets
+from seed import seed_command
+from replicas import read_replica, init_replicas, sticky_primary
+from coalesce import SingleFlight, coalesce
+from group_commit import GroupCommitWriter
+from cache import LRUCache
+from images import image_cache, get_thumbnail, ImageError, THUMBNAIL_SIZES, DEFAULT_SIZE
 # from config import APP_KEY
 # from forms import
 
 app = Flask(__name__)
 
-# Flask and SQL Alchemy Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///cupcakes'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+# Flask and SQL Alchemy Configuration. Settings, including the database url and connection
+#  pool sizes, come from config.py and its environment variables; CUPCAKES_ENV picks the
+#  development, testing or production settings.
+app.config.from_object(get_config())
 
 # app.config['SECRET_KEY'] = APP_KEY
 
@@ -20,25 +38,352 @@ app.config['SQLALCHEMY_ECHO'] = True
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 connect_db(app)
+init_replicas(app, db)
+init_instrumentation(app)
+init_compression(app)
+init_assets(app)
+image_cache.configure(app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'])
+
+# rendered first page of the home page catalog, see render_catalog_page.
+catalog_cache = LRUCache(max_size=8, ttl=app.config['CATALOG_CACHE_TTL'])
+
+# concurrent identical GET requests share one query and response body, see read_key.
+read_flight = SingleFlight()
+
+# with GROUP_COMMIT_ENABLED, POST /api/cupcakes commits together with concurrent creates,
+#  see group_commit.py.
+group_writer = GroupCommitWriter(db_add_validated_cupcakes, app,
+                                 window_seconds=app.config['GROUP_COMMIT_WINDOW_MS'] / 1000,
+                                 max_rows=app.config['GROUP_COMMIT_MAX_ROWS'],
+                                 timeout_seconds=app.config['GROUP_COMMIT_TIMEOUT_MS'] / 1000)
+
+# flask seed, see seed.py. flask assets (assets.py) builds the hashed static files.
+app.cli.add_command(seed_command)
+
+
+# Helpers
+
+def read_key():
+    """ Returns the key under which concurrent requests for the same read are coalesced, or
+        None when the request runs on its own (COALESCE_READS off, or a streamed export).
+
+        The key changes with every cupcake write in this process, so a request made after a
+        write never shares a query started before it, and keeps read your writes clients
+        (replicas.py) apart from replica readers.
+    """
+
+    if (not app.config['COALESCE_READS'] or request.args.get("format") == "ndjson"):
+        return None
+
+    return (request.path, request.query_string, sticky_primary(), cupcake_cache.invalidations)
+
+
+def get_bulk_items():
+    """ Returns the list of items in the body of a bulk request. The body is either a JSON
+        array or newline delimited JSON when the Content-Type is application/x-ndjson.
+
+        ValueError with a descriptive message is raised when the body cannot be read.
+    """
+
+    if (request.mimetype == "application/x-ndjson"):
+        items = []
+        for line_number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if (line.strip()):
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    raise ValueError(
+                        f"An error occurred. Line {line_number} is not valid JSON.")
+        return items
+
+    items = request.get_json(silent=True)
+    if (type(items) != list):
+        raise ValueError(
+            "An error occurred. The body must be a JSON array or newline delimited JSON.")
+
+    return items
+
+
+def load_suggest_index():
+    """ Loads the flavor / size typeahead index. A failure (for example a database without
+        the cupcakes table before flask seed) is logged; the index then loads on first use.
+    """
+
+    try:
+        suggest_index.get_indexes()
+    except Exception as e:
+        app.logger.warning(f"The suggest index was not preloaded: {e.__class__.__name__}: {e}")
+
+
+@app.before_first_request
+def preload_suggest_index():
+    """ Starts loading the typeahead index when this worker serves its first request, in
+        the background, so no GET /api/cupcakes/suggest pays for it and importing app.py
+        (flask seed, tests, benchmarks) does not touch the database. A suggest request
+        arriving during the load waits for it instead of loading again.
+    """
+
+    if (app.config['SUGGEST_PRELOAD']):
+        threading.Thread(target=load_suggest_index, name="suggest-preload", daemon=True).start()
 
 
 # API Routes
 
 # GET /api/cupcakes
 @app.route("/api/cupcakes")
+@read_replica
+@coalesce(read_flight, read_key)
 def list_cupcakes_api():
-    """ Get information about all cupcakes.
+    """ Get information about cupcakes, one page at a time.
+
+        Query string:
+          limit=  number of cupcakes per page (default CUPCAKES_PAGE_LIMIT).
+          after=  the next cursor from the previous page.
+          fields= comma separated list of fields to return, for example fields=flavor,rating.
+                  id is always returned.
+          format=ndjson streams every cupcake, see export_cupcakes_api.
+          ids=    comma separated cupcake ids (at most CUPCAKES_IDS_MAX) to get in one
+                  request, see get_cupcakes_by_ids. The other values are ignored.
+          sort=   id, flavor, size, rating or image, -rating for descending (default id).
+          flavor=        flavor contains the value, case insensitive.
+          flavor_prefix= flavor starts with the value.
+          size=          size is the value.
+          rating_min=, rating_max= rating is in the range (inclusive).
+
+        JSON response: {cupcakes: [{id, flavor, size, rating, image}, ...], next: cursor}.
+        next is only included when there is another page.
+
+        The response has an ETag; 304 is returned for an If-None-Match request when the
+        page did not change. There is no Last-Modified: a page changes when one of its
+        rows is deleted or moves to another page, which no updated_at on it shows.
+        Concurrent identical requests share one query (coalesce.py).
+
+        400 is raised when a query string value is not valid.
+    """
+
+    if (request.args.get("format") == "ndjson"):
+        return export_cupcakes_api()
+    if ("ids" in request.args):
+        return get_cupcakes_by_ids()
+
+    try:
+        params = get_list_params(request.args,
+                                 app.config['CUPCAKES_PAGE_LIMIT'],
+                                 app.config['CUPCAKES_PAGE_LIMIT_MAX'])
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    results = db_list_cupcakes(**params)
+
+    response_data = {"cupcakes": results["cupcakes"]}
+    if (results["more"]):
+        response_data["next"] = encode_cursor(
+            {"sort": params["sort"], **results["after"]})
 
-        JSON response: {cupcakes: [{id, flavor, size, rating, image}, ...]}.
+    # If-None-Match requests for an unchanged page get a 304 from coalesce.
+    response = json_response(response_data)
+    response.set_etag(list_etag(request.query_string, results))
+
+    return response
+
+
+def get_cupcakes_by_ids():
+    """ GET /api/cupcakes?ids=1,2,3: the cupcakes identified by ids, in one query.
+
+        JSON response: {results: [{id, response_code, cupcake}, ...]} in the order of ids.
+        Each result has the response_code and body GET /api/cupcakes/<id> would have
+        returned, {cupcake: {...}} for 200 and {error: {message}} for 404.
+
+        400 is raised when ids= is empty or lists more than CUPCAKES_IDS_MAX ids.
     """
-    cupcakes = Cupcake.query.all()
-    serialized = [cupcake.serialize() for cupcake in cupcakes]
 
-    return jsonify(cupcakes=serialized)
+    try:
+        cupcake_ids = get_ids_param(request.args, app.config['CUPCAKES_IDS_MAX'])
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    results = db_get_cupcakes(cupcake_ids)
+
+    response = json_response({"results": results["results"]})
+    response.set_etag(list_etag(request.query_string,
+                                {"versions": results["versions"], "more": False}))
+    return response
+
+
+# GET /api/cupcakes/export
+@app.route("/api/cupcakes/export")
+@read_replica
+def export_cupcakes_api():
+    """ Stream every cupcake as newline delimited JSON (one cupcake object per line).
+
+        Query string:
+          fields= comma separated list of fields to return. id is always returned.
+
+        Rows are read with a server side cursor and written out as they arrive, so the
+        first line is sent right away and memory use stays flat regardless of table size.
+
+        Response: application/x-ndjson, {id, flavor, size, rating, image} per line.
+
+        400 is raised when fields is not valid.
+    """
+
+    try:
+        fields = get_fields_param(request.args)
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    return Response(stream_with_context(ndjson_chunks(db_stream_cupcakes(fields))),
+                    mimetype="application/x-ndjson")
+
+
+# GET /api/cupcakes/stats
+@app.route("/api/cupcakes/stats")
+@read_replica
+def cupcake_stats_api():
+    """ Get rating statistics for all cupcakes and for each size and flavor.
+
+        Statistics come from the cupcake_stats summary table, one row per size / flavor /
+        rating bucket, which the add, update and delete functions maintain. min, max and
+        the histogram use the rating buckets (models.RATING_BUCKET); the mean is exact.
+
+        JSON response: {stats: {count, mean, min, max, histogram: {rating bucket: count},
+          sizes: {size: {count, mean, min, max, histogram}, ...},
+          flavors: {flavor: {count, mean, min, max, histogram}, ...}}}.
+    """
+
+    return json_response({"stats": db_get_cupcake_stats()})
+
+
+# GET /api/cupcakes/suggest
+@app.route("/api/cupcakes/suggest")
+def suggest_cupcakes_api():
+    """ Get existing flavors and sizes that start with what was typed, for typeahead.
+
+        Query string:
+          q=     the text typed so far, case insensitive. Leave it out for the most common values.
+          field= flavor or size (default both).
+          limit= suggestions per field (default SUGGEST_LIMIT).
+
+        JSON response: {suggestions: {flavor: [{value, count}, ...], size: [...]}}, the values
+        used by the most cupcakes first. Answered from an in-process index, see suggest.py.
+
+        400 is raised when a query string value is not valid.
+    """
+
+    try:
+        params = get_suggest_params(request.args, suggest_index.fields,
+                                    app.config['SUGGEST_LIMIT'], app.config['SUGGEST_LIMIT_MAX'])
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    return json_response({"suggestions": suggest_index.suggest(**params)})
+
+
+# GET /api/cupcakes/changes
+@app.route("/api/cupcakes/changes")
+@read_replica
+def cupcake_changes_api():
+    """ Get the cupcakes created, updated or deleted since the last sync of a client.
+
+        Query string:
+          since= the cursor from the previous response. Leave it out on the first sync.
+          limit= maximum number of changes (default CHANGES_PAGE_LIMIT).
+
+        JSON response: {changes: [{seq, op, id, cupcake}, ...], cursor, more, reset}.
+        op is create, update or delete; cupcake holds the values after a create or update
+        and is null for a delete. Only the latest change of a cupcake is returned. When more
+        is true, ask again right away with since=cursor.
+
+        reset is true on a first sync and when the change log cannot bring the client up
+        to date (the cupcakes were reloaded or the tables recreated): read every cupcake
+        with GET /api/cupcakes, then continue with since=cursor.
+
+        400 is raised when a query string value is not valid.
+    """
+
+    try:
+        params = get_changes_params(request.args, page_limit=app.config['CHANGES_PAGE_LIMIT'],
+                                    page_limit_max=app.config['CUPCAKES_PAGE_LIMIT_MAX'])
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    results = db_list_cupcake_changes(**params)
+    results["cursor"] = str(results["cursor"])
+
+    return json_response(results)
+
+
+def change_events(since, limit):
+    """ Generator of Server-Sent Events for the cupcake changes after since, polling the
+        change log every CHANGES_STREAM_POLL_SECONDS for CHANGES_STREAM_MAX_SECONDS.
+    """
+
+    poll_seconds = app.config['CHANGES_STREAM_POLL_SECONDS']
+    deadline = time.monotonic() + app.config['CHANGES_STREAM_MAX_SECONDS']
+    last_sent = time.monotonic()
+
+    # EventSource waits retry milliseconds before it reconnects with Last-Event-ID.
+    yield f"retry: {int(poll_seconds * 1000)}\n\n"
+
+    while (time.monotonic() < deadline):
+        results = db_list_cupcake_changes(since, limit)
+        # hand the connection back to the pool between polls.
+        db.session.remove()
+
+        since = results["cursor"]
+        if (results["reset"]):
+            yield f"event: reset\nid: {since}\ndata: {dumps({'cursor': str(since)}).decode()}\n\n"
+            last_sent = time.monotonic()
+        for change in results["changes"]:
+            yield f"event: change\nid: {change['seq']}\ndata: {dumps(change).decode()}\n\n"
+            last_sent = time.monotonic()
+
+        if (results["more"]):
+            continue
+
+        if (time.monotonic() - last_sent >= 15):
+            # comment line so proxies keep the connection open.
+            yield ": keep-alive\n\n"
+            last_sent = time.monotonic()
+
+        time.sleep(poll_seconds)
+
+
+# GET /api/cupcakes/changes/stream
+@app.route("/api/cupcakes/changes/stream")
+@read_replica
+def cupcake_changes_stream_api():
+    """ The change feed of cupcake_changes_api as a Server-Sent Events (text/event-stream)
+        stream for EventSource clients.
+
+        Events: "change" with a {seq, op, id, cupcake} change as data, and "reset" with
+        {cursor} when the client must read every cupcake again. The id of each event is
+        its cursor, so a reconnecting EventSource continues from its Last-Event-ID. The
+        server ends the stream after CHANGES_STREAM_MAX_SECONDS; EventSource reconnects.
+
+        400 is raised when a query string value is not valid.
+    """
+
+    try:
+        params = get_changes_params(request.args, request.headers.get("Last-Event-ID"),
+                                    app.config['CHANGES_PAGE_LIMIT'],
+                                    app.config['CUPCAKES_PAGE_LIMIT_MAX'])
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    response = Response(stream_with_context(change_events(**params)),
+                        mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    # nginx: send events as they are written.
+    response.headers["X-Accel-Buffering"] = "no"
+
+    return response
 
 
 # GET /api/cupcakes/[cupcake-id]
 @app.route("/api/cupcakes/<cupcake_id>")
+@read_replica
+@coalesce(read_flight, read_key)
 def list_cupcake_api(cupcake_id):
     """ Get information about a single cupcake identified by cupcake_id.
 
@@ -47,6 +392,10 @@ def list_cupcake_api(cupcake_id):
 
         JSON response: {cupcake: {id, flavor, size, rating, image}}.
 
+        The response has an ETag and Last-Modified. 304 is returned for a conditional
+        request (If-None-Match / If-Modified-Since) when the cupcake did not change.
+        Concurrent identical requests share one lookup (coalesce.py).
+
         404 is raised when the cupcake identified by cupcake_id was not found or when
         cupcake_id is not an integer.
 
@@ -54,26 +403,16 @@ def list_cupcake_api(cupcake_id):
 
     # only use cupcake_id for a db lookup when we know it is an integer
     if (cupcake_id.isnumeric()):
-        cupcake = Cupcake.query.get(cupcake_id)
-        if (cupcake):
-            response_code = 200
-            response_data = {
-                "cupcake": cupcake.serialize()
-            }
+        cached = db_get_cupcake(cupcake_id)
+        if (cached):
+            response = json_response({"cupcake": cached["cupcake"]})
+            response.set_etag(cupcake_etag(cached["cupcake"]["id"], cached["version"]))
+            response.last_modified = datetime.fromisoformat(cached["updated_at"])
 
-        else:
-            response_code = 404
-            response_data = {
-                "error": {"message": f"Cupcake id={cupcake_id} was not found"}
-            }
+            return response
 
-    else:
-        response_code = 404
-        response_data = {
-            "error": {"message": f"Cupcake id='{cupcake_id}' was not an integer."}
-        }
-
-    return (jsonify(response_data), response_code)
+    # not found, or not an integer
+    return json_response({"error": {"message": get_error_message(cupcake_id)}}, 404)
 
 
 # POST /api/cupcakes
@@ -85,21 +424,21 @@ def create_cupcake_api():
         Responds wtih
         201 on successful add with JSON Response {cupcake: {id, flavor, size, rating, image}} 
         400 on an error with JSON response {error: "An error occurred. Non-blank values 
-          required for flavor, size, and rating. " } when required fields missing 
+          required for flavor, size, and rating. ", fields: {field: message} } when required
+          fields are missing or a value is not valid (fields lists every invalid field)
         400 on an error with JSON response {error: "An error occurred. " } when an unexpected
           error occurred.         
+        503 on an error with JSON response {error: "An error occurred. ..." } when group
+          commit is enabled and the writer did not save the cupcake in time.
 
     """
 
     # print(
     #     f"\n\ncreate_cupcake_api: request.headers = {request.headers}", flush=True)
 
-    cupcake_data = CUPCAKE_FIELDS
-
-    for key in cupcake_data.keys():
-        cupcake_data[key] = request.json.get(key, '')
-
-    results = db_add_cupcake(cupcake_data)
+    # the body is validated by db_add_cupcake before the database is used.
+    results = db_add_cupcake(request.get_json(silent=True),
+                             group_writer if app.config['GROUP_COMMIT_ENABLED'] else None)
 
     if (results["successful"]):
         # on success / okay, message contains serialized information for the new cupcake.
@@ -107,9 +446,92 @@ def create_cupcake_api():
         response_code = 201
     else:
         response_data = {"error": results["message"]}
-        response_code = 400
+        if ("fields" in results):
+            response_data["fields"] = results["fields"]
+        response_code = results.get("response_code", 400)
+
+    return json_response(response_data, response_code)
+
+
+# POST /api/cupcakes/bulk
+@app.route("/api/cupcakes/bulk", methods=["POST"])
+def create_cupcakes_bulk_api():
+    """ Create many cupcakes in one request and one transaction.
+
+        The body is a JSON array of {flavor, size, rating, image} objects, or newline 
+        delimited JSON (Content-Type: application/x-ndjson) with one object per line.
+        Each cupcake is checked with the same rules as POST /api/cupcakes and nothing
+        is added when any cupcake has an issue.
+
+        Responds with
+        201 on successful add with JSON Response {cupcakes: [{index, id}, ...]}
+        400 on an error with JSON Response {error: {message, items: [{index, message}, ...]}}
+          where items lists every cupcake with an issue by its position in the body.
+
+    """
+
+    try:
+        cupcake_specs = get_bulk_items()
+    except ValueError as e:
+        return json_response({"error": {"message": str(e), "items": []}}, 400)
+
+    results = db_add_cupcakes(cupcake_specs)
+
+    if (results["successful"]):
+        response_data = {"cupcakes": results["message"]}
+    else:
+        response_data = {
+            "error": {"message": results["message"], "items": results["items"]}}
+
+    return json_response(response_data, results["response_code"])
+
+
+# PATCH /api/cupcakes/bulk
+@app.route("/api/cupcakes/bulk", methods=["PATCH"])
+def update_cupcakes_bulk_api():
+    """ Update many cupcakes in one request.
+
+        The body is a JSON array (or newline delimited JSON) of
+        {id, flavor, size, rating, image} objects. Like PATCH /api/cupcakes/<id>, every
+        field is required and cupcakes without changes are not written.
+
+        Responds with
+        200 with JSON Response {results: [{id, response_code, cupcake}, ...]}. Each result
+          has the response_code and body the single cupcake PATCH would have returned,
+          {cupcake: {...}} for 200 and {error: {message}} for 400 / 404.
+        400 when the body is not a JSON array.
+
+    """
+
+    try:
+        cupcake_edits_list = get_bulk_items()
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    return json_response({"results": db_update_cupcakes(cupcake_edits_list)})
+
+
+# DELETE /api/cupcakes/bulk
+@app.route("/api/cupcakes/bulk", methods=["DELETE"])
+def delete_cupcakes_bulk_api():
+    """ Delete many cupcakes in one request.
+
+        The body is a JSON array of cupcake ids.
 
-    return (jsonify(response_data), response_code)
+        Responds with
+        200 with JSON Response {results: [{id, response_code, message}, ...]}. Each result
+          has the response_code and body the single cupcake DELETE would have returned,
+          {message: {deleted: {...}}} for 200 and {error: {message}} for 404.
+        400 when the body is not a JSON array.
+
+    """
+
+    try:
+        cupcake_ids = get_bulk_items()
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    return json_response({"results": db_delete_cupcakes(cupcake_ids)})
 
 
 @app.route("/api/cupcakes/<cupcake_id>", methods=["PATCH"])
@@ -120,27 +542,35 @@ def update_cupcake_api(cupcake_id):
         Responds wtih
         200 on successful update with JSON Response {cupcake: {id, flavor, size, rating, image}} 
 
-        400 when there was an issue found with the data.
+        400 when there was an issue found with the data. error.fields is {field: message}
+          for every invalid field when the body did not pass validation.
         404 when the cupcake identified by cupcake_id was not found or when cupcake_id is 
           not an integer.
+        412 when an If-Match header was sent and the cupcake is no longer at that version
+          (the ETag from GET /api/cupcakes/<cupcake_id>).
         For 40x errors, JSON Response is {error: {message: descriptive error message}}
 
     """
 
     # only use cupcake_id for a db lookup when we know it is an integer
     if (cupcake_id.isnumeric()):
-        cupcake_data = CUPCAKE_FIELDS
+        cupcake_data = request.get_json(silent=True)
 
-        for key in cupcake_data.keys():
-            cupcake_data[key] = request.json.get(key, None)
+        # If-Match: "<id>-<version>" only updates the cupcake when it is still at that
+        #  version. If-Match: * updates any version.
+        expected_version = if_match_version(request.if_match, cupcake_id)
 
-        results = db_update_cupcake(cupcake_id, cupcake_data)
+        results = db_update_cupcake(cupcake_id, cupcake_data, expected_version)
 
         if (results["successful"]):
             # on success / okay, message contains serialized information for the new cupcake.
-            response_data = {"cupcake": results["message"]}
+            response = json_response({"cupcake": results["message"]})
+            response.set_etag(cupcake_etag(results["message"]["id"], results["version"]))
+            return response
         else:
             response_data = {"error": {"message": results["message"]}}
+            if ("fields" in results):
+                response_data["error"]["fields"] = results["fields"]
 
         response_code = results["response_code"]
 
@@ -150,7 +580,7 @@ def update_cupcake_api(cupcake_id):
         }
         response_code = 404
 
-    return (jsonify(response_data), response_code)
+    return json_response(response_data, response_code)
 
 
 # DELETE /api/cupcakes/[cupcake-id]
@@ -187,16 +617,125 @@ def delete_cupcake_api(cupcake_id):
             "error": {"message": f"Cupcake id='{cupcake_id}' was not an integer. No delete occurred. "}
         }
 
-    return (jsonify(response_data), response_code)
+    return json_response(response_data, response_code)
+
+
+# GET /api/status/cache
+@app.route("/api/status/cache")
+def cache_status_api():
+    """ Get the hit, miss and eviction counters of the cupcake cache.
+
+        JSON response: {cache: {hits, misses, evictions, expirations, shared_hits,
+          shared_misses, loads, size, max_size}}.
+    """
+
+    return json_response({"cache": cupcake_cache.get_stats()})
+
+
+# GET /api/status/pool
+@app.route("/api/status/pool")
+def pool_status_api():
+    """ Get the connection pool settings and utilization of this worker process.
+
+        JSON response: {pools: [{url, pool, connects, checkouts, checkins, invalidations,
+          checked_out, checked_out_peak, checkout_seconds, size, checkedin, overflow,
+          timeout, max_overflow}]}. size / checkedin / overflow / timeout / max_overflow are
+          only reported for pools that have them (QueuePool).
+    """
+
+    return json_response({"pools": db_pool_status()})
+
+
+# GET /api/status/replicas
+@app.route("/api/status/replicas")
+def replica_status_api():
+    """ Get the health of the read replicas as of their last check.
+
+        JSON response: {replicas: [{name, healthy, checked_seconds_ago, reason}]}. healthy is
+          null for a replica that was not checked yet.
+    """
+
+    return json_response({"replicas": db.replica_router.status()})
+
+
+# GET /images/[cupcake-id]
+@app.route("/images/<cupcake_id>")
+def cupcake_image(cupcake_id):
+    """ Get a thumbnail of the image of the cupcake identified by cupcake_id.
+
+        Query string:
+          size=  small, medium or large (default medium), see images.THUMBNAIL_SIZES.
+
+        The image is fetched, resized and cached on disk the first time it is requested,
+        see images.py. The response is cacheable for IMAGE_MAX_AGE seconds and has an
+        ETag from the image content; 304 is returned for a matching If-None-Match.
+
+        404 is raised when the cupcake was not found or cupcake_id is not an integer, 400
+        for an unknown size and 502 when the image could not be fetched or read.
+    """
+
+    size = request.args.get("size", DEFAULT_SIZE)
+    if (size not in THUMBNAIL_SIZES):
+        return json_response({"error": {"message": f"size='{size}' is not one of {', '.join(THUMBNAIL_SIZES)}."}}, 400)
+
+    # only use cupcake_id for a db lookup when we know it is an integer
+    if (not cupcake_id.isnumeric()):
+        return json_response({"error": {"message": f"Cupcake id='{cupcake_id}' was not an integer."}}, 404)
+
+    cached = db_get_cupcake(cupcake_id)
+    if (not cached):
+        return json_response({"error": {"message": f"Cupcake id={cupcake_id} was not found"}}, 404)
+
+    try:
+        thumbnail, mimetype, digest = get_thumbnail(
+            cached["cupcake"]["image"], size, app.static_folder, app.static_url_path,
+            app.config['IMAGE_LOCAL_HOSTS'] + (request.host,),
+            app.config['IMAGE_FETCH_TIMEOUT'], app.config['IMAGE_MAX_SOURCE_BYTES'])
+    except ImageError as e:
+        return json_response({"error": {"message": e.message}}, e.response_code)
+
+    response = app.response_class(thumbnail, mimetype=mimetype)
+    response.set_etag(f"{digest}-{size}")
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['IMAGE_MAX_AGE']
+
+    return response.make_conditional(request.environ)
 
 
 # HTML Routes
 
-# GET /api/cupcakes
+def render_catalog_page():
+    """ Returns (first catalog page as HTML, next cursor, change feed cursor).
+
+        The rendered page is kept in catalog_cache under the newest cupcake change, so it
+        is rendered again only after a cupcake was written.
+    """
+
+    latest_seq, latest_changed_at = db_latest_change()
+    limit = app.config['CATALOG_PAGE_LIMIT']
+    key = (latest_seq, latest_changed_at, limit)
+
+    found, page = catalog_cache.get(key)
+    if (not found):
+        results = db_list_cupcakes(limit=limit)
+        next_cursor = encode_cursor(
+            {"sort": "id", **results["after"]}) if results["more"] else None
+        page = (Markup(render_template("_cupcake_list.html", cupcakes=results["cupcakes"])),
+                next_cursor, latest_seq)
+        catalog_cache.set(key, page)
+
+    return page
+
+
+# GET /
 @app.route("/")
+@read_replica
 def home_page():
-    """ Render a template to an empty home page.
-        JavaScript will take care of the rest.
+    """ Render the home page with the first CATALOG_PAGE_LIMIT cupcakes. JavaScript loads
+        the next pages as the user scrolls and keeps the list current with the change feed.
     """
 
-    return render_template("index.html")
+    catalog, next_cursor, changes_cursor = render_catalog_page()
+
+    return render_template("index.html", catalog=catalog, next=next_cursor,
+                           changes_cursor=changes_cursor)
@@ -0,0 +1,173 @@
+"""Content hashed static assets.
+
+    flask assets        build static/dist from the files in static
+
+Every file in the static folder is copied to ASSETS_DIR (default static/dist) under a name
+with a hash of its content, for example cupcakes.3f2a91c4d0.js, and text files also get
+precompressed .gz (and .br with the brotli package) variants. manifest.json maps the
+original names to the hashed ones.
+
+Templates link assets with asset_url("cupcakes.js"). With a manifest that is the hashed
+file under /assets/, served with Cache-Control: immutable and the precompressed variant
+the client accepts; a changed file gets a new name, so browsers never see a stale copy.
+Without a manifest (no build yet) asset_url falls back to the plain /static/ url.
+"""
+
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import with_appcontext
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+from compression import ENCODINGS, ENCODING_SUFFIXES, choose_encoding, compress, compressible
+
+MANIFEST = "manifest.json"
+
+# a year; hashed names never change content.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def hashed_name(name, data):
+    """ Returns name with the first 10 hex digits of the SHA-256 of data before the extension. """
+
+    root, extension = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:10]}{extension}"
+
+
+def build_assets(static_folder, output_dir, level=9, brotli_quality=11):
+    """ Writes the hashed (and precompressed) copies of the files in static_folder and the
+        manifest to output_dir, which is emptied first. Returns the manifest.
+    """
+
+    if (os.path.isdir(output_dir)):
+        shutil.rmtree(output_dir)
+
+    output_real = os.path.realpath(output_dir)
+    manifest = {}
+    for root, directories, names in os.walk(static_folder):
+        # leave the build output (static/dist) out of the build.
+        directories[:] = [directory for directory in directories
+                          if os.path.realpath(os.path.join(root, directory)) != output_real]
+
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, static_folder).replace(os.sep, "/")
+            with open(path, "rb") as source:
+                data = source.read()
+
+            hashed = hashed_name(relative, data)
+            target = os.path.join(output_dir, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as output:
+                output.write(data)
+
+            mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if (compressible(mimetype)):
+                for encoding in ENCODINGS:
+                    with open(target + ENCODING_SUFFIXES[encoding], "wb") as output:
+                        output.write(compress(data, encoding, level, brotli_quality))
+
+            manifest[relative] = hashed
+
+    with open(os.path.join(output_dir, MANIFEST), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class AssetManifest:
+    """ The manifest of ASSETS_DIR, read again when the file changes. """
+
+    def __init__(self):
+        self.path = None
+        self.mtime = None
+        self.entries = {}
+
+    def get(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return {}
+
+        if (path != self.path or mtime != self.mtime):
+            with open(path) as manifest_file:
+                self.entries = json.load(manifest_file)
+            self.path, self.mtime = path, mtime
+
+        return self.entries
+
+
+asset_manifest = AssetManifest()
+
+
+def assets_dir(app):
+    return os.path.join(app.root_path, app.config.get("ASSETS_DIR", "static/dist"))
+
+
+def asset_url(name):
+    """ Returns the url for the static file name: the hashed /assets/ url when it is in the
+        manifest, else the /static/ url.
+    """
+
+    manifest = asset_manifest.get(os.path.join(assets_dir(current_app), MANIFEST))
+    if (name in manifest):
+        return url_for("asset", filename=manifest[name])
+    return url_for("static", filename=name)
+
+
+@click.command("assets")
+@click.option("--output", help="Directory for the built assets (default ASSETS_DIR).")
+@with_appcontext
+def assets_command(output):
+    """ Build the content hashed and precompressed static assets. """
+
+    app = current_app
+    output_dir = output or assets_dir(app)
+    manifest = build_assets(app.static_folder, output_dir)
+
+    click.echo(f"{len(manifest)} assets written to {output_dir}.")
+
+
+def init_assets(app):
+    """ Adds GET /assets/<filename>, the asset_url template function and flask assets to app. """
+
+    app.add_template_global(asset_url)
+    app.cli.add_command(assets_command)
+
+    # GET /assets/[filename]
+    @app.route("/assets/<path:filename>")
+    def asset(filename):
+        """ A hashed static file, with immutable caching and the best precompressed
+            variant for the Accept-Encoding of the request.
+        """
+
+        directory = assets_dir(app)
+        path = safe_join(directory, filename)
+        if (filename == MANIFEST or path is None or not os.path.isfile(path)):
+            raise NotFound()
+
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        available = [encoding for encoding in ENCODINGS
+                     if os.path.isfile(path + ENCODING_SUFFIXES[encoding])]
+        encoding = choose_encoding(request.accept_encodings, available)
+
+        if (encoding):
+            response = send_from_directory(directory, filename + ENCODING_SUFFIXES[encoding],
+                                           mimetype=mimetype, cache_timeout=IMMUTABLE_MAX_AGE)
+            response.headers["Content-Encoding"] = encoding
+        else:
+            response = send_from_directory(directory, filename, mimetype=mimetype,
+                                           cache_timeout=IMMUTABLE_MAX_AGE)
+
+        if (available):
+            response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+
+        return response
@@ -0,0 +1,406 @@
+"""Async serving mode for the Cupcakes API.
+
+Serves the cupcake CRUD and statistics routes of app.py with the same JSON bodies and status
+codes, using Quart and the SQLAlchemy 1.4 asyncio engine (asyncpg). Requests waiting on
+PostgreSQL do not hold a worker thread. Run with, for example,
+
+    hypercorn --workers 4 async_app:app
+
+The bulk, export and status routes are only served by app.py.
+"""
+
+from datetime import datetime, timezone
+
+from quart import Quart, request
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+
+from coalesce import AsyncSingleFlight
+from config import get_config
+from api_helpers import encode_cursor, cupcake_etag, list_etag, if_match_version, get_list_params, get_ids_param
+from models import (Cupcake, cupcake_cache, cupcake_cache_entry, cupcake_list_statement,
+                    cupcake_list_page, cupcake_stats_deltas, db_adjust_cupcake_stats, db_get_cupcake_stats,
+                    create_error_message, update_error_message, change_occurred, version_mismatch_results,
+                    record_cupcake_changes, db_get_cupcakes, get_error_message, suggest_index)
+from pool_metrics import track_engine
+from serializers import dumps
+from validators import validate_cupcake_create, validate_cupcake_update, field_messages
+
+app = Quart(__name__)
+
+# same settings as app.py (config.py); the engine uses ASYNC_DATABASE_URI and the DB_* pool
+#  settings. SQL statements are not echoed.
+app.config.from_object(get_config())
+app.config['SQLALCHEMY_ECHO'] = False
+
+# the engine is created on first use so the database settings can be changed after import.
+engines = {}
+
+# concurrent identical list and detail requests share one query and encoded body, see
+#  coalesced.
+read_flight = AsyncSingleFlight()
+
+
+def get_session():
+    """ Returns a new AsyncSession on the engine for ASYNC_DATABASE_URI. """
+
+    uri = app.config['ASYNC_DATABASE_URI']
+    if (uri not in engines):
+        options = {"echo": app.config['SQLALCHEMY_ECHO'],
+                   "pool_pre_ping": app.config['DB_POOL_PRE_PING']}
+        if (not uri.startswith("sqlite")):
+            options["pool_size"] = app.config['DB_POOL_SIZE']
+            options["max_overflow"] = app.config['DB_MAX_OVERFLOW']
+            options["pool_timeout"] = app.config['DB_POOL_TIMEOUT']
+            options["pool_recycle"] = app.config['DB_POOL_RECYCLE']
+            if (app.config['DB_STATEMENT_TIMEOUT_MS']):
+                options["connect_args"] = {"server_settings": {
+                    "statement_timeout": str(app.config['DB_STATEMENT_TIMEOUT_MS'])}}
+        engine = create_async_engine(uri, **options)
+        track_engine(engine.sync_engine)
+        engines[uri] = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    return engines[uri]()
+
+
+def json_response(data, status=200):
+    """ Returns an application/json response with data serialized by serializers.dumps,
+        like json_response in serializers.py does for app.py.
+    """
+
+    return app.response_class(dumps(data), status=status, mimetype="application/json")
+
+
+def record_write(sync_session, stats_deltas, op, cupcakes):
+    """ Updates cupcake_stats and the change log for a write, on the sync session of an
+        AsyncSession (AsyncSession.run_sync).
+    """
+
+    db_adjust_cupcake_stats(stats_deltas, sync_session)
+    record_cupcake_changes(op, cupcakes, sync_session)
+
+
+async def coalesced(load):
+    """ Returns await load(), shared by concurrent requests for the same path and query
+        string (COALESCE_READS). The key changes with every cupcake write in this process,
+        so a request made after a write never shares a query started before it.
+    """
+
+    if (not app.config['COALESCE_READS']):
+        return await load()
+
+    key = (request.path, request.query_string, cupcake_cache.invalidations)
+    return await read_flight.do(key, load)
+
+
+def not_modified(etag, last_modified):
+    """ True when the conditional request headers show the client has the current response. """
+
+    if (request.if_none_match):
+        return request.if_none_match.contains(etag)
+
+    if (request.if_modified_since and last_modified):
+        return last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since
+
+    return False
+
+
+def conditional_response(body, etag, last_modified):
+    """ Returns the JSON response for the encoded body with ETag / Last-Modified, or an
+        empty 304 response when the client already has it.
+    """
+
+    if (not_modified(etag, last_modified)):
+        response = app.response_class("", status=304)
+    else:
+        response = app.response_class(body, mimetype="application/json")
+
+    response.set_etag(etag)
+    if (last_modified):
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+
+    return response
+
+
+# API Routes
+
+# GET /api/cupcakes
+@app.route("/api/cupcakes")
+async def list_cupcakes_api():
+    """ Get information about cupcakes, one page at a time. Same query string and responses
+        as list_cupcakes_api in app.py, except format=ndjson.
+    """
+
+    if ("ids" in request.args):
+        return await get_cupcakes_by_ids()
+
+    try:
+        params = get_list_params(request.args,
+                                 app.config['CUPCAKES_PAGE_LIMIT'],
+                                 app.config['CUPCAKES_PAGE_LIMIT_MAX'])
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    query_string = request.query_string
+
+    async def load_page():
+        async with get_session() as session:
+            rows = (await session.execute(cupcake_list_statement(**params))).all()
+
+        results = cupcake_list_page(rows, params["limit"])
+
+        response_data = {"cupcakes": results["cupcakes"]}
+        if (results["more"]):
+            response_data["next"] = encode_cursor(
+                {"sort": params["sort"], **results["after"]})
+
+        # no Last-Modified, like app.py: deleting a row changes the page without changing
+        #  any updated_at on it.
+        return (dumps(response_data), list_etag(query_string, results), None)
+
+    return conditional_response(*await coalesced(load_page))
+
+
+async def get_cupcakes_by_ids():
+    """ GET /api/cupcakes?ids=1,2,3, same responses as get_cupcakes_by_ids in app.py. """
+
+    try:
+        cupcake_ids = get_ids_param(request.args, app.config['CUPCAKES_IDS_MAX'])
+    except ValueError as e:
+        return json_response({"error": {"message": str(e)}}, 400)
+
+    query_string = request.query_string
+
+    async def load_results():
+        async with get_session() as session:
+            results = await session.run_sync(
+                lambda sync_session: db_get_cupcakes(cupcake_ids, sync_session))
+        return (dumps({"results": results["results"]}),
+                list_etag(query_string, {"versions": results["versions"], "more": False}))
+
+    body, etag = await coalesced(load_results)
+    return conditional_response(body, etag, None)
+
+
+# GET /api/cupcakes/stats
+@app.route("/api/cupcakes/stats")
+async def cupcake_stats_api():
+    """ Get rating statistics for all cupcakes and for each size and flavor. """
+
+    async with get_session() as session:
+        stats = await session.run_sync(lambda sync_session: db_get_cupcake_stats(sync_session))
+
+    return json_response({"stats": stats})
+
+
+# GET /api/cupcakes/[cupcake-id]
+@app.route("/api/cupcakes/<cupcake_id>")
+async def list_cupcake_api(cupcake_id):
+    """ Get information about a single cupcake identified by cupcake_id. Same responses as
+        list_cupcake_api in app.py.
+    """
+
+    # only use cupcake_id for a db lookup when we know it is an integer
+    if (cupcake_id.isnumeric()):
+
+        async def load_cupcake():
+            async with get_session() as session:
+                return cupcake_cache_entry(await session.get(Cupcake, int(cupcake_id)))
+
+        async def load_response():
+            cached = await cupcake_cache.get_or_load_async(int(cupcake_id), load_cupcake)
+            if (cached):
+                return (dumps({"cupcake": cached["cupcake"]}),
+                        cupcake_etag(cached["cupcake"]["id"], cached["version"]),
+                        datetime.fromisoformat(cached["updated_at"]))
+            return None
+
+        found = await coalesced(load_response)
+        if (found):
+            return conditional_response(*found)
+
+    # not found, or not an integer
+    return json_response({"error": {"message": get_error_message(cupcake_id)}}, 404)
+
+
+# POST /api/cupcakes
+@app.route("/api/cupcakes", methods=["POST"])
+async def create_cupcake_api():
+    """ Create a cupcake with flavor, size, rating and image data from the body of the JSON
+        request. Same responses as create_cupcake_api in app.py.
+    """
+
+    request_json = await request.get_json(silent=True)
+
+    # bad bodies are rejected before a session is opened.
+    validation = validate_cupcake_create(request_json)
+    if (validation.errors):
+        return json_response({"error": create_error_message(request_json, validation.errors),
+                              "fields": field_messages(validation.errors)}, 400)
+
+    cupcake_spec = {key: value for key, value in validation.values.items() if value is not None}
+
+    async with get_session() as session:
+        new_cupcake = Cupcake(**cupcake_spec)
+
+        try:
+            session.add(new_cupcake)
+            await session.flush()
+            await session.run_sync(record_write, cupcake_stats_deltas(added=[new_cupcake.serialize()]),
+                                   "create", [new_cupcake.serialize()])
+            await session.commit()
+            cupcake_cache.invalidate(new_cupcake.id)
+            suggest_index.apply(added=[new_cupcake.serialize()])
+
+            # read the values back like the sync app does after its commit.
+            await session.refresh(new_cupcake)
+
+            return json_response({"cupcake": new_cupcake.serialize()}, 201)
+
+        except:
+            await session.rollback()
+
+            return json_response({"error": "An error occurred."}, 400)
+
+
+# PATCH /api/cupcakes/[cupcake-id]
+@app.route("/api/cupcakes/<cupcake_id>", methods=["PATCH"])
+async def update_cupcake_api(cupcake_id):
+    """ Update a cupcake with flavor, size, rating and image data from the body of a JSON
+        request. Same responses (and If-Match handling) as update_cupcake_api in app.py.
+    """
+
+    # only use cupcake_id for a db lookup when we know it is an integer
+    if (not cupcake_id.isnumeric()):
+        response_data = {
+            "error": {"message": f"Update Error: Cupcake id='{cupcake_id}' was not an integer. No updates occurred."}
+        }
+        return json_response(response_data, 404)
+
+    cupcake_edits_in = await request.get_json(silent=True)
+
+    validation = validate_cupcake_update(cupcake_edits_in)
+    if (validation.errors):
+        response_data = {"error": {
+            "message": update_error_message(cupcake_id, cupcake_edits_in, validation.errors),
+            "fields": field_messages(validation.errors)}}
+        return json_response(response_data, 400)
+
+    async with get_session() as session:
+        results = await update_cupcake(session, cupcake_id, validation.values,
+                                       if_match_version(request.if_match, cupcake_id))
+
+    if (results["successful"]):
+        response = json_response({"cupcake": results["message"]})
+        response.set_etag(cupcake_etag(
+            results["message"]["id"], results["version"]))
+        return response
+
+    return json_response({"error": {"message": results["message"]}}, results["response_code"])
+
+
+async def update_cupcake(session, cupcake_id, cupcake_edits_in, expected_version=None):
+    """ db_update_cupcake from models.py on an AsyncSession, for cupcake_edits_in that
+        passed validate_cupcake_update. Returns the same results.
+    """
+
+    db_cupcake = await session.get(Cupcake, int(cupcake_id))
+
+    if (db_cupcake is None):
+        return {
+            "message": f"Update Error: Cupcake id={cupcake_id} was not found. No updates occurred.",
+            "successful": False,
+            "response_code": 404
+        }
+
+    if (expected_version is not None and db_cupcake.version != expected_version):
+        return version_mismatch_results(cupcake_id)
+
+    cupcake_edits = {"id": int(cupcake_id), **cupcake_edits_in}
+
+    previous = db_cupcake.serialize()
+    data_check = change_occurred(previous, cupcake_edits)
+
+    if (not data_check["changed"]):
+        if (len(data_check["message"]) > 0):
+            return {"message": f"Update Error: { data_check['message'] }", "successful": False, "response_code": 400}
+
+        # no changes and message is "". There were no data issues.
+        return {"message": previous, "version": db_cupcake.version, "successful": True, "response_code": 200}
+
+    db_cupcake.flavor = cupcake_edits["flavor"]
+    db_cupcake.size = cupcake_edits["size"]
+    db_cupcake.rating = cupcake_edits["rating"]
+    db_cupcake.image = cupcake_edits["image"]
+
+    try:
+        await session.flush()
+        await session.run_sync(record_write, cupcake_stats_deltas(removed=[previous], added=[cupcake_edits]),
+                               "update", [cupcake_edits])
+        await session.commit()
+        cupcake_cache.invalidate(db_cupcake.id)
+        suggest_index.apply(removed=[previous], added=[cupcake_edits])
+
+        await session.refresh(db_cupcake)
+
+        return {"message": db_cupcake.serialize(), "version": db_cupcake.version,
+                "successful": True, "response_code": 200}
+
+    except StaleDataError:
+        # another request updated or deleted the cupcake after we read it.
+        await session.rollback()
+        return version_mismatch_results(cupcake_id)
+
+    except:
+        await session.rollback()
+        return {
+            "message": f"Update Error: An error occurred while updating {previous['id']}: {previous['flavor']}. No updates occurred.",
+            "successful": False,
+            "response_code": 400
+        }
+
+
+# DELETE /api/cupcakes/[cupcake-id]
+@app.route("/api/cupcakes/<cupcake_id>", methods=["DELETE"])
+async def delete_cupcake_api(cupcake_id):
+    """ Delete the single cupcake identified by cupcake_id. Same responses as
+        delete_cupcake_api in app.py.
+    """
+
+    # only use cupcake_id for a db lookup when we know it is an integer
+    if (not cupcake_id.isnumeric()):
+        response_data = {
+            "error": {"message": f"Cupcake id='{cupcake_id}' was not an integer. No delete occurred. "}
+        }
+        return json_response(response_data, 404)
+
+    async with get_session() as session:
+        del_cupcake = await session.get(Cupcake, int(cupcake_id))
+
+        if (del_cupcake is None):
+            response_data = {
+                "error": {"message": f"Cupcake id={cupcake_id} was not found. No delete occurred. "}
+            }
+            return json_response(response_data, 404)
+
+        msg_historical = del_cupcake.serialize()
+
+        try:
+            await session.delete(del_cupcake)
+            await session.flush()
+            await session.run_sync(record_write, cupcake_stats_deltas(removed=[msg_historical]),
+                                   "delete", [msg_historical])
+            await session.commit()
+            cupcake_cache.invalidate(msg_historical["id"])
+            suggest_index.apply(removed=[msg_historical])
+
+            return json_response({"message": {"deleted": msg_historical}}, 200)
+
+        except:
+            await session.rollback()
+
+            response_data = {
+                "error": {"message": f"An error occurred while deleting {str(msg_historical)}. No delete occurred. "}
+            }
+            return json_response(response_data, 400)
@@ -0,0 +1,108 @@
+"""Concurrency benchmark: sync Flask app (app.py) vs async Quart app (async_app.py).
+
+Start both servers against the same seeded database, for example
+
+    gunicorn --workers 4 --threads 8 --bind 127.0.0.1:5000 app:app
+    hypercorn --workers 4 --bind 127.0.0.1:5001 async_app:app
+
+then run
+
+    python benchmarks/bench_async.py --sync http://127.0.0.1:5000 --async http://127.0.0.1:5001
+
+For each number of in-flight requests, the same mix of GET /api/cupcakes?limit=20 and
+GET /api/cupcakes/<id> requests is sent to each server. Requests per second and
+p50 / p99 latency are printed as JSON, one object per server and concurrency.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def http_get(host, port, path):
+    """ Sends GET path over a new connection and returns the status code. """
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(
+        f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+
+    response = await reader.read()
+    writer.close()
+
+    return int(response.split(b" ", 2)[1])
+
+
+async def run_level(base_url, paths, concurrency, total):
+    """ Sends total requests from paths with concurrency requests in flight. Returns the
+        results for one server and concurrency level.
+    """
+
+    url = urlsplit(base_url)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one_request(path):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                status = await http_get(url.hostname, url.port or 80, path)
+                if (status >= 400):
+                    errors += 1
+            except OSError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one_request(random.choice(paths)) for i in range(total)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "server": base_url,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2)
+    }
+
+
+async def main(args):
+    ids = list(range(1, args.ids + 1))
+    paths = ["/api/cupcakes?limit=20"] + [f"/api/cupcakes/{cupcake_id}" for cupcake_id in ids]
+
+    results = []
+    for concurrency in args.concurrency:
+        for base_url in (args.sync, args.async_url):
+            total = max(args.requests, concurrency * 4)
+            results.append(await run_level(base_url, paths, concurrency, total))
+            print(json.dumps(results[-1]), flush=True)
+
+    if (args.output):
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sync", default="http://127.0.0.1:5000",
+                        help="base url of the app.py server")
+    parser.add_argument("--async", dest="async_url", default="http://127.0.0.1:5001",
+                        help="base url of the async_app.py server")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 200, 500],
+                        help="numbers of requests in flight")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="requests per server and concurrency level")
+    parser.add_argument("--ids", type=int, default=3,
+                        help="GET /api/cupcakes/<id> uses ids 1 to IDS")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+
+    asyncio.run(main(parser.parse_args()))
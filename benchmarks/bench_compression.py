@@ -0,0 +1,93 @@
+"""Bytes on the wire with and without response compression.
+
+    python benchmarks/bench_compression.py --rows 1000
+
+Loads --rows cupcakes into an in-memory SQLite database, builds the hashed static assets
+(assets.py) into a temporary directory and requests API pages, the NDJSON export and the
+static files with Accept-Encoding identity, gzip and br (when the brotli package is
+installed). The response body size of each, and the percentage saved compared to
+identity, is printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+# an in-memory database so the benchmark needs no server. Set before app is imported.
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ.setdefault("SQLALCHEMY_ECHO", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import app  # noqa: E402
+from assets import build_assets  # noqa: E402
+from compression import ENCODINGS  # noqa: E402
+from models import db, db_rebuild_cupcake_stats  # noqa: E402
+from seed import insert_rows, load_rows, generate_cupcakes  # noqa: E402
+
+# name -> (before url, after url or None for the same url). Static files are compared
+#  as /static/ (before) and the hashed /assets/ file (after).
+API_URLS = {
+    "list_20": "/api/cupcakes?limit=20",
+    "list_100": "/api/cupcakes?limit=100",
+    "list_1000": "/api/cupcakes?limit=1000",
+    "detail": "/api/cupcakes/1",
+    "stats": "/api/cupcakes/stats",
+    "export": "/api/cupcakes/export",
+}
+STATIC_FILES = ("cupcakes.js", "base.css", "images/cupcake.jpg")
+
+
+def body_size(client, url, encoding):
+    response = client.get(url, headers={"Accept-Encoding": encoding})
+    if (response.status_code != 200):
+        raise RuntimeError(f"GET {url} returned {response.status_code}.")
+    return len(response.get_data())
+
+
+def measure(client, before_url, after_url):
+    """ Returns {identity, gzip, br, ..., saved_percent} for one resource. """
+
+    sizes = {"identity": body_size(client, before_url, "identity")}
+    for encoding in ENCODINGS:
+        sizes[encoding] = body_size(client, after_url, encoding)
+
+    smallest = min(sizes[encoding] for encoding in ENCODINGS)
+    sizes["saved_percent"] = round(100 * (1 - smallest / sizes["identity"]), 1)
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app.config["ASSETS_DIR"] = directory
+        manifest = build_assets(app.static_folder, directory)
+
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            insert_rows(load_rows(generate_cupcakes(args.rows), "generated"), 10000)
+            db_rebuild_cupcake_stats()
+
+            results = {"rows": args.rows, "encodings": list(ENCODINGS),
+                       "min_size": app.config["COMPRESSION_MIN_SIZE"], "bytes": {}}
+            with app.test_client() as client:
+                for name, url in API_URLS.items():
+                    results["bytes"][name] = measure(client, url, url)
+                for name in STATIC_FILES:
+                    results["bytes"][name] = measure(
+                        client, f"/static/{name}", f"/assets/{manifest[name]}")
+
+    print(json.dumps(results, indent=2))
+    if (args.output):
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if (__name__ == "__main__"):
+    main()
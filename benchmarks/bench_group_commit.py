@@ -0,0 +1,102 @@
+"""Create throughput with and without group commit (group_commit.py).
+
+    python benchmarks/bench_group_commit.py --clients 32 --creates 50 --windows 0,1,2,5,10
+
+Each of --clients threads creates --creates cupcakes through models.db_add_cupcake, as
+POST /api/cupcakes does. Window 0 is the default mode, one commit per cupcake; the other
+windows (milliseconds) go through a GroupCommitWriter with --max-rows. Creates per second,
+p50 / p99 latency of a create and the mean batch size are printed as JSON per window.
+
+The database is a SQLite file in a temporary directory, so every commit is synced to disk;
+pass --database-url to measure PostgreSQL, whose cupcakes tables are recreated.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+directory = tempfile.TemporaryDirectory()
+
+if (__name__ == "__main__"):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--creates", type=int, default=50, help="creates per client")
+    parser.add_argument("--windows", default="0,1,2,5,10", help="comma separated milliseconds")
+    parser.add_argument("--max-rows", type=int, default=100)
+    parser.add_argument("--database-url",
+                        default=f"sqlite:///{os.path.join(directory.name, 'bench.db')}")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    # set before app is imported.
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ.setdefault("SQLALCHEMY_ECHO", "0")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import app  # noqa: E402
+from group_commit import GroupCommitWriter  # noqa: E402
+from models import db, db_add_cupcake, db_add_validated_cupcakes  # noqa: E402
+
+
+def run_window(window_ms, clients, creates, max_rows):
+    """ Returns the results of clients threads making creates cupcakes each. """
+
+    writer = None
+    if (window_ms):
+        writer = GroupCommitWriter(db_add_validated_cupcakes, app, window_ms / 1000, max_rows)
+
+    latencies = []
+    errors = []
+
+    def client(number):
+        with app.app_context():
+            for index in range(creates):
+                start = time.perf_counter()
+                results = db_add_cupcake({"flavor": f"flavor {number}", "size": "small",
+                                          "rating": index % 10}, writer)
+                latencies.append(time.perf_counter() - start)
+                if (not results["successful"]):
+                    errors.append(results["message"])
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    results = {"window_ms": window_ms,
+               "creates_per_second": round(len(latencies) / seconds, 1),
+               "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+               "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+               "errors": len(errors)}
+    if (writer):
+        results["mean_batch"] = round(writer.stats["rows"] / writer.stats["batches"], 1)
+    return results
+
+
+def main():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+    results = {"clients": args.clients, "creates": args.clients * args.creates,
+               "database": db.get_engine(app).dialect.name, "windows": []}
+    for window_ms in [int(window) for window in args.windows.split(",")]:
+        results["windows"].append(run_window(window_ms, args.clients, args.creates, args.max_rows))
+
+    print(json.dumps(results, indent=2))
+    if (args.output):
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,94 @@
+"""Serialization micro-benchmark: per-row cost of building a cupcake list response.
+
+    python benchmarks/bench_serialize.py --rows 1000 --repeat 20
+
+Loads --rows cupcakes into an in-memory SQLite database and times two ways of turning
+them into a JSON response body:
+
+  orm   Cupcake instances, Cupcake.serialize() and json.dumps with the Flask jsonify
+        defaults (sorted keys, indented when JSONIFY_PRETTYPRINT_REGULAR is on).
+  rows  SQL row tuples, serializers.rows_to_dicts and serializers.dumps (orjson when it
+        is installed).
+
+The best time of --repeat runs is reported as microseconds per row, as JSON.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# an in-memory database so the benchmark needs no server. Set before app is imported.
+os.environ["DATABASE_URL"] = "sqlite://"
+os.environ.setdefault("SQLALCHEMY_ECHO", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app import app  # noqa: E402
+from models import db, Cupcake, CUPCAKE_COLUMNS  # noqa: E402
+from serializers import ENCODER, dumps, rows_to_dicts  # noqa: E402
+
+
+def seed(rows):
+    """ Replaces the cupcakes table with rows synthetic cupcakes. """
+
+    db.drop_all()
+    db.create_all()
+    db.session.bulk_insert_mappings(Cupcake, [
+        {"flavor": f"flavor {i % 50}", "size": ("small", "medium", "large")[i % 3],
+         "rating": float(i % 10), "image": f"https://example.com/cupcakes/{i}.jpg"}
+        for i in range(rows)])
+    db.session.commit()
+
+
+def orm_body(pretty):
+    db.session.expunge_all()
+    cupcakes = [cupcake.serialize() for cupcake in Cupcake.query.order_by(Cupcake.id)]
+    if (pretty):
+        return json.dumps({"cupcakes": cupcakes}, indent=2, separators=(", ", ": "),
+                          sort_keys=True)
+    return json.dumps({"cupcakes": cupcakes}, sort_keys=True)
+
+
+def rows_body():
+    columns = [getattr(Cupcake, column) for column in CUPCAKE_COLUMNS]
+    rows = db.session.execute(db.select(columns).order_by(Cupcake.id)).all()
+    return dumps({"cupcakes": rows_to_dicts(rows, CUPCAKE_COLUMNS)})
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.rows)
+
+        results = {"rows": args.rows, "encoder": ENCODER, "us_per_row": {}}
+        for name, function in (("orm", lambda: orm_body(False)),
+                               ("orm_pretty", lambda: orm_body(True)),
+                               ("rows", rows_body)):
+            seconds = best_time(function, args.repeat)
+            results["us_per_row"][name] = round(seconds / args.rows * 1e6, 3)
+
+        results["speedup"] = round(results["us_per_row"]["orm"] / results["us_per_row"]["rows"], 2)
+
+    print(json.dumps(results, indent=2))
+    if (args.output):
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,96 @@
+"""Typeahead micro-benchmark: suggest.PrefixIndex at a million distinct values.
+
+    python benchmarks/bench_suggest.py --values 1000000 --queries 2000
+
+Builds a PrefixIndex of --values distinct synthetic flavors with skewed counts, then times:
+
+  suggest      prefixes of 1 to 4 characters taken from the values, after each prefix was
+               asked once (the top values of short prefixes are cached).
+  suggest_cold the first request for each prefix, including ranking a large slice.
+  adjust       a write changing the count of an existing value.
+  add_remove   a write adding a new value and the delete removing it again.
+  scan         a linear scan of every value, roughly what a LIKE 'q%' without an index costs.
+
+Latencies are reported as median / 99th percentile microseconds, as JSON.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from suggest import PrefixIndex  # noqa: E402
+
+SYLLABLES = ("ba", "ber", "cho", "co", "la", "le", "man", "mon", "na", "nut", "pe",
+             "ra", "rasp", "red", "sal", "te", "ted", "va", "vel", "wal", "zest")
+
+
+def generate_values(count, seed=1):
+    """ Returns {value: count} for count distinct flavor like values with skewed counts. """
+
+    rng = random.Random(seed)
+    values = {}
+    while (len(values) < count):
+        words = [("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))).title()
+                 for _ in range(rng.randint(1, 3))]
+        values[" ".join(words)] = int(rng.paretovariate(1.2))
+    return values
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {"p50_us": round(samples[len(samples) // 2] * 1e6, 2),
+            "p99_us": round(samples[int(len(samples) * 0.99)] * 1e6, 2)}
+
+
+def timed(function, arguments):
+    samples = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--values", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    counts = generate_values(args.values)
+    start = time.perf_counter()
+    index = PrefixIndex(counts)
+    results = {"values": len(index), "build_seconds": round(time.perf_counter() - start, 2)}
+
+    rng = random.Random(2)
+    names = list(counts)
+    prefixes = [name[:rng.randint(1, 4)].lower() for name in rng.sample(names, args.queries)]
+
+    results["suggest_cold"] = timed(lambda prefix: index.suggest(prefix, args.limit), prefixes)
+    results["suggest"] = timed(lambda prefix: index.suggest(prefix, args.limit), prefixes)
+    results["adjust"] = timed(lambda name: index.adjust(name, 1), rng.sample(names, args.queries))
+    results["add_remove"] = timed(
+        lambda number: (index.adjust(f"New Flavor {number}", 1), index.adjust(f"New Flavor {number}", -1)),
+        range(args.queries))
+
+    def scan(prefix):
+        return sorted((name for name in names if name.lower().startswith(prefix)),
+                      key=counts.get, reverse=True)[:args.limit]
+
+    results["scan"] = timed(scan, prefixes[:20])
+
+    print(json.dumps(results, indent=2))
+    if (args.output):
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if (__name__ == "__main__"):
+    main()
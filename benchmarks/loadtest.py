@@ -0,0 +1,380 @@
+"""Load test for the /api/cupcakes routes.
+
+Seeds a throwaway database with synthetic cupcakes (seed.generate_cupcakes), serves app.py
+from a local threaded server and sends a weighted mix of read and write requests from
+--concurrency client threads for --duration seconds. Latency percentiles and requests per
+second are printed as JSON for each operation and overall.
+
+    python benchmarks/loadtest.py --cupcakes 100000 --concurrency 16 --duration 30 --output run.json
+    python benchmarks/loadtest.py --cupcakes 100000 --compare run.json
+
+--database-url defaults to a temporary SQLite file. A PostgreSQL url works as well, for
+example postgresql:///cupcakes_bench, but its tables are DROPPED and reseeded, so only
+point it at a database used for benchmarks. --url sends the requests to a server that is
+already running (and seeded with seed.py) instead.
+
+Before the load starts, the time to first content of the home page is sampled
+--ttfc-samples times: the time from requesting / until the markup of the first cupcake
+arrives. For a page without server rendered cupcakes the first GET /api/cupcakes page the
+script would request is added.
+
+--compare reads an earlier --output file and exits with status 1 when an operation's p95
+latency (or the p95 time to first content) grew, or its requests per second dropped, by
+more than --tolerance (default 10%).
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# operation name -> weight. Every /api/cupcakes route is covered.
+DEFAULT_MIX = {
+    "home": 2, "list": 25, "list_filtered": 15, "detail": 30, "stats": 5, "export": 1,
+    "create": 8, "update": 8, "delete": 4,
+    "bulk_create": 1, "bulk_update": 1, "bulk_delete": 1
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+class Workload:
+    """ Builds the requests for each operation. Cupcakes created by the load test are the
+        ones deleted, so the catalog keeps about the same size.
+    """
+
+    def __init__(self, ids, seed=0):
+        self.ids = list(ids)
+        self.created = []
+        self.lock = threading.Lock()
+        self.rand = random.Random(seed)
+        self.specs = None
+
+    def spec(self):
+        from seed import generate_cupcakes
+
+        with self.lock:
+            if (self.specs is None):
+                self.specs = generate_cupcakes(10 ** 9, self.rand.random())
+            return next(self.specs)
+
+    def some_id(self):
+        with self.lock:
+            return self.rand.choice(self.ids + self.created)
+
+    def take_created(self, count=1):
+        with self.lock:
+            taken, self.created = self.created[:count], self.created[count:]
+            return taken
+
+    def add_created(self, ids):
+        with self.lock:
+            self.created.extend(ids)
+
+    def request(self, operation):
+        """ Returns (method, path, body or None, on_response callback or None). """
+
+        from seed import FLAVORS, SIZES
+
+        if (operation == "home"):
+            return ("GET", "/", None, None)
+
+        if (operation == "list"):
+            return ("GET", f"/api/cupcakes?limit={self.rand.choice((20, 100))}", None, None)
+
+        if (operation == "list_filtered"):
+            query = self.rand.choice((
+                {"flavor": self.rand.choice(FLAVORS), "limit": 20},
+                {"flavor_prefix": self.rand.choice(FLAVORS)[:3], "sort": "-rating", "limit": 20},
+                {"size": self.rand.choice(SIZES), "rating_min": 8, "limit": 20}))
+            return ("GET", f"/api/cupcakes?{urlencode(query)}", None, None)
+
+        if (operation == "detail"):
+            return ("GET", f"/api/cupcakes/{self.some_id()}", None, None)
+
+        if (operation == "stats"):
+            return ("GET", "/api/cupcakes/stats", None, None)
+
+        if (operation == "export"):
+            return ("GET", "/api/cupcakes/export?fields=flavor", None, None)
+
+        if (operation == "create"):
+            return ("POST", "/api/cupcakes", self.spec(),
+                    lambda body: self.add_created([body["cupcake"]["id"]]))
+
+        if (operation == "update"):
+            return ("PATCH", f"/api/cupcakes/{self.some_id()}", self.spec(), None)
+
+        if (operation == "delete"):
+            taken = self.take_created()
+            if (not taken):
+                return self.request("create")
+            return ("DELETE", f"/api/cupcakes/{taken[0]}", None, None)
+
+        if (operation == "bulk_create"):
+            return ("POST", "/api/cupcakes/bulk", [self.spec() for _ in range(20)],
+                    lambda body: self.add_created([item["id"] for item in body["cupcakes"]]))
+
+        if (operation == "bulk_update"):
+            return ("PATCH", "/api/cupcakes/bulk",
+                    [{"id": self.some_id(), **self.spec()} for _ in range(20)], None)
+
+        if (operation == "bulk_delete"):
+            taken = self.take_created(20)
+            if (not taken):
+                return self.request("bulk_create")
+            return ("DELETE", "/api/cupcakes/bulk", taken, None)
+
+        raise ValueError(f"Unknown operation '{operation}'.")
+
+
+def run_client(base_url, workload, mix, deadline, results, seed):
+    """ Sends requests until deadline, appending (operation, seconds, ok) to results. """
+
+    url = urlsplit(base_url)
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    rand = random.Random(seed)
+    operations, weights = zip(*mix.items())
+    local = []
+
+    while (time.perf_counter() < deadline):
+        operation = rand.choices(operations, weights)[0]
+        method, path, body, on_response = workload.request(operation)
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = connection.getresponse()
+            data = response.read()
+            ok = response.status < 400
+            if (ok and on_response):
+                on_response(json.loads(data))
+        except (OSError, http.client.HTTPException):
+            ok = False
+            connection.close()
+        local.append((operation, time.perf_counter() - start, ok))
+
+    connection.close()
+    results.extend(local)
+
+
+# markup of a rendered cupcake in the home page.
+FIRST_CONTENT_MARKER = b'class="cupcake"'
+
+
+def time_to_first_content(base_url, samples):
+    """ Returns the time to first content of the home page in seconds, once per sample. """
+
+    url = urlsplit(base_url)
+    times = []
+    for _ in range(samples):
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+
+        start = time.perf_counter()
+        connection.request("GET", "/")
+        response = connection.getresponse()
+        received = b""
+        found = False
+        while (not found):
+            chunk = response.read1(4096)
+            if (not chunk):
+                break
+            received += chunk
+            found = FIRST_CONTENT_MARKER in received
+        response.read()
+
+        if (not found):
+            # rendered by the script: the first page of the API.
+            connection.request("GET", "/api/cupcakes")
+            connection.getresponse().read()
+        times.append(time.perf_counter() - start)
+
+        connection.close()
+
+    return times
+
+
+def percentile(sorted_values, percent):
+    """ Returns the nearest-rank percentile of sorted_values. """
+
+    if (not sorted_values):
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples, duration):
+    """ Returns {requests, errors, rps, p50_ms, p95_ms, p99_ms} for (seconds, ok) samples. """
+
+    latencies = sorted(seconds for seconds, ok in samples)
+    summary = {
+        "requests": len(samples),
+        "errors": sum(1 for seconds, ok in samples if not ok),
+        "rps": round(len(samples) / duration, 1)
+    }
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        summary[f"p{percent}_ms"] = round(value * 1000, 2) if value is not None else None
+
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    """ Returns a list of regression messages for results against the baseline results. """
+
+    regressions = []
+    current_ttfc, previous_ttfc = results.get("ttfc"), baseline.get("ttfc")
+    if (current_ttfc and previous_ttfc and current_ttfc["p95_ms"] and previous_ttfc["p95_ms"]):
+        if (current_ttfc["p95_ms"] > previous_ttfc["p95_ms"] * (1 + tolerance)):
+            regressions.append(
+                f"ttfc: p95 {previous_ttfc['p95_ms']}ms -> {current_ttfc['p95_ms']}ms")
+
+    for operation, current in results["operations"].items():
+        previous = baseline["operations"].get(operation)
+        if (not previous or not previous["requests"] or not current["requests"]):
+            continue
+
+        if (current["p95_ms"] > previous["p95_ms"] * (1 + tolerance)):
+            regressions.append(
+                f"{operation}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if (current["rps"] < previous["rps"] * (1 - tolerance)):
+            regressions.append(
+                f"{operation}: rps {previous['rps']} -> {current['rps']}")
+
+    return regressions
+
+
+def parse_mix(text):
+    """ Returns the mix for "list=50,detail=50" style text, DEFAULT_MIX when text is empty. """
+
+    if (not text):
+        return dict(DEFAULT_MIX)
+
+    mix = {}
+    for item in text.split(","):
+        operation, weight = item.split("=")
+        if (operation not in DEFAULT_MIX):
+            raise ValueError(f"Unknown operation '{operation}'. Use {', '.join(DEFAULT_MIX)}.")
+        mix[operation] = float(weight)
+    return mix
+
+
+def start_local_server(database_url, cupcakes):
+    """ Seeds database_url with cupcakes synthetic cupcakes and serves app.py on a free
+        local port from a background thread. Returns (base_url, cupcake ids, dialect).
+    """
+
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["SQLALCHEMY_ECHO"] = "0"
+
+    from werkzeug.serving import make_server
+    from app import app
+    from models import db, Cupcake
+    from seed import seed_synthetic
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_synthetic(cupcakes)
+        ids = [cupcake_id for (cupcake_id,) in db.session.query(Cupcake.id)]
+        dialect = db.engine.dialect.name
+        db.session.remove()
+
+    # no access log line per request.
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return (f"http://127.0.0.1:{server.server_port}", ids, dialect)
+
+
+def remote_ids(base_url):
+    """ Returns up to 1000 cupcake ids from a running server. """
+
+    url = urlsplit(base_url)
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    connection.request("GET", "/api/cupcakes?fields=id&limit=1000")
+    body = json.loads(connection.getresponse().read())
+    connection.close()
+
+    return [cupcake["id"] for cupcake in body["cupcakes"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cupcakes", type=int, default=10000, help="synthetic cupcakes to seed")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--mix", help="operation=weight list, for example list=50,detail=50")
+    parser.add_argument("--database-url", help="throwaway database to seed (default temporary SQLite)")
+    parser.add_argument("--url", help="use this running server instead of a local one")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--compare", help="results JSON of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    parser.add_argument("--ttfc-samples", type=int, default=20,
+                        help="home page time to first content samples (0 to skip)")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+
+    if (args.url):
+        base_url, ids, dialect = args.url, remote_ids(args.url), "remote"
+    else:
+        database_url = args.database_url or "sqlite:///" + os.path.join(
+            tempfile.mkdtemp(prefix="cupcakes-loadtest-"), "cupcakes.db")
+        base_url, ids, dialect = start_local_server(database_url, args.cupcakes)
+
+    ttfc = sorted(time_to_first_content(base_url, args.ttfc_samples))
+
+    workload = Workload(ids)
+    samples = []
+    threads = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    for number in range(args.concurrency):
+        thread = threading.Thread(target=run_client,
+                                  args=(base_url, workload, mix, deadline, samples, number))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    results = {
+        "url": base_url, "database": dialect, "cupcakes": len(ids),
+        "concurrency": args.concurrency, "duration_s": round(duration, 2), "mix": mix,
+        "ttfc": {"samples": len(ttfc),
+                 **{f"p{percent}_ms": round(percentile(ttfc, percent) * 1000, 2) if ttfc else None
+                    for percent in PERCENTILES}},
+        "overall": summarize([(seconds, ok) for operation, seconds, ok in samples], duration),
+        "operations": {operation: summarize([(seconds, ok) for name, seconds, ok in samples
+                                             if name == operation], duration)
+                       for operation in mix}
+    }
+
+    print(json.dumps(results, indent=2))
+    if (args.output):
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+    if (args.compare):
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if (regressions):
+            sys.exit(1)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,277 @@
+"""Read-through cache for serialized cupcakes."""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ In-process least recently used cache where entries expire ttl seconds after they
+        were added.
+
+        Counters for hits, misses, evictions (removed to stay within max_size) and
+        expirations (removed because the ttl passed) are kept in stats.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key):
+        """ Returns (True, value) when key is cached and not expired, otherwise (False, None). """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None):
+                self.stats["misses"] += 1
+                return (False, None)
+
+            expires, value = entry
+            if (expires <= self.clock()):
+                del self.entries[key]
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return (False, None)
+
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return (True, value)
+
+    def set(self, key, value):
+        """ Cache value for key, evicting the least recently used entries when full. """
+
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while (len(self.entries) > self.max_size):
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def delete(self, *keys):
+        """ Remove keys from the cache. Keys that are not cached are ignored. """
+
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        """ Remove every entry. Counters are not reset. """
+
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class InMemorySharedBackend:
+    """ Stand-in for a shared cache server such as Redis. Supports the subset of the
+        redis-py client used by ReadThroughCache: get(key), mget(keys), set(key, value,
+        ex=seconds), incr(key), expire(key, seconds) and delete(*keys). Values are
+        strings, like they would be on a real server.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None):
+                return None
+
+            expires, value = entry
+            if (expires is not None and expires <= self.clock()):
+                del self.entries[key]
+                return None
+
+            return value
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.entries[key] = (
+                self.clock() + ex if ex else None, value)
+        return True
+
+    def incr(self, key):
+        with self.lock:
+            expires, value = self.entries.get(key, (None, "0"))
+            if (expires is not None and expires <= self.clock()):
+                expires, value = (None, "0")
+            value = str(int(value) + 1)
+            self.entries[key] = (expires, value)
+            return int(value)
+
+    def expire(self, key, seconds):
+        with self.lock:
+            if (key not in self.entries):
+                return False
+            self.entries[key] = (self.clock() + seconds, self.entries[key][1])
+            return True
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(1 for key in keys if self.entries.pop(key, None) is not None)
+
+
+class ReadThroughCache:
+    """ Read-through cache of JSON serializable values, for example serialized cupcakes.
+
+        Lookups check the in-process LRU first, then the optional shared backend (any
+        object with redis style get / mget / set / incr / expire / delete), and finally
+        call the loader. Loader results of None (not found) are not cached.
+
+        Writers call invalidate with the keys they changed. A value loaded while an
+        invalidation happened is returned but not cached, so a reader that raced a
+        writer cannot put an old value back into the cache.
+
+        With a shared backend, invalidate also increments a generation counter per key
+        there, and every cached value, local or shared, is kept with the generation it
+        was loaded under. A hit only counts when that is still the key's generation, so
+        a write in one worker process is seen by the local caches of all the others (and
+        a value a slow reader stores after a write is ignored). This costs one small GET
+        per local hit; the local tier still saves the value transfer and JSON decode.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, shared=None, prefix="cupcake:"):
+        self.prefix = prefix
+        self.invalidations = 0
+        self.stats = {"shared_hits": 0, "shared_misses": 0, "stale_hits": 0, "loads": 0}
+        self.configure(max_size, ttl, shared)
+
+    def configure(self, max_size=1024, ttl=60, shared=None):
+        """ Replace the local cache and shared backend. Cached values are dropped. """
+
+        self.local = LRUCache(max_size, ttl)
+        self.shared = shared
+
+    def shared_key(self, key):
+        return f"{self.prefix}{key}"
+
+    def generation_key(self, key):
+        return f"{self.prefix}{key}:generation"
+
+    def get_or_load(self, key, loader):
+        """ Returns the cached value for key or the value from loader(), caching it. """
+
+        found, value = self.lookup(key)
+        if (found):
+            return value
+
+        snapshot = self.snapshot(key)
+        value = loader()
+        self.store(key, value, snapshot)
+
+        return value
+
+    async def get_or_load_async(self, key, loader):
+        """ get_or_load for an async loader: returns the cached value for key or the value
+            from await loader(), caching it.
+        """
+
+        found, value = self.lookup(key)
+        if (found):
+            return value
+
+        snapshot = self.snapshot(key)
+        value = await loader()
+        self.store(key, value, snapshot)
+
+        return value
+
+    def lookup(self, key):
+        """ Returns (True, value) from the local cache or shared backend, otherwise (False, None). """
+
+        found, entry = self.local.get(key)
+        if (found):
+            if (self.shared is None or
+                    entry[0] == int(self.shared.get(self.generation_key(key)) or 0)):
+                return (True, entry[1])
+            # another process changed key since this value was cached.
+            self.stats["stale_hits"] += 1
+            self.local.delete(key)
+
+        if (self.shared is not None):
+            shared_value, generation = self.shared.mget(
+                [self.shared_key(key), self.generation_key(key)])
+            generation = int(generation or 0)
+
+            if (shared_value is not None):
+                shared_entry = json.loads(shared_value)
+                if (shared_entry["generation"] == generation):
+                    self.stats["shared_hits"] += 1
+                    self.local.set(key, (generation, shared_entry["value"]))
+                    return (True, shared_entry["value"])
+
+            self.stats["shared_misses"] += 1
+
+        return (False, None)
+
+    def snapshot(self, *keys):
+        """ Returns what store needs to tell whether keys changed while their values were
+            loaded: the local invalidation count and the shared generation of each key.
+            Take it before the load starts.
+        """
+
+        generations = {}
+        if (self.shared is not None and keys):
+            values = self.shared.mget([self.generation_key(key) for key in keys])
+            generations = {key: int(value or 0) for key, value in zip(keys, values)}
+
+        return (self.invalidations, generations)
+
+    def store(self, key, value, snapshot):
+        """ Cache a loaded value unless it is None or this process invalidated a key since
+            snapshot was taken (before the load started). The value is cached under the
+            generation in snapshot, so one that another process invalidated meanwhile is
+            never a hit.
+        """
+
+        self.stats["loads"] += 1
+
+        invalidations, generations = snapshot
+        if (value is not None and invalidations == self.invalidations):
+            generation = generations.get(key, 0)
+            self.local.set(key, (generation, value))
+            if (self.shared is not None):
+                self.shared.set(self.shared_key(key),
+                                json.dumps({"generation": generation, "value": value}),
+                                ex=self.local.ttl)
+
+    def invalidate(self, *keys):
+        """ Remove keys from the local cache and the shared backend, and move them to a new
+            generation so the local caches of other processes drop them too.
+        """
+
+        if (len(keys) == 0):
+            return
+
+        self.invalidations += 1
+        self.local.delete(*keys)
+        if (self.shared is not None):
+            for key in keys:
+                self.shared.incr(self.generation_key(key))
+                # a cached value is at most ttl old, so an older generation is not needed.
+                self.shared.expire(self.generation_key(key), 2 * self.local.ttl)
+            self.shared.delete(*[self.shared_key(key) for key in keys])
+
+    def clear(self):
+        """ Remove every value from the local cache. The shared backend is not cleared. """
+
+        self.invalidations += 1
+        self.local.clear()
+
+    def get_stats(self):
+        """ Returns hit / miss / eviction counters for the local cache and shared backend. """
+
+        return {**self.local.stats, **self.stats, "size": len(self.local), "max_size": self.local.max_size}
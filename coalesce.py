@@ -0,0 +1,124 @@
+"""Single-flight coalescing of identical concurrent reads.
+
+When many clients ask for the same popular cupcake or list page at once, the first request
+(the leader) runs the query and encodes the response while the others (followers) wait for
+it and share its result, so the database sees one query instead of hundreds.
+
+    SingleFlight        threaded and gevent workers (app.py)
+    AsyncSingleFlight   asyncio workers (async_app.py)
+
+A call is only shared while it runs; nothing is cached afterwards. Keys should change
+when the data can, for example with ReadThroughCache.invalidations, so a request that
+arrives after a write never joins a read that started before it.
+"""
+
+import asyncio
+import functools
+import threading
+
+from flask import current_app, make_response, request
+
+
+class Call:
+    """ One in-flight call and its outcome. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Runs function once per key at a time for threads; callers arriving while it runs
+        wait and get the same value, or the same exception.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {"leaders": 0, "followers": 0}
+
+    def do(self, key, function):
+        """ Returns function(), shared with every caller of the same key while it runs. """
+
+        with self.lock:
+            call = self.calls.get(key)
+            if (call is None):
+                call = self.calls[key] = Call()
+                self.stats["leaders"] += 1
+                leader = True
+            else:
+                self.stats["followers"] += 1
+                leader = False
+
+        if (not leader):
+            call.done.wait()
+            if (call.error is not None):
+                raise call.error
+            return call.value
+
+        try:
+            call.value = function()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """ SingleFlight for coroutines. The call runs as its own task, so a caller that is
+        cancelled (a client that went away) does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.stats = {"leaders": 0, "followers": 0}
+
+    async def do(self, key, function):
+        """ Returns await function(), shared with every caller of the same key while it runs. """
+
+        task = self.calls.get(key)
+        if (task is None):
+            task = self.calls[key] = asyncio.ensure_future(function())
+            task.add_done_callback(lambda done: self.calls.pop(key, None))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["followers"] += 1
+
+        return await asyncio.shield(task)
+
+
+def freeze_response(response):
+    """ Returns (body, status, headers) of a Flask response, for responses to other requests. """
+
+    return (response.get_data(), response.status_code, list(response.headers.items()))
+
+
+def coalesce(flight, key):
+    """ Decorator for Flask views: concurrent requests with the same key() share one run of
+        the view and its encoded body. key() returns None for requests that run on their
+        own. Each request gets its own copy of the response, so after_request hooks still
+        apply per request, and is answered with a 304 when its conditional headers match.
+    """
+
+    def decorator(view):
+
+        @functools.wraps(view)
+        def coalesced_view(*args, **kwargs):
+            request_key = key()
+            if (request_key is None):
+                response = make_response(view(*args, **kwargs))
+            else:
+                body, status, headers = flight.do(
+                    request_key, lambda: freeze_response(make_response(view(*args, **kwargs))))
+                response = current_app.response_class(body, status=status, headers=headers)
+
+            return response.make_conditional(request.environ)
+
+        return coalesced_view
+
+    return decorator
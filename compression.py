@@ -0,0 +1,132 @@
+"""gzip / brotli compression of Cupcakes responses.
+
+init_compression(app) adds an after_request hook that compresses JSON, NDJSON and text
+responses of at least COMPRESSION_MIN_SIZE bytes with the best encoding the client lists
+in Accept-Encoding: br when the brotli package is installed (pip install brotli), else
+gzip. Streamed responses (NDJSON export) are compressed chunk by chunk, each chunk flushed
+so the client can decode it as it arrives. Responses that already have a Content-Encoding,
+such as the precompressed assets of assets.py, are left alone.
+
+The ETag of a compressed response is made weak, as its bytes differ from the identity
+response the ETag was computed for. If-None-Match still matches it.
+"""
+
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/javascript",
+                      "image/svg+xml")
+
+# encodings this process can write, in order of preference.
+ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+# file suffix of the precompressed variant for each encoding.
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def compressible(mimetype):
+    """ Returns True for mimetypes worth compressing (text, JSON, JavaScript, SVG). Event
+        streams are not: a compressor holds back each event until it has enough data.
+    """
+
+    if (mimetype == "text/event-stream"):
+        return False
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+def choose_encoding(accept_encodings, available=ENCODINGS):
+    """ Returns the encoding in available the client accepts, from the parsed
+        Accept-Encoding header (werkzeug Accept), or None for identity.
+    """
+
+    best = None
+    best_quality = 0
+    for encoding in available:
+        quality = accept_encodings[encoding]
+        if (quality > best_quality):
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding, level=6, brotli_quality=5):
+    """ Returns data compressed with encoding ("gzip" or "br"). """
+
+    if (encoding == "br"):
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_chunks(chunks, encoding, level=6, brotli_quality=5):
+    """ Generator compressing the byte chunks of a streamed response as they come. Each
+        chunk is flushed, so everything received so far decompresses; without the flush
+        the compressor holds data back until its buffer fills and the stream stalls.
+    """
+
+    if (encoding == "br"):
+        compressor = brotli.Compressor(quality=brotli_quality)
+        finish = compressor.finish
+
+        def write(chunk):
+            return compressor.process(chunk) + compressor.flush()
+    else:
+        # wbits 31 writes a gzip header and trailer.
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        finish = compressor.flush
+
+        def write(chunk):
+            return compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    for chunk in chunks:
+        if (isinstance(chunk, str)):
+            chunk = chunk.encode("utf-8")
+        data = write(chunk)
+        if (data):
+            yield data
+    yield finish()
+
+
+def init_compression(app):
+    """ Adds the response compression hook to app. COMPRESSION_ENABLED turns it off. """
+
+    @app.after_request
+    def compress_response(response):
+        if (not app.config.get("COMPRESSION_ENABLED", True)):
+            return response
+        if (not compressible(response.mimetype)):
+            return response
+
+        response.vary.add("Accept-Encoding")
+
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough or "Content-Encoding" in response.headers):
+            return response
+
+        encoding = choose_encoding(request.accept_encodings)
+        if (encoding is None):
+            return response
+
+        level = app.config.get("COMPRESSION_LEVEL", 6)
+        brotli_quality = app.config.get("COMPRESSION_BROTLI_QUALITY", 5)
+
+        if (response.is_streamed):
+            response.response = compress_chunks(response.response, encoding, level, brotli_quality)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if (len(data) < app.config.get("COMPRESSION_MIN_SIZE", 1024)):
+                return response
+            response.set_data(compress(data, encoding, level, brotli_quality))
+
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if (etag and not weak):
+            response.set_etag(etag, weak=True)
+
+        return response
@@ -0,0 +1,220 @@
+"""Configuration for the Cupcakes app.
+
+Settings come from environment variables so each deployment can tune them without code
+changes. CUPCAKES_ENV picks the configuration class (development, testing or production,
+default development).
+
+    DATABASE_URL             database url (default postgresql:///cupcakes)
+    ASYNC_DATABASE_URL       database url for async_app.py (default DATABASE_URL on asyncpg)
+    SQLALCHEMY_ECHO          log every SQL statement (default on in development only)
+    DB_POOL_SIZE             connections kept open per process (default 5)
+    DB_MAX_OVERFLOW          extra connections allowed above DB_POOL_SIZE (default 10)
+    DB_POOL_TIMEOUT          seconds to wait for a free connection (default 30)
+    DB_POOL_PRE_PING         test connections before use (default on)
+    DB_POOL_RECYCLE          seconds before a connection is replaced (default 1800)
+    DB_STATEMENT_TIMEOUT_MS  PostgreSQL statement_timeout, 0 for none (default 0)
+    CUPCAKES_INSTRUMENTATION request metrics at GET /metrics (default off), see instrumentation.py
+    CUPCAKES_PROFILE_SLOW_MS profile requests and save the stacks of ones slower than this (default 0, off)
+    DATABASE_REPLICA_URLS    comma separated read replica urls for the GET routes (default none), see replicas.py
+
+With gunicorn, every worker process has its own pool, so the database sees up to
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections. GET /api/status/pool reports the
+pool utilization of a worker to help size these values.
+"""
+
+import os
+
+
+def env_str(name, default):
+    """ Returns the environment variable name, or default when it is not set. """
+
+    return os.environ.get(name, default)
+
+
+def env_int(name, default):
+    """ Returns the environment variable name as an int, or default when it is not set. """
+
+    value = os.environ.get(name)
+    if (value is None or value.strip() == ""):
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"Environment variable {name}='{value}' must be an integer.")
+
+
+def env_bool(name, default):
+    """ Returns the environment variable name as a bool (1/true/yes/on), or default when it
+        is not set.
+    """
+
+    value = os.environ.get(name)
+    if (value is None or value.strip() == ""):
+        return default
+
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def database_url(url):
+    """ Returns url with the postgres:// scheme some hosts use changed to postgresql://,
+        the only name SQLAlchemy 1.4 accepts.
+    """
+
+    if (url.startswith("postgres://")):
+        return "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+def replica_binds(urls):
+    """ Returns the SQLALCHEMY_BINDS {"replica_1": url, ...} for comma separated replica urls. """
+
+    urls = [url.strip() for url in urls.split(",") if url.strip()]
+    return {f"replica_{number}": database_url(url) for number, url in enumerate(urls, 1)}
+
+
+def async_database_url(url):
+    """ Returns the asyncpg version of a postgresql url. """
+
+    if (url.startswith("postgresql://")):
+        return "postgresql+asyncpg://" + url[len("postgresql://"):]
+    return url
+
+
+class Config:
+    """ Settings shared by every environment. """
+
+    SQLALCHEMY_DATABASE_URI = database_url(
+        env_str("DATABASE_URL", "postgresql:///cupcakes"))
+    ASYNC_DATABASE_URI = env_str(
+        "ASYNC_DATABASE_URL", async_database_url(SQLALCHEMY_DATABASE_URI))
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = env_bool("SQLALCHEMY_ECHO", False)
+
+    # connection pool and session settings, applied by CupcakesSQLAlchemy in models.py.
+    DB_POOL_SIZE = env_int("DB_POOL_SIZE", 5)
+    DB_MAX_OVERFLOW = env_int("DB_MAX_OVERFLOW", 10)
+    DB_POOL_TIMEOUT = env_int("DB_POOL_TIMEOUT", 30)
+    DB_POOL_PRE_PING = env_bool("DB_POOL_PRE_PING", True)
+    DB_POOL_RECYCLE = env_int("DB_POOL_RECYCLE", 1800)
+    DB_STATEMENT_TIMEOUT_MS = env_int("DB_STATEMENT_TIMEOUT_MS", 0)
+
+    # read replicas (replicas.py): health check interval, the replay lag (PostgreSQL) that takes
+    #  a replica out of rotation (0 for no limit), and how long a client that wrote reads the
+    #  primary.
+    SQLALCHEMY_BINDS = replica_binds(env_str("DATABASE_REPLICA_URLS", ""))
+    REPLICA_HEALTH_CHECK_SECONDS = env_int("REPLICA_HEALTH_CHECK_SECONDS", 10)
+    REPLICA_MAX_LAG_SECONDS = env_int("REPLICA_MAX_LAG_SECONDS", 0)
+    REPLICA_STICKY_SECONDS = env_int("REPLICA_STICKY_SECONDS", 5)
+    REPLICA_STICKY_COOKIE = "cupcakes_primary_until"
+
+    # page size for GET /api/cupcakes when limit= is not provided and the largest limit= allowed,
+    #  and the most ids GET /api/cupcakes?ids= accepts.
+    CUPCAKES_PAGE_LIMIT = env_int("CUPCAKES_PAGE_LIMIT", 100)
+    CUPCAKES_PAGE_LIMIT_MAX = env_int("CUPCAKES_PAGE_LIMIT_MAX", 1000)
+    CUPCAKES_IDS_MAX = env_int("CUPCAKES_IDS_MAX", 100)
+
+    # read-through cache for GET /api/cupcakes/<cupcake_id>. CUPCAKE_CACHE_SHARED is an optional
+    #  shared cache client with redis style get / mget / set / incr / expire / delete, for
+    #  example redis.Redis(). Writes are seen by the local caches of every worker through it.
+    CUPCAKE_CACHE_SIZE = env_int("CUPCAKE_CACHE_SIZE", 1024)
+    CUPCAKE_CACHE_TTL = env_int("CUPCAKE_CACHE_TTL", 60)
+    CUPCAKE_CACHE_SHARED = None
+
+    # group commit for POST /api/cupcakes (group_commit.py): creates arriving within
+    #  GROUP_COMMIT_WINDOW_MS of each other, up to GROUP_COMMIT_MAX_ROWS, share one transaction.
+    #  A create waits at most GROUP_COMMIT_TIMEOUT_MS for the writer thread.
+    GROUP_COMMIT_ENABLED = env_bool("GROUP_COMMIT_ENABLED", False)
+    GROUP_COMMIT_WINDOW_MS = env_int("GROUP_COMMIT_WINDOW_MS", 5)
+    GROUP_COMMIT_MAX_ROWS = env_int("GROUP_COMMIT_MAX_ROWS", 100)
+    GROUP_COMMIT_TIMEOUT_MS = env_int("GROUP_COMMIT_TIMEOUT_MS", 5000)
+
+    # concurrent identical list and detail requests share one query and response body
+    #  (coalesce.py).
+    COALESCE_READS = env_bool("COALESCE_READS", True)
+
+    # request latency, SQL and serialization metrics, and the slow request sampling profiler.
+    INSTRUMENTATION_ENABLED = env_bool("CUPCAKES_INSTRUMENTATION", False)
+    INSTRUMENTATION_PROFILE_SLOW_MS = env_int("CUPCAKES_PROFILE_SLOW_MS", 0)
+    INSTRUMENTATION_PROFILE_INTERVAL_MS = env_int("CUPCAKES_PROFILE_INTERVAL_MS", 5)
+    INSTRUMENTATION_PROFILE_DIR = env_str("CUPCAKES_PROFILE_DIR", "profiles")
+
+    # GET /api/cupcakes/suggest: suggestions per field when limit= is not provided, the
+    #  largest limit= allowed, how often the in-process index is loaded again to pick up
+    #  writes from other worker processes (0 for never) and whether each worker loads it in
+    #  the background on its first request rather than on the first suggest request.
+    SUGGEST_LIMIT = env_int("SUGGEST_LIMIT", 10)
+    SUGGEST_LIMIT_MAX = env_int("SUGGEST_LIMIT_MAX", 50)
+    SUGGEST_REFRESH_SECONDS = env_int("SUGGEST_REFRESH_SECONDS", 300)
+    SUGGEST_PRELOAD = env_bool("SUGGEST_PRELOAD", True)
+
+    # cupcakes rendered into the home page, and how long the rendered page is cached. A
+    #  cupcake write renders it again right away.
+    CATALOG_PAGE_LIMIT = env_int("CATALOG_PAGE_LIMIT", 24)
+    CATALOG_CACHE_TTL = env_int("CATALOG_CACHE_TTL", 300)
+
+    # GET /api/cupcakes/changes page size, and how often / how long the Server-Sent Events
+    #  stream polls the change log before it ends (EventSource then reconnects).
+    CHANGES_PAGE_LIMIT = env_int("CHANGES_PAGE_LIMIT", 500)
+    CHANGES_STREAM_POLL_SECONDS = env_int("CHANGES_STREAM_POLL_SECONDS", 1)
+    CHANGES_STREAM_MAX_SECONDS = env_int("CHANGES_STREAM_MAX_SECONDS", 300)
+
+    # gzip / brotli for JSON and text responses of at least COMPRESSION_MIN_SIZE bytes
+    #  (compression.py), and the directory of the hashed static files (flask assets).
+    COMPRESSION_ENABLED = env_bool("COMPRESSION_ENABLED", True)
+    COMPRESSION_MIN_SIZE = env_int("COMPRESSION_MIN_SIZE", 1024)
+    COMPRESSION_LEVEL = env_int("COMPRESSION_LEVEL", 6)
+    COMPRESSION_BROTLI_QUALITY = env_int("COMPRESSION_BROTLI_QUALITY", 5)
+    ASSETS_DIR = env_str("ASSETS_DIR", "static/dist")
+
+    # GET /images/<cupcake_id> thumbnails: disk cache, fetch limits and browser caching. /static/
+    #  urls on IMAGE_LOCAL_HOSTS (or the request host) are read from the static folder.
+    IMAGE_CACHE_DIR = env_str("IMAGE_CACHE_DIR", "image_cache")
+    IMAGE_CACHE_MAX_BYTES = env_int("IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+    IMAGE_FETCH_TIMEOUT = env_int("IMAGE_FETCH_TIMEOUT", 5)
+    IMAGE_MAX_SOURCE_BYTES = env_int("IMAGE_MAX_SOURCE_BYTES", 10 * 1024 * 1024)
+    IMAGE_MAX_AGE = env_int("IMAGE_MAX_AGE", 7 * 24 * 3600)
+    IMAGE_LOCAL_HOSTS = ("127.0.0.1:5000", "localhost:5000")
+
+
+class DevelopmentConfig(Config):
+    """ Local development: SQL statements are logged. """
+
+    SQLALCHEMY_ECHO = env_bool("SQLALCHEMY_ECHO", True)
+
+
+class TestingConfig(Config):
+    """ Unit tests: the cupcakes_test database. """
+
+    TESTING = True
+    SUGGEST_PRELOAD = False
+    SQLALCHEMY_DATABASE_URI = database_url(
+        env_str("DATABASE_URL", "postgresql:///cupcakes_test"))
+    ASYNC_DATABASE_URI = env_str(
+        "ASYNC_DATABASE_URL", async_database_url(SQLALCHEMY_DATABASE_URI))
+
+
+class ProductionConfig(Config):
+    """ Deployments: no SQL logging and a statement timeout unless one is configured. """
+
+    DB_STATEMENT_TIMEOUT_MS = env_int("DB_STATEMENT_TIMEOUT_MS", 5000)
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig
+}
+
+
+def get_config(name=None):
+    """ Returns the configuration class for name, or for the CUPCAKES_ENV environment
+        variable when name is None.
+    """
+
+    name = name or env_str("CUPCAKES_ENV", "development")
+    if (name not in CONFIGS):
+        raise ValueError(
+            f"CUPCAKES_ENV='{name}' is not valid. Use one of {', '.join(CONFIGS)}.")
+
+    return CONFIGS[name]
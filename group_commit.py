@@ -0,0 +1,123 @@
+"""Group commit for cupcake creation.
+
+With GROUP_COMMIT_ENABLED, POST /api/cupcakes hands its validated cupcake to a writer
+thread instead of committing on its own. The writer takes the first waiting cupcake, keeps
+collecting for GROUP_COMMIT_WINDOW_MS or until it has GROUP_COMMIT_MAX_ROWS, and writes
+them all in one transaction (models.db_add_validated_cupcakes), so many requests share one
+commit and its fsync. Each request then gets its own result: the new cupcake, or an error
+when its row could not be written.
+
+Validation still runs in the request, so a bad body is answered with 400 without waiting
+for the writer. A request waits at most one window plus one commit longer than before,
+and never longer than GROUP_COMMIT_TIMEOUT_MS: a cupcake still queued by then is taken
+back and written by the request itself, and one the writer has already started on is
+answered with 503.
+Under light load the window is mostly idle time; the mode pays off when creates arrive
+faster than commits complete, see benchmarks/bench_group_commit.py.
+
+The writer thread starts with the first cupcake, so each forked worker process (gunicorn)
+gets its own, and submit starts a new one if it has died.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+
+class WriterTimeout(Exception):
+    """ Raised by GroupCommitWriter.wait when a result is late. cancelled is True when the
+        item was taken back before the writer started on it.
+    """
+
+    def __init__(self, cancelled):
+        super().__init__("The group commit writer did not answer in time.")
+        self.cancelled = cancelled
+
+
+class GroupCommitWriter:
+    """ Queues items for write(items) -> [result per item], called in an app context of
+        app on a writer thread with up to max_rows items collected over window_seconds.
+    """
+
+    def __init__(self, write, app=None, window_seconds=0.005, max_rows=100, timeout_seconds=5):
+        self.write = write
+        self.app = app
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stats = {"batches": 0, "rows": 0, "largest_batch": 0, "timeouts": 0}
+        self.configure(window_seconds, max_rows, timeout_seconds)
+
+    def configure(self, window_seconds=0.005, max_rows=100, timeout_seconds=5):
+        self.window_seconds = window_seconds
+        self.max_rows = max_rows
+        self.timeout_seconds = timeout_seconds
+
+    def submit(self, item):
+        """ Queues item and returns a Future for its result. """
+
+        future = Future()
+        self.queue.put((item, future))
+
+        with self.lock:
+            if (self.thread is None or not self.thread.is_alive()):
+                self.thread = threading.Thread(target=self.run, name="group-commit", daemon=True)
+                self.thread.start()
+
+        return future
+
+    def wait(self, future):
+        """ Returns the result of a submitted future, waiting at most timeout_seconds.
+
+            Raises TimeoutError when the result is late: if the writer has not started on
+            the item yet, it is cancelled and the caller can write it itself (cancelled is
+            True); otherwise it may still be written (cancelled is False).
+        """
+
+        try:
+            return future.result(timeout=self.timeout_seconds)
+        except TimeoutError:
+            self.stats["timeouts"] += 1
+            raise WriterTimeout(future.cancel())
+
+    def collect(self):
+        """ Returns the next batch: the first waiting item and those that arrive within
+            window_seconds of it, up to max_rows.
+        """
+
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window_seconds
+        while (len(batch) < self.max_rows):
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0
+                             else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while (True):
+            # items whose request stopped waiting (see wait) are dropped.
+            batch = [(item, future) for item, future in self.collect()
+                     if future.set_running_or_notify_cancel()]
+            if (not batch):
+                continue
+            items = [item for item, future in batch]
+            try:
+                if (self.app is not None):
+                    with self.app.app_context():
+                        results = self.write(items)
+                else:
+                    results = self.write(items)
+            except Exception as e:
+                for item, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.stats["batches"] += 1
+            self.stats["rows"] += len(batch)
+            self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+            for (item, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,419 @@
+"""Thumbnails of cupcake images for GET /images/<cupcake_id>.
+
+Cupcake.image is any URL. The image is fetched once, resized to each requested width in
+THUMBNAIL_SIZES and re-encoded as a progressive JPEG with Pillow (in requirements.txt).
+Without Pillow the fetched image is cached and served unchanged.
+
+Remote images are only fetched from public addresses: the host is resolved and the
+connection refused when it resolves to a private, loopback, link-local, multicast or
+reserved address, and the address actually connected to is checked again (DNS may change
+between the two). Redirects are followed by hand, up to MAX_REDIRECTS, so every hop is
+checked the same way, and proxies from the environment are not used. The body is read up
+to max_bytes.
+
+Files are content addressed: a thumbnail is named after the SHA-256 of the source image
+bytes, so cupcakes sharing an image (for example the default image) share thumbnails. A
+small index maps each source URL to that digest so cached images are not fetched again.
+The cache directory is kept under IMAGE_CACHE_MAX_BYTES by removing the least recently
+used files.
+
+/static/ URLs of this app (a host in IMAGE_LOCAL_HOSTS, or no host) are read from the
+static folder instead of over HTTP.
+"""
+
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+from urllib.parse import urljoin, urlsplit
+
+from werkzeug.security import safe_join
+
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:
+    Image = None
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+except ImportError:
+    requests = None
+
+# size name -> largest width / height in pixels.
+THUMBNAIL_SIZES = {"small": 96, "medium": 240, "large": 480}
+DEFAULT_SIZE = "medium"
+
+# the most redirects followed for one image.
+MAX_REDIRECTS = 3
+
+# leading bytes -> (content type, file extension) of images served without Pillow.
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", ("image/jpeg", "jpg")),
+    (b"\x89PNG\r\n\x1a\n", ("image/png", "png")),
+    (b"GIF87a", ("image/gif", "gif")),
+    (b"GIF89a", ("image/gif", "gif")),
+)
+
+
+class ImageError(Exception):
+    """ The image could not be fetched or read. response_code is the HTTP status for it. """
+
+    def __init__(self, message, response_code=502):
+        super().__init__(message)
+        self.message = message
+        self.response_code = response_code
+
+
+def image_type(data):
+    """ Returns (content type, extension) for the image bytes in data. """
+
+    for signature, found in IMAGE_SIGNATURES:
+        if (data.startswith(signature)):
+            return found
+    if (data[:4] == b"RIFF" and data[8:12] == b"WEBP"):
+        return ("image/webp", "webp")
+
+    raise ImageError("The cupcake image is not a JPEG, PNG, GIF or WebP image.")
+
+
+def local_image_path(url, static_folder, static_url_path, local_hosts):
+    """ Returns the file in static_folder for a /static/ url of this app, else None. """
+
+    parts = urlsplit(url)
+    if (parts.netloc and parts.netloc not in local_hosts):
+        return None
+    if (not parts.path.startswith(static_url_path + "/")):
+        return None
+
+    return safe_join(static_folder, parts.path[len(static_url_path) + 1:])
+
+
+def is_public_address(address):
+    """ Returns True when the IP address string is a public unicast address, one an image
+        may be fetched from.
+    """
+
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if (ip.version == 6 and ip.ipv4_mapped):
+        ip = ip.ipv4_mapped
+
+    return ip.is_global and not ip.is_multicast
+
+
+def check_public_host(host, port):
+    """ Raises ImageError unless every address host resolves to is public. """
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)}
+    except (socket.gaierror, UnicodeError):
+        raise ImageError("The cupcake image host could not be resolved.")
+
+    if (not all(is_public_address(address) for address in addresses)):
+        raise ImageError("The cupcake image host is not a public address.")
+
+
+def check_public_peer(sock):
+    """ Closes sock and raises ImageError when it is connected to a non-public address. """
+
+    if (not is_public_address(sock.getpeername()[0])):
+        sock.close()
+        raise ImageError("The cupcake image host is not a public address.")
+
+
+if (requests is not None):
+
+    class PublicHTTPConnection(HTTPConnection):
+        """ HTTPConnection that only connects to public addresses. """
+
+        def _new_conn(self):
+            check_public_host(self._dns_host, self.port)
+            sock = super()._new_conn()
+            check_public_peer(sock)
+            return sock
+
+    class PublicHTTPSConnection(HTTPSConnection):
+        """ HTTPSConnection that only connects to public addresses. """
+
+        def _new_conn(self):
+            check_public_host(self._dns_host, self.port)
+            sock = super()._new_conn()
+            check_public_peer(sock)
+            return sock
+
+    class PublicHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = PublicHTTPConnection
+
+    class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = PublicHTTPSConnection
+
+    class PublicAddressAdapter(HTTPAdapter):
+        """ requests transport adapter using the public address connections. """
+
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": PublicHTTPConnectionPool, "https": PublicHTTPSConnectionPool}
+
+
+def public_session():
+    """ Returns a requests session that only connects to public addresses. """
+
+    session = requests.Session()
+    # a proxy would be the peer instead of the image host, so the address check needs
+    #  direct connections.
+    session.trust_env = False
+    adapter = PublicAddressAdapter()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_image(url, timeout=5, max_bytes=10 * 1024 * 1024):
+    """ Returns the bytes at the http(s) url. ImageError when the fetch fails, the url or a
+        redirect leads to a non-public address or the image is larger than max_bytes.
+    """
+
+    if (requests is None):
+        raise ImageError("Remote images need the requests package.")
+
+    try:
+        with public_session() as session:
+            for redirect in range(MAX_REDIRECTS + 1):
+                if (urlsplit(url).scheme not in ("http", "https")):
+                    raise ImageError(f"The cupcake image url '{url}' is not an http(s) url.")
+
+                with session.get(url, timeout=timeout, stream=True, allow_redirects=False) as response:
+                    if (response.is_redirect):
+                        url = urljoin(url, response.headers["Location"])
+                        continue
+
+                    return read_image(response, max_bytes)
+
+            raise ImageError("The cupcake image url redirected too many times.")
+
+    except requests.RequestException as e:
+        raise ImageError(f"The cupcake image could not be fetched: {e.__class__.__name__}.")
+
+
+def read_image(response, max_bytes):
+    """ Returns the body of the requests response, up to max_bytes. """
+
+    if (response.status_code != 200):
+        raise ImageError(
+            f"The cupcake image could not be fetched, status {response.status_code}.")
+
+    length = response.headers.get("Content-Length", "")
+    if (length.isnumeric() and int(length) > max_bytes):
+        raise ImageError("The cupcake image is too large.")
+
+    data = io.BytesIO()
+    for chunk in response.iter_content(64 * 1024):
+        data.write(chunk)
+        if (data.tell() > max_bytes):
+            raise ImageError("The cupcake image is too large.")
+    return data.getvalue()
+
+
+def make_thumbnail(data, width):
+    """ Returns data resized to fit width x width and re-encoded as JPEG bytes. """
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((width, width))
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        raise ImageError("The cupcake image could not be read.")
+
+    if (image.mode in ("RGBA", "LA", "P")):
+        # JPEG has no transparency; use a white background.
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        image = image.convert("RGBA")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif (image.mode != "RGB"):
+        image = image.convert("RGB")
+
+    thumbnail = io.BytesIO()
+    image.save(thumbnail, "JPEG", quality=80, optimize=True, progressive=True)
+    return thumbnail.getvalue()
+
+
+class ImageCache:
+    """ Content addressed disk cache of thumbnails with least recently used eviction.
+
+        directory/urls/<sha256 of url>       "<digest> <extension>" of the source image
+        directory/<digest[:2]>/<digest>-<size>.<extension>  thumbnail
+
+        The modification time of a file is its last use; eviction removes the oldest files
+        until the cache is within max_bytes.
+    """
+
+    def __init__(self, directory="image_cache", max_bytes=256 * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.configure(directory, max_bytes)
+
+    def configure(self, directory, max_bytes):
+        with self.lock:
+            self.directory = directory
+            self.max_bytes = max_bytes
+            # bytes on disk, counted on the first write.
+            self.size = None
+
+    def url_path(self, url):
+        return os.path.join(self.directory, "urls", hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def thumbnail_path(self, digest, size, extension):
+        return os.path.join(self.directory, digest[:2], f"{digest}-{size}.{extension}")
+
+    def lookup(self, url):
+        """ Returns (digest, extension) of the source image of url, or None. """
+
+        try:
+            with open(self.url_path(url)) as index:
+                digest, extension = index.read().split()
+        except (OSError, ValueError):
+            return None
+
+        touch(self.url_path(url))
+        return (digest, extension)
+
+    def get(self, digest, size, extension):
+        """ Returns the cached thumbnail bytes, or None.
+
+            The file is read here rather than handing out its path: evict may remove it at
+            any time, and an open file can still be read after that.
+        """
+
+        path = self.thumbnail_path(digest, size, extension)
+        try:
+            with open(path, "rb") as thumbnail_file:
+                data = thumbnail_file.read()
+        except OSError:
+            return None
+
+        touch(path)
+        return data
+
+    def put_url(self, url, digest, extension):
+        self.write(self.url_path(url), f"{digest} {extension}".encode("ascii"))
+
+    def put(self, digest, size, extension, data):
+        """ Stores the thumbnail data and returns it. """
+
+        self.write(self.thumbnail_path(digest, size, extension), data)
+        return data
+
+    def write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write then rename, so readers never see a partial file.
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(handle, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            if (self.size is None):
+                self.size = sum(size for path, mtime, size in self.files())
+            else:
+                self.size += len(data)
+            if (self.size > self.max_bytes):
+                self.evict()
+
+    def files(self):
+        """ Returns (path, mtime, size) for every file in the cache. """
+
+        found = []
+        for root, directories, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((path, stat.st_mtime, stat.st_size))
+        return found
+
+    def evict(self):
+        """ Removes the least recently used files until the cache fits max_bytes. Called
+            with the lock held.
+        """
+
+        files = sorted(self.files(), key=lambda file: file[1])
+        self.size = sum(size for path, mtime, size in files)
+        for path, mtime, size in files:
+            if (self.size <= self.max_bytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+def touch(path):
+    """ Marks path as just used. Returns False when it does not exist. """
+
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+image_cache = ImageCache()
+
+
+def get_thumbnail(url, size, static_folder, static_url_path="/static",
+                  local_hosts=(), timeout=5, max_bytes=10 * 1024 * 1024):
+    """ Returns (image bytes, content type, digest) of the size thumbnail of the image at url,
+        fetching and resizing it when it is not cached. ImageError when that fails.
+    """
+
+    width = THUMBNAIL_SIZES[size]
+    found = image_cache.lookup(url)
+    if (found):
+        digest, extension = found
+        thumbnail = image_cache.get(digest, size if Image else "original", extension)
+        if (thumbnail is not None):
+            return (thumbnail, content_type(extension), digest)
+
+    local_path = local_image_path(url, static_folder, static_url_path, local_hosts)
+    if (local_path):
+        try:
+            with open(local_path, "rb") as image_file:
+                data = image_file.read()
+        except OSError:
+            raise ImageError("The cupcake image was not found.", 404)
+    else:
+        data = fetch_image(url, timeout, max_bytes)
+
+    digest = hashlib.sha256(data).hexdigest()
+    if (Image):
+        extension = "jpg"
+        thumbnail = image_cache.get(digest, size, extension)
+        if (thumbnail is None):
+            thumbnail = image_cache.put(digest, size, extension, make_thumbnail(data, width))
+    else:
+        extension = image_type(data)[1]
+        thumbnail = image_cache.get(digest, "original", extension)
+        if (thumbnail is None):
+            thumbnail = image_cache.put(digest, "original", extension, data)
+    image_cache.put_url(url, digest, extension)
+
+    return (thumbnail, content_type(extension), digest)
+
+
+def content_type(extension):
+    """ Returns the content type for a cached file extension. """
+
+    for signature, (found_type, found_extension) in IMAGE_SIGNATURES:
+        if (found_extension == extension):
+            return found_type
+    return "image/webp"
@@ -0,0 +1,282 @@
+"""Opt-in request instrumentation for the Cupcakes Flask app.
+
+Turned on with INSTRUMENTATION_ENABLED (environment variable CUPCAKES_INSTRUMENTATION=1).
+When it is off the request hooks return right away. When it is on, every request records
+
+    cupcakes_request_duration_seconds        latency by method, route and status
+    cupcakes_request_sql_queries             SQL statements run by the request, by route
+    cupcakes_request_sql_duration_seconds    time spent in those statements, by route
+    cupcakes_request_serialization_seconds   time spent writing the JSON body, by route
+
+as histograms, served in Prometheus text format at GET /metrics.
+
+With INSTRUMENTATION_PROFILE_SLOW_MS above 0, a sampling profiler takes the stack of every
+in-flight request each INSTRUMENTATION_PROFILE_INTERVAL_MS milliseconds. The samples of a
+request slower than the threshold are written to INSTRUMENTATION_PROFILE_DIR in the folded
+stack format read by flamegraph.pl and speedscope, one file per slow request.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# latency bucket upper bounds in seconds, and for SQL statement counts.
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Histogram:
+    """ Prometheus style histogram: cumulative bucket counts, sum and count for each set
+        of label values.
+    """
+
+    def __init__(self, name, description, label_names, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if (series is None):
+                series = self.series[label_values] = {
+                    "buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+
+            for index, bound in enumerate(self.buckets):
+                if (value <= bound):
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        """ Returns the histogram in Prometheus text format lines. """
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                labels = ",".join(f'{name}="{escape_label(value)}"'
+                                  for name, value in zip(self.label_names, label_values))
+                separator = "," if labels else ""
+
+                for bound, bucket_count in zip(self.buckets, series["buckets"]):
+                    lines.append(
+                        f'{self.name}_bucket{{{labels}{separator}le="{bound}"}} {bucket_count}')
+                lines.append(
+                    f'{self.name}_bucket{{{labels}{separator}le="+Inf"}} {series["count"]}')
+                suffix = f"{{{labels}}}" if labels else ""
+                lines.append(f"{self.name}_sum{suffix} {series['sum']}")
+                lines.append(f"{self.name}_count{suffix} {series['count']}")
+
+        return lines
+
+
+def escape_label(value):
+    """ Returns value escaped for a Prometheus label value. """
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_duration = Histogram("cupcakes_request_duration_seconds",
+                             "Request latency.", ("method", "route", "status"))
+request_sql_queries = Histogram("cupcakes_request_sql_queries",
+                                "SQL statements run per request.", ("route",), COUNT_BUCKETS)
+request_sql_duration = Histogram("cupcakes_request_sql_duration_seconds",
+                                 "Time spent in SQL statements per request.", ("route",))
+request_serialization = Histogram("cupcakes_request_serialization_seconds",
+                                  "Time spent serializing the response body per request.", ("route",))
+
+METRICS = (request_duration, request_sql_queries, request_sql_duration, request_serialization)
+
+
+def render_metrics():
+    """ Returns every metric in Prometheus text format. """
+
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """ Samples the Python stack of registered threads every interval seconds from a
+        background thread. Each registered thread collects a Counter of folded stacks
+        ("outer;inner;innermost" -> number of samples).
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if (self.thread is None):
+            self.thread = threading.Thread(target=self.run, name="cupcakes-profiler", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+
+            with self.lock:
+                thread_ids = list(self.samples)
+            if (not thread_ids):
+                continue
+
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if (frame is not None):
+                    stack = folded_stack(frame)
+                    with self.lock:
+                        if (thread_id in self.samples):
+                            self.samples[thread_id][stack] += 1
+
+    def register(self, thread_id):
+        """ Starts collecting samples for thread_id. """
+
+        with self.lock:
+            self.samples[thread_id] = Counter()
+
+    def unregister(self, thread_id):
+        """ Stops collecting samples for thread_id and returns them. """
+
+        with self.lock:
+            return self.samples.pop(thread_id, Counter())
+
+
+def folded_stack(frame):
+    """ Returns the stack of frame as "function (file:line);..." from the outermost call. """
+
+    names = []
+    while (frame is not None):
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+def write_profile(directory, route, duration, samples):
+    """ Writes samples in folded stack format to a new file in directory and returns its path. """
+
+    os.makedirs(directory, exist_ok=True)
+    name = "".join(c if c.isalnum() else "_" for c in route).strip("_") or "root"
+    path = os.path.join(directory,
+                        f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{name}-{int(duration * 1000)}ms.folded")
+
+    with open(path, "w") as profile:
+        for stack, count in samples.most_common():
+            profile.write(f"{stack} {count}\n")
+
+    return path
+
+
+def record_serialization(seconds):
+    """ Adds seconds to the serialization time of the current request. Called by
+        serializers.json_response; does nothing outside an instrumented request.
+    """
+
+    if (has_request_context() and "instrumentation" in g):
+        g.instrumentation["serialization"] += seconds
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if (has_request_context() and "instrumentation" in g):
+        conn.info.setdefault("instrumentation_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if (has_request_context() and "instrumentation" in g):
+        starts = conn.info.get("instrumentation_start")
+        if (starts):
+            g.instrumentation["sql_queries"] += 1
+            g.instrumentation["sql_seconds"] += time.perf_counter() - starts.pop()
+
+
+def init_instrumentation(app):
+    """ Adds the request hooks and GET /metrics to app. They do nothing (and /metrics is
+        404) unless INSTRUMENTATION_ENABLED is set, which can be changed while running.
+    """
+
+    # every engine, including ones created after this call.
+    if (not event.contains(Engine, "before_cursor_execute", before_cursor_execute)):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+
+    def get_profiler():
+        """ Returns the SamplingProfiler when slow request profiling is on, else None. """
+
+        if (app.config.get("INSTRUMENTATION_PROFILE_SLOW_MS", 0) <= 0):
+            return None
+
+        profiler = app.extensions.get("cupcakes_profiler")
+        if (profiler is None):
+            profiler = app.extensions["cupcakes_profiler"] = SamplingProfiler(
+                app.config.get("INSTRUMENTATION_PROFILE_INTERVAL_MS", 5) / 1000)
+            profiler.start()
+        return profiler
+
+    @app.before_request
+    def start_instrumentation():
+        if (not app.config.get("INSTRUMENTATION_ENABLED")):
+            return
+
+        g.instrumentation = {"start": time.perf_counter(), "sql_queries": 0,
+                             "sql_seconds": 0.0, "serialization": 0.0,
+                             "profiler": get_profiler()}
+        if (g.instrumentation["profiler"]):
+            g.instrumentation["profiler"].register(threading.get_ident())
+
+    @app.after_request
+    def record_instrumentation(response):
+        data = g.pop("instrumentation", None)
+        if (data is None):
+            return response
+
+        duration = time.perf_counter() - data["start"]
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+
+        request_duration.observe(duration, request.method, route, str(response.status_code))
+        request_sql_queries.observe(data["sql_queries"], route)
+        request_sql_duration.observe(data["sql_seconds"], route)
+        request_serialization.observe(data["serialization"], route)
+
+        profiler = data["profiler"]
+        if (profiler):
+            samples = profiler.unregister(threading.get_ident())
+            if (duration * 1000 >= app.config["INSTRUMENTATION_PROFILE_SLOW_MS"] and samples):
+                write_profile(app.config.get("INSTRUMENTATION_PROFILE_DIR", "profiles"),
+                              f"{request.method} {route}", duration, samples)
+
+        return response
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        # a request that raised skips after_request; stop sampling its thread.
+        data = g.pop("instrumentation", None)
+        if (data and data["profiler"]):
+            data["profiler"].unregister(threading.get_ident())
+
+    # GET /metrics
+    @app.route("/metrics")
+    def metrics():
+        """ Request, SQL and serialization histograms in Prometheus text format. 404 when
+            instrumentation is off.
+        """
+
+        if (not app.config.get("INSTRUMENTATION_ENABLED")):
+            return Response("Instrumentation is not enabled.\n", status=404, mimetype="text/plain")
+
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
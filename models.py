@@ -1,18 +1,132 @@
 """Models for Cupcake app."""
 
-from flask_sqlalchemy import SQLAlchemy
+import math
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from types import MappingProxyType
+
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm.util import identity_key
+from cache import ReadThroughCache
+from group_commit import WriterTimeout
+from pool_metrics import track_engine, pool_status
+from replicas import ReplicaRouter, is_read_statement
+from serializers import rows_to_dicts
+from suggest import SuggestIndex
+from validators import (validate_cupcake_create, validate_cupcake_update, first_error,
+                        field_messages, MISSING, BLANK)
 # from sqlalchemy.exc import NotNullViolation
 # from sqlalchemy.exc import IntegrityError
 # from psycopg2.errors import NotNullViolation
 
-db = SQLAlchemy()
 
-CUPCAKE_FIELDS = {
+class RoutingSession(SignallingSession):
+    """ Session that runs the SELECT statements of read_replica views (session.info
+        "read_replica", see replicas.py) on a replica. One replica serves the whole
+        session. Writes, flushes and locking reads go to the primary, and so does every
+        statement after the first of them.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if (self.info.get("read_replica")):
+            if (self._flushing or not is_read_statement(clause)):
+                # the rest of the session reads its own writes.
+                self.info["read_replica"] = False
+            else:
+                if ("replica" not in self.info):
+                    self.info["replica"] = self.db.replica_router.choose(
+                        lambda name: self.db.get_engine(self.app, bind=name))
+                if (self.info["replica"]):
+                    return self.info["replica"][1]
+
+        return super().get_bind(mapper, clause)
+
+
+class CupcakesSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy that applies the DB_* connection pool settings from config.py to the
+        engine and collects pool utilization metrics (GET /api/status/pool). Its sessions
+        can send reads to replicas (replicas.py).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.replica_router = ReplicaRouter()
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        """ Adds pool options to the create_engine options. SQLALCHEMY_ENGINE_OPTIONS still
+            take precedence. SQLite uses the pool Flask-SQLAlchemy picks for it, so only
+            pre-ping applies there.
+        """
+
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+
+        options.setdefault("pool_pre_ping", app.config.get("DB_POOL_PRE_PING", True))
+
+        if (sa_url.drivername.startswith("postgresql")):
+            options.setdefault("pool_size", app.config.get("DB_POOL_SIZE", 5))
+            options.setdefault("max_overflow", app.config.get("DB_MAX_OVERFLOW", 10))
+            options.setdefault("pool_timeout", app.config.get("DB_POOL_TIMEOUT", 30))
+            options.setdefault("pool_recycle", app.config.get("DB_POOL_RECYCLE", 1800))
+
+            statement_timeout = app.config.get("DB_STATEMENT_TIMEOUT_MS", 0)
+            if (statement_timeout):
+                connect_args = options.setdefault("connect_args", {})
+                connect_args.setdefault(
+                    "options", f"-c statement_timeout={int(statement_timeout)}")
+
+        return (sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        track_engine(engine)
+
+        return engine
+
+
+db = CupcakesSQLAlchemy()
+
+# serialized cupcakes by id for GET /api/cupcakes/<cupcake_id>. Every function below that
+#  changes a cupcake invalidates its id.
+cupcake_cache = ReadThroughCache()
+
+
+def load_value_counts(field):
+    """ Returns {value: number of cupcakes} for the flavor or size column. Uses a connection
+        of its own, not db.session, as suggest_index also refreshes in a background thread.
+    """
+
+    column = getattr(Cupcake, field)
+    with db.get_engine(db.get_app()).connect() as connection:
+        return dict(connection.execute(
+            db.select([column, db.func.count()]).group_by(column)).fetchall())
+
+
+# distinct flavors and sizes for GET /api/cupcakes/suggest. Every function below that
+#  changes a cupcake applies its change after the commit.
+suggest_index = SuggestIndex(("flavor", "size"), load_value_counts)
+
+# read only: request handlers build their own dictionaries from these keys.
+CUPCAKE_FIELDS = MappingProxyType({
     "flavor": "",
     "size": "",
     "rating": "",
     "image": ""
-}
+})
+
+# columns that may be requested through the fields= projection. id is always returned
+#  because it is the pagination key.
+CUPCAKE_COLUMNS = ("id", "flavor", "size", "rating", "image")
 
 
 def connect_db(app):
@@ -22,6 +136,21 @@ def connect_db(app):
     db.app = app
     db.init_app(app)
 
+    cupcake_cache.configure(max_size=app.config.get('CUPCAKE_CACHE_SIZE', 1024),
+                            ttl=app.config.get('CUPCAKE_CACHE_TTL', 60),
+                            shared=app.config.get('CUPCAKE_CACHE_SHARED'))
+    suggest_index.configure(refresh_seconds=app.config.get('SUGGEST_REFRESH_SECONDS', 300),
+                            max_limit=app.config.get('SUGGEST_LIMIT_MAX', 50))
+
+
+def db_pool_status():
+    """ Returns connection pool settings and utilization for the engines of this process. """
+
+    # make sure the engine exists so a fresh worker reports its pool.
+    db.get_engine()
+
+    return pool_status()
+
 
 # MODELS
 class Cupcake(db.Model):
@@ -46,6 +175,32 @@ class Cupcake(db.Model):
                       nullable=False,
                       default='https://tinyurl.com/demo-cupcake')
 
+    # row version, incremented by every update. Used for ETags and for optimistic
+    #  concurrency: the ORM adds "AND version = <version read>" to its UPDATE statements.
+    version = db.Column(db.Integer,
+                        nullable=False,
+                        default=1)
+
+    updated_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+    __mapper_args__ = {"version_id_col": version}
+
+    # indexes for the GET /api/cupcakes filters and sorts. The trigram index serves
+    #  flavor substring searches (ILIKE '%..%') and the pattern_ops index flavor prefix
+    #  searches (LIKE '..%'). (column, id) indexes serve the keyset pagination order.
+    __table_args__ = (
+        db.Index("ix_cupcakes_flavor_trgm", "flavor",
+                 postgresql_using="gin",
+                 postgresql_ops={"flavor": "gin_trgm_ops"}),
+        db.Index("ix_cupcakes_flavor_prefix", "flavor", "id",
+                 postgresql_ops={"flavor": "varchar_pattern_ops"}),
+        db.Index("ix_cupcakes_size_id", "size", "id"),
+        db.Index("ix_cupcakes_rating_id", "rating", "id"),
+    )
+
     def __repr__(self):
         """Show cupcake information """
 
@@ -64,13 +219,572 @@ class Cupcake(db.Model):
         return serialized_dictionary
 
 
-def db_add_cupcake(cupcake_spec_in):
-    """ adds a cupcate to the cupcakes table """
+# width of the rating buckets of cupcake_stats. A power of two, so the bucket of a rating
+#  is computed exactly alike in Python and SQL.
+RATING_BUCKET = 0.5
 
-    # print(
-    #     f"\n\nMODEL db_add_cupcake: cupcake_spec = {cupcake_spec_in}", flush=True)
 
-    # Take the values in cupcake_spec_in, move them into cupcake_spec and handle '' and strip()
+class CupcakeStat(db.Model):
+    """ Number of cupcakes and sum of their ratings for each size, flavor and rating bucket
+        (ratings rounded down to a multiple of RATING_BUCKET). The add, update and delete
+        functions below keep it in step with the cupcakes table in the same transaction,
+        so statistics are read from one row per group instead of every cupcake.
+    """
+
+    __tablename__ = 'cupcake_stats'
+
+    size = db.Column(db.String(64),
+                     primary_key=True)
+
+    flavor = db.Column(db.String(64),
+                       primary_key=True)
+
+    rating_bucket = db.Column(db.Float,
+                              primary_key=True)
+
+    count = db.Column(db.Integer,
+                      nullable=False,
+                      default=0)
+
+    # exact ratings summed, for the mean.
+    rating_sum = db.Column(db.Float,
+                           nullable=False,
+                           default=0)
+
+    def __repr__(self):
+        """Show cupcake statistic information """
+
+        return f"<CupcakeStat size='{self.size}', flavor='{self.flavor}', rating_bucket={self.rating_bucket}, count={self.count}, rating_sum={self.rating_sum} >"
+
+
+class CupcakeChange(db.Model):
+    """ Change log of the cupcakes table. The add, update and delete functions below write
+        one row per cupcake they change, in the same transaction, so clients can ask for
+        the changes after the last seq they saw (GET /api/cupcakes/changes) instead of
+        reading every cupcake again.
+    """
+
+    __tablename__ = 'cupcake_changes'
+
+    seq = db.Column(db.Integer,
+                    primary_key=True,
+                    autoincrement=True)
+
+    # create, update, delete, or reload (cupcakes were written in bulk, read them all again).
+    op = db.Column(db.String(8),
+                   nullable=False)
+
+    cupcake_id = db.Column(db.Integer)
+
+    # serialized cupcake after a create or update; None for deletes and reloads.
+    cupcake = db.Column(db.JSON)
+
+    changed_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow)
+
+    def __repr__(self):
+        """Show cupcake change information """
+
+        return f"<CupcakeChange seq={self.seq} op='{self.op}', cupcake_id={self.cupcake_id} >"
+
+    def serialize(self):
+        """ Returns serialized dictionary with change values. """
+
+        return {
+            'seq': self.seq,
+            'op': self.op,
+            'id': self.cupcake_id,
+            'cupcake': self.cupcake
+        }
+
+
+# the trigram index needs the pg_trgm extension.
+db.event.listen(Cupcake.__table__, "before_create",
+                db.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+
+
+def like_escape(value):
+    """ Returns value with the LIKE wildcards % and _ escaped with a / (the escape character
+        used by cupcake_filters).
+    """
+
+    return value.replace("/", "//").replace("%", "/%").replace("_", "/_")
+
+
+def cupcake_filters(filters):
+    """ Returns a list of SQL conditions for the dictionary filters. Recognized keys:
+
+        flavor         flavor contains the value, case insensitive (trigram index).
+        flavor_prefix  flavor starts with the value (pattern_ops index).
+        size           size equals the value (size index).
+        rating_min     rating >= the value (rating index).
+        rating_max     rating <= the value (rating index).
+
+    """
+
+    conditions = []
+    if (filters.get("flavor")):
+        conditions.append(Cupcake.flavor.ilike(
+            f"%{like_escape(filters['flavor'])}%", escape="/"))
+    if (filters.get("flavor_prefix")):
+        conditions.append(Cupcake.flavor.like(
+            f"{like_escape(filters['flavor_prefix'])}%", escape="/"))
+    if (filters.get("size")):
+        conditions.append(Cupcake.size == filters["size"])
+    if (filters.get("rating_min") is not None):
+        conditions.append(Cupcake.rating >= filters["rating_min"])
+    if (filters.get("rating_max") is not None):
+        conditions.append(Cupcake.rating <= filters["rating_max"])
+
+    return conditions
+
+
+def db_list_cupcakes(limit, after=None, fields=CUPCAKE_COLUMNS, filters=None, sort="id"):
+    """ Returns one page of cupcakes (keyset pagination).
+
+        limit is the maximum number of cupcakes returned. fields is a list of column names
+        from CUPCAKE_COLUMNS. Only those columns are selected, rows are returned as
+        dictionaries and no Cupcake objects are created. filters is a dictionary for
+        cupcake_filters. sort is a column name from CUPCAKE_COLUMNS, prefixed with - for 
+        descending order. Rows with the same sort value are ordered by id.
+
+        after is the "after" dictionary of the previous page ({"id", "value"}), or None for
+        the first page.
+
+        Returns {"cupcakes": [{...}, ...], "versions": [(id, version), ...], "after":
+        {"id", "value"} of the last row or None, "more": True when another page exists}.
+
+    """
+
+    rows = db.session.execute(cupcake_list_statement(
+        limit, after, fields, filters, sort)).all()
+
+    return cupcake_list_page(rows, limit)
+
+
+def cupcake_list_statement(limit, after=None, fields=CUPCAKE_COLUMNS, filters=None, sort="id"):
+    """ Returns the SELECT for a page of db_list_cupcakes (see it for the arguments). One
+        extra row is selected to find out whether there is another page.
+    """
+
+    descending = sort.startswith("-")
+    sort_column = getattr(Cupcake, sort.lstrip("-"))
+
+    columns = [Cupcake.id] + [getattr(Cupcake, field)
+                              for field in fields if field != "id"]
+
+    statement = (db.select([*columns,
+                            sort_column.label("sort_value"),
+                            Cupcake.version])
+                 .where(*cupcake_filters(filters or {})))
+
+    if (descending):
+        statement = statement.order_by(sort_column.desc(), Cupcake.id.desc())
+    else:
+        statement = statement.order_by(sort_column, Cupcake.id)
+
+    if (after is not None):
+        # (sort value, id) row comparison lets the database continue the index scan
+        #  where the previous page stopped.
+        position = db.tuple_(sort_column, Cupcake.id)
+        last = db.tuple_(after["value"], after["id"])
+        statement = statement.where(position < last if descending else position > last)
+
+    return statement.limit(limit + 1)
+
+
+def cupcake_list_page(rows, limit):
+    """ Returns the db_list_cupcakes results for the rows read with cupcake_list_statement. """
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    # the last two columns are sort_value and version.
+    keys = rows[0]._fields[:-2] if rows else ()
+
+    return {
+        "cupcakes": rows_to_dicts(rows, keys),
+        "versions": [(row.id, row.version) for row in rows],
+        "after": {"id": rows[-1].id, "value": rows[-1].sort_value} if rows else None,
+        "more": more
+    }
+
+
+def db_get_cupcake(cupcake_id):
+    """ Returns {"cupcake": serialized cupcake, "version": row version, "updated_at": iso
+        timestamp} for cupcake_id or None when it does not exist.
+
+        Values come from cupcake_cache, the database is only read on a cache miss. Misses
+        read the primary (primary_reads).
+    """
+
+    def load_cupcake():
+        with primary_reads():
+            return cupcake_cache_entry(Cupcake.query.get(cupcake_id))
+
+    return cupcake_cache.get_or_load(int(cupcake_id), load_cupcake)
+
+
+def db_get_cupcakes(cupcake_ids, session=None):
+    """ Returns {"results": [...], "versions": [(id, version)]} with one result per id in
+        the order of cupcake_ids. Each result has id, response_code and either cupcake (200)
+        or error: {message} (404), using the same messages as a single cupcake lookup
+        (get_error_message). versions lists the cupcakes found, for the ETag.
+
+        Cached cupcakes come from cupcake_cache, the others are read from the primary with
+        one query (id = ANY(array) on PostgreSQL, id IN (..) elsewhere) and cached.
+        session defaults to db.session; the async app passes the sync session of its
+        AsyncSession.
+    """
+
+    session = session or db.session
+    keys = {int(cupcake_id) for cupcake_id in cupcake_ids if is_cupcake_id(cupcake_id)}
+
+    found = {}
+    missing = []
+    for key in sorted(keys):
+        hit, value = cupcake_cache.lookup(key)
+        if (hit):
+            found[key] = value
+        else:
+            missing.append(key)
+
+    if (missing):
+        snapshot = cupcake_cache.snapshot(*missing)
+        with primary_reads(session):
+            for cupcake in session.query(Cupcake).filter(
+                    id_in(Cupcake.id, missing, session.bind.dialect)):
+                found[cupcake.id] = cupcake_cache_entry(cupcake)
+                cupcake_cache.store(cupcake.id, found[cupcake.id], snapshot)
+
+    results = []
+    versions = []
+    for cupcake_id in cupcake_ids:
+        entry = found.get(int(cupcake_id)) if is_cupcake_id(cupcake_id) else None
+        if (entry):
+            results.append({"id": entry["cupcake"]["id"], "response_code": 200,
+                            "cupcake": entry["cupcake"]})
+            versions.append((entry["cupcake"]["id"], entry["version"]))
+        else:
+            results.append({"id": cupcake_id, "response_code": 404,
+                            "error": {"message": get_error_message(cupcake_id)}})
+
+    return {"results": results, "versions": versions}
+
+
+def get_error_message(cupcake_id):
+    """ Returns the message for a cupcake_id that GET cannot return: not an integer or not
+        found.
+    """
+
+    if (not is_cupcake_id(cupcake_id)):
+        return f"Cupcake id='{cupcake_id}' was not an integer."
+    return f"Cupcake id={cupcake_id} was not found"
+
+
+def id_in(column, ids, dialect):
+    """ Returns column = ANY(:ids) with ids bound as one array on PostgreSQL, so the
+        statement is the same for every number of ids, and column IN (..) elsewhere.
+    """
+
+    if (dialect.name == "postgresql"):
+        return column == db.any_(db.bindparam("ids", ids, type_=postgresql.ARRAY(db.Integer)))
+    return column.in_(ids)
+
+
+@contextmanager
+def primary_reads(session=None):
+    """ Runs the statements of the block on the primary in a read_replica view (replicas.py).
+        For reads that fill a cache: a lagging replica would put a stale row in it.
+    """
+
+    info = (session or db.session).info
+    read_replica = info.pop("read_replica", False)
+    try:
+        yield
+    finally:
+        info["read_replica"] = read_replica
+
+
+def cupcake_cache_entry(cupcake):
+    """ Returns the cupcake_cache value for the Cupcake cupcake (None stays None). """
+
+    if (cupcake):
+        return {
+            "cupcake": cupcake.serialize(),
+            "version": cupcake.version,
+            "updated_at": cupcake.updated_at.isoformat()
+        }
+    return None
+
+
+def db_stream_cupcakes(fields=CUPCAKE_COLUMNS, batch_size=1000):
+    """ Generator over every cupcake ordered by id, yielded as dictionaries with the
+        columns in fields (id is always included).
+
+        Rows are read through a server side cursor batch_size rows at a time so memory use
+        does not grow with the size of the cupcakes table.
+    """
+
+    keys = ["id"] + [field for field in fields if field != "id"]
+    columns = [getattr(Cupcake, key) for key in keys]
+
+    query = db.session.query(*columns).order_by(Cupcake.id).yield_per(batch_size)
+    for row in query:
+        yield dict(zip(keys, row))
+
+
+def rating_bucket(rating):
+    """ Returns the cupcake_stats rating bucket of rating. """
+
+    return math.floor(rating / RATING_BUCKET) * RATING_BUCKET
+
+
+def cupcake_stats_key(cupcake):
+    """ Returns (size, flavor, rating bucket, rating) for a serialized cupcake: its
+        cupcake_stats group and the exact rating the group's rating_sum changes by.
+    """
+
+    rating = float(cupcake["rating"])
+    return (cupcake["size"], cupcake["flavor"], rating_bucket(rating), rating)
+
+
+def cupcake_stats_deltas(removed=(), added=()):
+    """ Returns a Counter of cupcake_stats_key -> change in count for the serialized
+        cupcakes removed and added by a write.
+    """
+
+    deltas = Counter(cupcake_stats_key(cupcake) for cupcake in added)
+    deltas.subtract(cupcake_stats_key(cupcake) for cupcake in removed)
+    return deltas
+
+
+def upsert_statement(table, dialect):
+    """ Returns an INSERT for table that supports on_conflict_do_update on dialect. """
+
+    if (dialect.name == "postgresql"):
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def db_adjust_cupcake_stats(deltas, session=None):
+    """ Applies deltas from cupcake_stats_deltas to the cupcake_stats table with one upsert
+        per group and removes groups whose count drops to 0. Runs in the caller's
+        transaction; the caller commits.
+
+        session defaults to db.session. The async app passes the sync session of its
+        AsyncSession (AsyncSession.run_sync).
+    """
+
+    session = session or db.session
+
+    # (size, flavor, rating bucket) -> [change in count, change in rating_sum]. A rating
+    #  changed within its bucket only changes rating_sum.
+    groups = {}
+    for (size, flavor, bucket, rating), count in deltas.items():
+        group = groups.setdefault((size, flavor, bucket), [0, 0.0])
+        group[0] += count
+        group[1] += count * rating
+
+    # keys are written in a fixed order so concurrent writers lock rows in the same order.
+    changes = sorted((key, count, rating_sum) for key, (count, rating_sum) in groups.items()
+                     if count != 0 or rating_sum != 0)
+    if (len(changes) == 0):
+        return
+
+    stats_table = CupcakeStat.__table__
+    insert = upsert_statement(stats_table, session.bind.dialect)
+    statement = insert.on_conflict_do_update(
+        index_elements=["size", "flavor", "rating_bucket"],
+        set_={"count": stats_table.c.count + insert.excluded["count"],
+              "rating_sum": stats_table.c.rating_sum + insert.excluded["rating_sum"]})
+
+    session.execute(statement, [{"size": size, "flavor": flavor, "rating_bucket": bucket,
+                                 "count": count, "rating_sum": rating_sum}
+                                for (size, flavor, bucket), count, rating_sum in changes])
+
+    removed = [key for key, count, rating_sum in changes if count < 0]
+    if (removed):
+        session.execute(stats_table.delete()
+                        .where(stats_table.c.count <= 0)
+                        .where(db.tuple_(stats_table.c.size, stats_table.c.flavor,
+                                         stats_table.c.rating_bucket).in_(removed)))
+
+
+# pg_advisory_xact_lock key held while change rows are written.
+CHANGE_LOG_LOCK = 0x63757063
+
+
+def record_cupcake_changes(op, cupcakes, session=None):
+    """ Adds a cupcake_changes row with op for each serialized cupcake in cupcakes (for a
+        reload, one row without a cupcake). Runs in the caller's transaction; the caller
+        commits. session defaults to db.session.
+
+        On PostgreSQL the rows are written under a transaction level advisory lock, so
+        change log transactions commit in seq order and a reader never sees seq n + 1
+        before seq n.
+    """
+
+    session = session or db.session
+
+    if (op == "reload"):
+        rows = [{"op": op, "cupcake_id": None, "cupcake": None}]
+    else:
+        rows = [{"op": op, "cupcake_id": cupcake["id"],
+                 "cupcake": None if op == "delete" else {column: cupcake[column] for column in CUPCAKE_COLUMNS}}
+                for cupcake in cupcakes]
+    if (len(rows) == 0):
+        return
+
+    if (session.bind.dialect.name == "postgresql"):
+        session.execute(db.select([db.func.pg_advisory_xact_lock(CHANGE_LOG_LOCK)]))
+
+    changed_at = datetime.utcnow()
+    session.execute(CupcakeChange.__table__.insert(),
+                    [{**row, "changed_at": changed_at} for row in rows])
+
+
+def db_latest_change_seq(session=None):
+    """ Returns the seq of the newest cupcake change, 0 when there are none. """
+
+    session = session or db.session
+    return session.query(db.func.coalesce(db.func.max(CupcakeChange.seq), 0)).scalar()
+
+
+def db_latest_change():
+    """ Returns (seq, changed_at) of the newest cupcake change, (0, None) when there are
+        none. Any write to the cupcakes gives a new value, also after the tables were
+        recreated (a new changed_at), so it can key caches of rendered cupcakes.
+    """
+
+    row = (db.session.query(CupcakeChange.seq, CupcakeChange.changed_at)
+           .order_by(CupcakeChange.seq.desc())
+           .first())
+    return (row.seq, row.changed_at) if row else (0, None)
+
+
+def db_list_cupcake_changes(since=None, limit=500, session=None):
+    """ Returns the cupcake changes after seq since, oldest first, at most limit changes.
+
+        Changes to the same cupcake are combined: only its latest change is returned, so a
+        client applying them in order ends with the current state of each cupcake.
+
+        Returns {"changes": [{seq, op, id, cupcake}, ...], "cursor": seq to pass as since
+        next time, "more": True when changes after cursor remain, "reset": True when the
+        client must read every cupcake again, then continue from cursor}. reset is True
+        when since is None (a first sync), is newer than the log (the tables were
+        recreated), or the changes include a reload.
+    """
+
+    session = session or db.session
+    latest = db_latest_change_seq(session)
+
+    if (since is None or since > latest):
+        return {"changes": [], "cursor": latest, "more": False, "reset": True}
+
+    rows = (session.query(CupcakeChange)
+            .filter(CupcakeChange.seq > since)
+            .order_by(CupcakeChange.seq)
+            .limit(limit + 1)
+            .all())
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    for index, row in enumerate(rows):
+        if (row.op == "reload"):
+            # every change before the reload is covered by reading everything again.
+            return {"changes": [], "cursor": row.seq,
+                    "more": index + 1 < len(rows) or more, "reset": True}
+
+    latest_changes = {}
+    for row in rows:
+        latest_changes.pop(row.cupcake_id, None)
+        latest_changes[row.cupcake_id] = row
+
+    return {
+        "changes": [row.serialize() for row in latest_changes.values()],
+        "cursor": rows[-1].seq if rows else since,
+        "more": more,
+        "reset": False
+    }
+
+
+def db_rebuild_cupcake_stats():
+    """ Recomputes the cupcake_stats table from the cupcakes table and commits. Used after
+        cupcakes are written without the functions in this module, for example by seed.py,
+        so it also records a reload change: change feed clients read every cupcake again.
+    """
+
+    stats_table = CupcakeStat.__table__
+    bucket = db.func.floor(Cupcake.rating / RATING_BUCKET) * RATING_BUCKET
+    db.session.execute(stats_table.delete())
+    db.session.execute(stats_table.insert().from_select(
+        ["size", "flavor", "rating_bucket", "count", "rating_sum"],
+        db.select([Cupcake.size, Cupcake.flavor, bucket, db.func.count(), db.func.sum(Cupcake.rating)])
+        .group_by(Cupcake.size, Cupcake.flavor, bucket)))
+    record_cupcake_changes("reload", ())
+    db.session.commit()
+    suggest_index.invalidate()
+
+
+def summarize_ratings(groups):
+    """ Returns {count, mean, min, max, histogram} for a list of (rating bucket, count,
+        rating_sum) tuples. The mean is exact; min, max and the histogram keys are
+        rating buckets.
+    """
+
+    count = sum(group_count for bucket, group_count, rating_sum in groups)
+    if (count == 0):
+        return {"count": 0, "mean": None, "min": None, "max": None, "histogram": {}}
+
+    histogram = Counter()
+    for bucket, group_count, rating_sum in groups:
+        histogram[bucket] += group_count
+
+    return {
+        "count": count,
+        "mean": sum(rating_sum for bucket, group_count, rating_sum in groups) / count,
+        "min": min(histogram),
+        "max": max(histogram),
+        "histogram": {str(rating): histogram[rating] for rating in sorted(histogram)}
+    }
+
+
+def db_get_cupcake_stats(session=None):
+    """ Returns cupcake statistics from the cupcake_stats table:
+
+        {count, mean, min, max, histogram} for all cupcakes, plus the same summary for
+        each size in sizes and each flavor in flavors. histogram is {rating bucket: count}
+        and min / max are the lowest and highest rating buckets (ratings rounded down to
+        a multiple of RATING_BUCKET); the mean is exact.
+        The work depends on the number of size / flavor / rating groups, not on the
+        number of cupcakes. session defaults to db.session.
+    """
+
+    session = session or db.session
+    by_size = {}
+    by_flavor = {}
+    all_groups = []
+    for stat in session.query(CupcakeStat.size, CupcakeStat.flavor, CupcakeStat.rating_bucket,
+                              CupcakeStat.count, CupcakeStat.rating_sum):
+        group = (stat.rating_bucket, stat.count, stat.rating_sum)
+        all_groups.append(group)
+        by_size.setdefault(stat.size, []).append(group)
+        by_flavor.setdefault(stat.flavor, []).append(group)
+
+    return {
+        **summarize_ratings(all_groups),
+        "sizes": {size: summarize_ratings(groups) for size, groups in sorted(by_size.items())},
+        "flavors": {flavor: summarize_ratings(groups) for flavor, groups in sorted(by_flavor.items())}
+    }
+
+
+def clean_cupcake_spec(cupcake_spec_in):
+    """ Returns a new dictionary with the values in cupcake_spec_in where strings are 
+        stripped and blank strings are changed to None so column defaults apply.
+    """
+
     cupcake_spec = {}
     for key in cupcake_spec_in.keys():
         if (type(cupcake_spec_in[key]) == str):
@@ -80,33 +794,211 @@ def db_add_cupcake(cupcake_spec_in):
         else:
             cupcake_spec[key] = cupcake_spec_in[key]
 
-    new_cupcake = Cupcake(**cupcake_spec)
-    # new_cupcake = Cupcake(flavor=cupcake_spec["flavor"], size=cupcake_spec["size"],
-    #                       rating=cupcake_spec["rating"], image=cupcake_spec["image"])
+    return cupcake_spec
+
+
+def missing_values_message(cupcake_spec):
+    """ Returns the add error message when flavor, size or rating do not have a value in
+        the cleaned cupcake_spec, otherwise returns None.
+    """
+
+    if ((cupcake_spec["flavor"] == None) or (cupcake_spec["size"] == None) or
+            (cupcake_spec["rating"] == None)):
+        msg_fields = f"flavor='{str(cupcake_spec['flavor'])}', size='{str(cupcake_spec['size'])}', rating={str(cupcake_spec['rating'])}."
+        return f"An error occurred. Non-blank values required for flavor, size, and rating. {msg_fields.replace('''None''', '')}"
+
+    return None
+
+
+def create_error_message(cupcake_spec_in, errors):
+    """ Returns the add error message for the validate_cupcake_create errors of
+        cupcake_spec_in. Missing required values use missing_values_message.
+    """
+
+    name, kind = first_error(errors)
+    if (name == "_"):
+        return f"An error occurred. {errors[name][1]}"
+
+    if (kind in (MISSING, BLANK)):
+        return missing_values_message(clean_cupcake_spec(
+            {key: cupcake_spec_in.get(key, '') for key in CUPCAKE_FIELDS.keys()}))
+
+    return f"An error occurred. {name}: {errors[name][1]}"
+
+
+def update_error_message(cupcake_id, cupcake_edits_in, errors):
+    """ Returns the update error message for the validate_cupcake_update errors of
+        cupcake_edits_in.
+    """
+
+    name, kind = first_error(errors)
+    if (name == "_"):
+        return f"Update Error: {errors[name][1]} No updates occurred."
+
+    if (kind == MISSING):
+        return f"Update Error: All fields require a value. {name} had a value of None. No updates occurred."
+
+    if (kind == BLANK):
+        return f"Update Error: Error: A non-blank value is required for {name}. No updates occurred."
+
+    return f"Update Error: An error occurred while updating {cupcake_id}: {cupcake_edits_in.get('flavor')}. No updates occurred."
+
+
+def db_add_cupcake(cupcake_spec_in, writer=None):
+    """ adds a cupcate to the cupcakes table
+
+        writer is an optional group_commit.GroupCommitWriter: the cupcake is then written
+        together with the cupcakes of concurrent requests, with the same results. When the
+        writer does not answer within its timeout, the cupcake is written directly, or the
+        result has response_code 503 when the writer had already started on it.
+    """
+
+    # print(
+    #     f"\n\nMODEL db_add_cupcake: cupcake_spec = {cupcake_spec_in}", flush=True)
+
+    # values are checked, stripped and converted before a session is used. Blank optional
+    #  values are left out so column defaults apply.
+    validation = validate_cupcake_create(cupcake_spec_in)
+    if (validation.errors):
+        return {
+            "message": create_error_message(cupcake_spec_in, validation.errors),
+            "fields": field_messages(validation.errors),
+            "successful": False
+        }
+
+    cupcake_spec = {key: value for key, value in validation.values.items()
+                    if value is not None}
+
+    if (writer is None):
+        return db_add_validated_cupcakes([cupcake_spec])[0]
 
     try:
-        db.session.add(new_cupcake)
+        return writer.wait(writer.submit(cupcake_spec))
+    except WriterTimeout as e:
+        if (e.cancelled):
+            # the writer never started on it, so it is written here instead.
+            return db_add_validated_cupcakes([cupcake_spec])[0]
+        return {"message": "An error occurred. The cupcake could not be saved in time; it may or may not have been added.",
+                "successful": False,
+                "response_code": 503}
+    except:
+        return {"message": "An error occurred.", "successful": False}
+
+
+def db_add_validated_cupcakes(cupcake_specs):
+    """ Adds cupcakes checked by validate_cupcake_create in one transaction. Returns a
+        db_add_cupcake result for each spec, in order.
+
+        When the transaction fails, each cupcake is tried again in a transaction of its
+        own, so one bad cupcake only fails its own result.
+    """
+
+    try:
+        new_cupcakes = [Cupcake(**cupcake_spec) for cupcake_spec in cupcake_specs]
+        db.session.add_all(new_cupcakes)
+        db.session.flush()
+        new_serialized = [new_cupcake.serialize() for new_cupcake in new_cupcakes]
+        db_adjust_cupcake_stats(cupcake_stats_deltas(added=new_serialized))
+        record_cupcake_changes("create", new_serialized)
         db.session.commit()
+        cupcake_cache.invalidate(*[new_cupcake["id"] for new_cupcake in new_serialized])
+        suggest_index.apply(added=new_serialized)
 
-        results = {
-            "message": new_cupcake.serialize()}
-        results["successful"] = True
+        return [{"message": new_cupcake, "successful": True} for new_cupcake in new_serialized]
 
     except:
-        # will check whether required values were provided.
-        if ((cupcake_spec["flavor"] == None) or (cupcake_spec["size"] == None) or
-                (cupcake_spec["rating"] == None)):
-            msg_fields = f"flavor='{str(cupcake_spec['flavor'])}', size='{str(cupcake_spec['size'])}', rating={str(cupcake_spec['rating'])}."
-            results = {
-                "message": f"An error occurred. Non-blank values required for flavor, size, and rating. {msg_fields.replace('''None''', '')}"}
+        db.session.rollback()
+
+    if (len(cupcake_specs) > 1):
+        return [db_add_validated_cupcakes([cupcake_spec])[0] for cupcake_spec in cupcake_specs]
+
+    return [{"message": "An error occurred.", "successful": False}]
 
+
+# number of cupcakes inserted per INSERT batch by db_add_cupcakes.
+BULK_INSERT_CHUNK_SIZE = 1000
+
+
+def db_add_cupcakes(cupcake_specs_in, chunk_size=BULK_INSERT_CHUNK_SIZE):
+    """ Adds a list of cupcakes to the cupcakes table in a single transaction.
+
+        Every item is checked with the same rules as db_add_cupcake before anything is
+        written. When any item has an issue, nothing is added. Valid lists are inserted
+        chunk_size rows per flush, which the psycopg2 dialect sends as batched
+        INSERT .. VALUES .. RETURNING id statements, and committed once.
+
+        On success, message is a list of {index, id} in the order of cupcake_specs_in.
+        On an error, message is the error message and items is a list of {index, message}
+        for every item with an issue.
+
+    """
+
+    cupcake_specs = []
+    items = []
+    for index, cupcake_spec_in in enumerate(cupcake_specs_in):
+        validation = validate_cupcake_create(cupcake_spec_in)
+        if (validation.errors):
+            items.append({"index": index,
+                          "message": create_error_message(cupcake_spec_in, validation.errors),
+                          "fields": field_messages(validation.errors)})
         else:
-            results = {"message": "An error occurred."}
+            cupcake_specs.append({key: value for key, value in validation.values.items()
+                                  if value is not None})
+
+    if (items):
+        return {
+            "message": f"An error occurred. {len(items)} of {len(cupcake_specs_in)} cupcakes had errors. No cupcakes were added.",
+            "items": items,
+            "successful": False,
+            "response_code": 400
+        }
+
+    if (len(cupcake_specs) == 0):
+        return {
+            "message": "An error occurred. No cupcakes were provided.",
+            "items": [],
+            "successful": False,
+            "response_code": 400
+        }
+
+    created = []
+    new_serialized = []
+    stats_deltas = Counter()
+    try:
+        for start in range(0, len(cupcake_specs), chunk_size):
+            new_cupcakes = [Cupcake(**cupcake_spec)
+                            for cupcake_spec in cupcake_specs[start:start + chunk_size]]
+            db.session.add_all(new_cupcakes)
+            db.session.flush()
+            stats_deltas.update(cupcake_stats_deltas(
+                added=cupcake_specs[start:start + chunk_size]))
+
+            created.extend({"index": start + offset, "id": new_cupcake.id}
+                           for offset, new_cupcake in enumerate(new_cupcakes))
+            new_serialized.extend(new_cupcake.serialize() for new_cupcake in new_cupcakes)
+
+        db_adjust_cupcake_stats(stats_deltas)
+        record_cupcake_changes("create", new_serialized)
+        db.session.commit()
+        cupcake_cache.invalidate(*[item["id"] for item in created])
+        suggest_index.apply(added=new_serialized)
 
-        results["successful"] = False
+        results = {
+            "message": created,
+            "successful": True,
+            "response_code": 201
+        }
 
+    except:
         db.session.rollback()
 
+        results = {
+            "message": "An error occurred. No cupcakes were added.",
+            "items": [],
+            "successful": False,
+            "response_code": 400
+        }
+
     return results
 
 
@@ -153,107 +1045,239 @@ def change_occurred(from_vals, to_vals):
     return results
 
 
-def db_update_cupcake(cupcake_id, cupcake_edits_in):
-    """ Updates the cupcake when changes have occurred.
+def version_mismatch_results(cupcake_id):
+    """ Returns the update results for an If-Match version that is not current. """
 
-        cupcake_id is the id of the cupcake getting updated. cupcake edits is a dictionary 
-        containing the updatable fields and values for the cupcake record update.
+    return {
+        "message": f"Update Error: Cupcake id={cupcake_id} was changed by another request. No updates occurred.",
+        "successful": False,
+        "response_code": 412
+    }
+
+
+def read_cupcake_row(cupcake_id):
+    """ Returns the (id, flavor, size, rating, image, version) row for cupcake_id or None. """
 
+    columns = [getattr(Cupcake, column) for column in CUPCAKE_COLUMNS]
+    return db.session.query(*columns, Cupcake.version).filter(Cupcake.id == cupcake_id).first()
+
+
+def update_precondition_results(cupcake_id, row, expected_version=None):
+    """ Returns the 404 (row is None) or 412 (row is not expected_version) update results,
+        or None when neither applies.
     """
 
-    db_cupcake = Cupcake.query.get(cupcake_id)
+    if (row is None):
+        return {
+            "message": f"Update Error: Cupcake id={cupcake_id} was not found. No updates occurred.",
+            "successful": False,
+            "response_code": 404
+        }
+
+    if (expected_version is not None and row.version != expected_version):
+        return version_mismatch_results(cupcake_id)
 
-    if (db_cupcake):
+    return None
 
-        # remove leading / trailing spaces and save into a new dictionary.
-        cupcake_edits = {}
-        for key in cupcake_edits_in.keys():
-            # Check for None. All fields are required and cannot be None.
-            if (cupcake_edits_in[key] == None):
-                # we are done. All fields are required to have values. Return
-                results = {
-                    "message": f"Update Error: All fields require a value. {key} had a value of None. No updates occurred."}
-                results["successful"] = False
-                results["response_code"] = 400
-                return results
 
-            else:
-                if (type(cupcake_edits_in[key]) == str):
-                    cupcake_edits[key] = cupcake_edits_in[key].strip()
+def update_cupcake_returning(cupcake_edits, expected_version=None):
+    """ Writes cupcake_edits with one UPDATE .. FROM (old values FOR UPDATE) .. RETURNING
+        statement. Nothing is written when the cupcake does not exist, is not
+        expected_version or already has the values.
 
-                else:
-                    cupcake_edits[key] = cupcake_edits_in[key]
+        Returns (previous {size, flavor, rating}, cupcake, version) or None when nothing
+        was written.
+    """
 
-        # add in id before we check for changes across the entire record.
-        cupcake_edits["id"] = int(cupcake_id)
+    cupcakes_table = Cupcake.__table__
+    edits = {key: cupcake_edits[key] for key in CUPCAKE_FIELDS.keys()}
+
+    # values before the update for cupcake_stats. The row lock makes a concurrent update
+    #  wait so these are the values this update replaces.
+    old = (db.select([cupcakes_table.c.id, cupcakes_table.c.size,
+                      cupcakes_table.c.flavor, cupcakes_table.c.rating])
+           .where(cupcakes_table.c.id == cupcake_edits["id"])
+           .with_for_update()
+           .subquery("old"))
+
+    conditions = [cupcakes_table.c.id == old.c.id,
+                  db.or_(*[cupcakes_table.c[key].is_distinct_from(value)
+                           for key, value in edits.items()])]
+    if (expected_version is not None):
+        conditions.append(cupcakes_table.c.version == expected_version)
+
+    statement = (cupcakes_table.update()
+                 .where(*conditions)
+                 .values(version=cupcakes_table.c.version + 1, **edits)
+                 .returning(*[cupcakes_table.c[column] for column in CUPCAKE_COLUMNS],
+                            cupcakes_table.c.version,
+                            old.c.size.label("old_size"),
+                            old.c.flavor.label("old_flavor"),
+                            old.c.rating.label("old_rating")))
+
+    row = db.session.execute(statement).first()
+    if (row is None):
+        return None
+
+    previous = {"size": row.old_size, "flavor": row.old_flavor, "rating": row.old_rating}
+    cupcake = {column: row._mapping[column] for column in CUPCAKE_COLUMNS}
+
+    return (previous, cupcake, row.version)
+
+
+def update_cupcake_checked(cupcake_edits, expected_version=None):
+    """ update_cupcake_returning for databases without RETURNING: reads the cupcake, then
+        writes it with an UPDATE that only matches the version read. StaleDataError is
+        raised when another request changed the cupcake in between.
+    """
 
-        data_check = change_occurred(db_cupcake.serialize(), cupcake_edits)
+    row = read_cupcake_row(cupcake_edits["id"])
+    if (update_precondition_results(cupcake_edits["id"], row, expected_version)):
+        return None
 
-        if (data_check["changed"]):
+    previous = {column: row._mapping[column] for column in CUPCAKE_COLUMNS}
+    if (not change_occurred(previous, cupcake_edits)["changed"]):
+        return None
 
-            db_cupcake.flavor = cupcake_edits["flavor"]
-            db_cupcake.size = cupcake_edits["size"]
-            db_cupcake.rating = cupcake_edits["rating"]
-            db_cupcake.image = cupcake_edits["image"]
+    cupcakes_table = Cupcake.__table__
+    edits = {key: cupcake_edits[key] for key in CUPCAKE_FIELDS.keys()}
+    result = db.session.execute(cupcakes_table.update()
+                                .where(cupcakes_table.c.id == row.id,
+                                       cupcakes_table.c.version == row.version)
+                                .values(version=row.version + 1, **edits))
+    if (result.rowcount == 0):
+        raise StaleDataError(f"Cupcake id={row.id} changed during the update.")
 
-            try:
-                # yes, we need a try to catch stuffing a sting into a float.
-                db.session.commit()
+    return (previous, {"id": row.id, **edits}, row.version + 1)
 
-                results = {
-                    "message": db_cupcake.serialize(),
-                    "successful": True,
-                    "response_code": 200
-                }
-            except:
-                db.session.rollback()
 
-                results = {
-                    "message": f"Update Error: An error occurred while updating {db_cupcake.id}: {db_cupcake.flavor}. No updates occurred.",
-                    "successful": False,
-                    "response_code": 400
-                }
+def db_update_cupcake(cupcake_id, cupcake_edits_in, expected_version=None):
+    """ Updates the cupcake when changes have occurred.
+
+        cupcake_id is the id of the cupcake getting updated. cupcake edits is a dictionary 
+        containing the updatable fields and values for the cupcake record update.
+
+        expected_version is the row version the client last read (If-Match). When it is
+        provided and the cupcake has a different version, or the cupcake changes before
+        the commit, no update occurs and response_code is 412.
+
+        On success, version holds the row version of the returned cupcake.
 
+        The edits are validated before the database is used; a 400 result also has
+        fields, {field: message} for every invalid field. On PostgreSQL a cupcake with
+        changes is written and read back with a single UPDATE .. RETURNING statement; the
+        cupcake is only read on its own when there was nothing to write or an error.
+
+    """
+
+    cupcake_id = int(cupcake_id)
+
+    # bad edits are rejected before a session is used.
+    validation = validate_cupcake_update(cupcake_edits_in)
+    if (validation.errors):
+        return {
+            "message": update_error_message(cupcake_id, cupcake_edits_in, validation.errors),
+            "fields": field_messages(validation.errors),
+            "successful": False,
+            "response_code": 400
+        }
+
+    cupcake_edits = {"id": cupcake_id, **validation.values}
+    write_error = False
+
+    try:
+        if (returning_supported()):
+            written = update_cupcake_returning(cupcake_edits, expected_version)
         else:
-            if (len(data_check["message"]) == 0):
-                # no changes and message is "". There were no data issues.
-                results = {
-                    "message": db_cupcake.serialize(),
-                    "successful": True,
-                    "response_code": 200
-                }
-            else:
-                # An error occurred with the data while comparing in change_occurred.
-                results = {
-                    "message": f"Update Error: { data_check['message'] }",
-                    "successful": False,
-                    "response_code": 400
-                }
+            written = update_cupcake_checked(cupcake_edits, expected_version)
 
-    else:
-        results = {
-            "message": f"Update Error: Cupcake id={cupcake_id} was not found. No updates occurred.",
+        if (written):
+            previous, cupcake, version = written
+            db_adjust_cupcake_stats(cupcake_stats_deltas(
+                removed=[previous], added=[cupcake]))
+            record_cupcake_changes("update", [cupcake])
+            db.session.commit()
+            cupcake_cache.invalidate(cupcake_id)
+            suggest_index.apply(removed=[previous], added=[cupcake])
+
+            return {"message": cupcake, "version": version, "successful": True, "response_code": 200}
+
+    except StaleDataError:
+        # another request updated or deleted the cupcake after we read it.
+        db.session.rollback()
+        return version_mismatch_results(cupcake_id)
+
+    except:
+        db.session.rollback()
+        write_error = True
+
+    # nothing was written. Not found and version mismatches are reported before data issues.
+    row = read_cupcake_row(cupcake_id)
+    results = update_precondition_results(cupcake_id, row, expected_version)
+    if (results):
+        return results
+
+    if (write_error):
+        return {
+            "message": f"Update Error: An error occurred while updating {row.id}: {row.flavor}. No updates occurred.",
             "successful": False,
-            "response_code": 404
+            "response_code": 400
         }
 
-    return results
+    # no changes. There were no data issues.
+    return {
+        "message": {column: row._mapping[column] for column in CUPCAKE_COLUMNS},
+        "version": row.version,
+        "successful": True,
+        "response_code": 200
+    }
 
 
-def db_delete_cupcake(cupcake_id):
-    """ deletes a cupcate to the cupcakes table """
+def delete_cupcake_rows(cupcake_ids):
+    """ Deletes the cupcakes with ids in cupcake_ids with a DELETE .. RETURNING statement and
+        returns the deleted cupcakes as dictionaries. Databases without RETURNING read the
+        cupcakes first. The caller commits.
+    """
+
+    cupcakes_table = Cupcake.__table__
+    columns = [cupcakes_table.c[column] for column in CUPCAKE_COLUMNS]
+    statement = cupcakes_table.delete().where(cupcakes_table.c.id.in_(cupcake_ids))
 
-    del_cupcake = Cupcake.query.get(cupcake_id)
+    if (returning_supported()):
+        rows = db.session.execute(statement.returning(*columns)).all()
+    else:
+        rows = db.session.execute(db.select(columns).where(
+            cupcakes_table.c.id.in_(cupcake_ids))).all()
+        db.session.execute(statement)
 
-    if (del_cupcake):
-        msg_historical = del_cupcake.serialize()
+    # Cupcake instances of the deleted rows leave the session, like after session.delete().
+    for row in rows:
+        instance = db.session.identity_map.get(identity_key(Cupcake, row.id))
+        if (instance is not None):
+            db.session.expunge(instance)
 
-        db.session.delete(del_cupcake)
+    return [row._asdict() for row in rows]
 
-        try:
+
+def db_delete_cupcake(cupcake_id):
+    """ deletes a cupcate to the cupcakes table
+
+        On PostgreSQL the cupcake is deleted and returned by one DELETE .. RETURNING
+        statement.
+    """
+
+    try:
+        deleted = delete_cupcake_rows([int(cupcake_id)])
+        if (deleted):
+            msg_historical = deleted[0]
+            db_adjust_cupcake_stats(
+                cupcake_stats_deltas(removed=[msg_historical]))
+            record_cupcake_changes("delete", deleted)
             db.session.commit()
+            cupcake_cache.invalidate(msg_historical["id"])
+            suggest_index.apply(removed=deleted)
 
-            results = {
+            return {
                 "message": {
                     "message": {
                         "deleted": msg_historical
@@ -263,10 +1287,13 @@ def db_delete_cupcake(cupcake_id):
                 "response_code": 200
             }
 
-        except:
-            db.session.commit()
+    except:
+        db.session.rollback()
 
-            results = {
+        row = read_cupcake_row(cupcake_id)
+        if (row):
+            msg_historical = {column: row._mapping[column] for column in CUPCAKE_COLUMNS}
+            return {
                 "message": {
                     "error": {
                         "message": f"An error occurred while deleting {str(msg_historical)}. No delete occurred. "
@@ -276,11 +1303,215 @@ def db_delete_cupcake(cupcake_id):
                 "response_code": 400
             }
 
-    else:
-        results = {
-            "message": {"error": {"message": f"Cupcake id={cupcake_id} was not found. No delete occurred. "}},
-            "successful": False,
-            "response_code": 404
-        }
+    return {
+        "message": {"error": {"message": f"Cupcake id={cupcake_id} was not found. No delete occurred. "}},
+        "successful": False,
+        "response_code": 404
+    }
+
+
+def returning_supported():
+    """ True when the database accepts UPDATE / DELETE .. RETURNING (PostgreSQL). """
+
+    return db.engine.dialect.full_returning
+
+
+def is_cupcake_id(cupcake_id):
+    """ True when cupcake_id is an int or a string holding an integer. """
+
+    return (type(cupcake_id) == int) or (type(cupcake_id) == str and cupcake_id.isnumeric())
+
+
+def db_update_cupcakes(cupcake_edits_list):
+    """ Updates many cupcakes. cupcake_edits_list is a list of dictionaries with the id of
+        the cupcake plus flavor, size, rating and image, the same fields db_update_cupcake
+        requires.
+
+        All current values are read and locked with one SELECT .. WHERE id IN (..) FOR UPDATE
+        and the cupcakes that changed are written with a single executemany UPDATE in the
+        same transaction. The lock makes concurrent updates of the same cupcakes wait, so
+        the values read are the ones replaced and the cupcake_stats deltas are exact.
+
+        Returns a list with one result per item in the order of cupcake_edits_list. Each
+        result has id, response_code and either cupcake (200) or error: {message} (400/404),
+        using the same messages, fields and no-change detection as db_update_cupcake.
+
+    """
+
+    results = [None] * len(cupcake_edits_list)
+    seen = set()
+    checked = {}
+    edits = {}
+    for index, cupcake_edits_in in enumerate(cupcake_edits_list):
+        cupcake_id = cupcake_edits_in.get("id") if (
+            type(cupcake_edits_in) == dict) else None
+
+        if (not is_cupcake_id(cupcake_id)):
+            results[index] = {
+                "id": cupcake_id,
+                "response_code": 404,
+                "error": {"message": f"Update Error: Cupcake id='{cupcake_id}' was not an integer. No updates occurred."}
+            }
+            continue
+
+        cupcake_id = int(cupcake_id)
+        if (cupcake_id in seen):
+            results[index] = {
+                "id": cupcake_id,
+                "response_code": 400,
+                "error": {"message": f"Update Error: Cupcake id={cupcake_id} was provided more than once. No updates occurred."}
+            }
+            continue
+        seen.add(cupcake_id)
+
+        # bad edits are reported without reading the cupcake.
+        validation = validate_cupcake_update(cupcake_edits_list[index])
+        if (validation.errors):
+            results[index] = {
+                "id": cupcake_id,
+                "response_code": 400,
+                "error": {"message": update_error_message(cupcake_id, cupcake_edits_list[index], validation.errors),
+                          "fields": field_messages(validation.errors)}
+            }
+            continue
+
+        checked[index] = cupcake_id
+        edits[index] = {"id": cupcake_id, **validation.values}
+
+    rows = {}
+    if (checked):
+        # rows are locked in id order so concurrent bulk updates cannot deadlock.
+        columns = [getattr(Cupcake, column) for column in CUPCAKE_COLUMNS]
+        query = (db.session.query(*columns)
+                 .filter(Cupcake.id.in_(checked.values()))
+                 .order_by(Cupcake.id)
+                 .with_for_update())
+        try:
+            for row in query:
+                rows[row.id] = row._asdict()
+        except:
+            db.session.rollback()
+            raise
+
+    changed = {}
+    for index, cupcake_id in checked.items():
+        if (cupcake_id not in rows):
+            results[index] = {
+                "id": cupcake_id,
+                "response_code": 404,
+                "error": {"message": f"Update Error: Cupcake id={cupcake_id} was not found. No updates occurred."}
+            }
+        elif (change_occurred(rows[cupcake_id], edits[index])["changed"]):
+            changed[index] = edits[index]
+        else:
+            results[index] = {"id": cupcake_id, "response_code": 200,
+                              "cupcake": rows[cupcake_id]}
+
+    if (checked and not changed):
+        # nothing to write; release the row locks.
+        db.session.rollback()
+
+    if (changed):
+        cupcakes_table = Cupcake.__table__
+        statement = (cupcakes_table.update()
+                     .where(cupcakes_table.c.id == db.bindparam("b_id"))
+                     .values(version=cupcakes_table.c.version + 1,
+                             **{key: db.bindparam(f"b_{key}") for key in CUPCAKE_FIELDS.keys()}))
+
+        try:
+            db.session.execute(statement, [
+                {f"b_{key}": value for key, value in cupcake_edits.items()}
+                for cupcake_edits in changed.values()])
+            db_adjust_cupcake_stats(cupcake_stats_deltas(
+                removed=[rows[cupcake_edits["id"]]
+                         for cupcake_edits in changed.values()],
+                added=changed.values()))
+            record_cupcake_changes("update", changed.values())
+            db.session.commit()
+            cupcake_cache.invalidate(*[cupcake_edits["id"]
+                                       for cupcake_edits in changed.values()])
+            suggest_index.apply(removed=[rows[cupcake_edits["id"]]
+                                         for cupcake_edits in changed.values()],
+                                added=changed.values())
+
+            for index, cupcake_edits in changed.items():
+                results[index] = {"id": cupcake_edits["id"], "response_code": 200,
+                                  "cupcake": {column: cupcake_edits[column] for column in CUPCAKE_COLUMNS}}
+
+        except:
+            db.session.rollback()
+
+            for index, cupcake_edits in changed.items():
+                results[index] = {
+                    "id": cupcake_edits["id"],
+                    "response_code": 400,
+                    "error": {"message": f"Update Error: An error occurred while updating {cupcake_edits['id']}: {cupcake_edits['flavor']}. No updates occurred."}
+                }
+
+    return results
+
+
+def db_delete_cupcakes(cupcake_ids):
+    """ Deletes many cupcakes with a single DELETE .. WHERE id IN (..) RETURNING statement.
+        Databases without RETURNING read the cupcakes first.
+
+        Returns a list with one result per id in the order of cupcake_ids. Each result has
+        id, response_code and either message: {deleted: {...}} (200) or
+        error: {message} (404), using the same messages as db_delete_cupcake. When the
+        delete fails nothing is deleted and every integer id gets error: {message} (400).
+
+    """
+
+    delete_ids = list({int(cupcake_id)
+                       for cupcake_id in cupcake_ids if is_cupcake_id(cupcake_id)})
+
+    deleted = {}
+    failed = False
+    if (delete_ids):
+        try:
+            rows = delete_cupcake_rows(delete_ids)
+
+            db_adjust_cupcake_stats(cupcake_stats_deltas(removed=rows))
+            record_cupcake_changes("delete", rows)
+            db.session.commit()
+            cupcake_cache.invalidate(*[row["id"] for row in rows])
+            suggest_index.apply(removed=rows)
+
+            deleted = {row["id"]: row for row in rows}
+
+        except:
+            db.session.rollback()
+            failed = True
+
+    results = []
+    for cupcake_id in cupcake_ids:
+        if (not is_cupcake_id(cupcake_id)):
+            results.append({
+                "id": cupcake_id,
+                "response_code": 404,
+                "error": {"message": f"Cupcake id='{cupcake_id}' was not an integer. No delete occurred. "}
+            })
+
+        elif (failed):
+            results.append({
+                "id": int(cupcake_id),
+                "response_code": 400,
+                "error": {"message": f"An error occurred while deleting cupcake id={cupcake_id}. No delete occurred. "}
+            })
+
+        elif (int(cupcake_id) in deleted):
+            # a repeated id reports the delete for each time it was listed.
+            results.append({
+                "id": int(cupcake_id),
+                "response_code": 200,
+                "message": {"deleted": deleted[int(cupcake_id)]}
+            })
+
+        else:
+            results.append({
+                "id": int(cupcake_id),
+                "response_code": 404,
+                "error": {"message": f"Cupcake id={cupcake_id} was not found. No delete occurred. "}
+            })
 
     return results
@@ -0,0 +1,121 @@
+"""Connection pool utilization metrics for the SQLAlchemy engines of the Cupcakes app."""
+
+import threading
+import time
+
+from sqlalchemy import event
+
+
+class PoolMetrics:
+    """ Counts connection pool events for one engine.
+
+        checkouts / checkins / connects / invalidations are running totals,
+        checked_out_peak is the most connections checked out at the same time, and
+        checkout_seconds the total time connections were held by the app. Together with the
+        pool size these show whether a worker's pool is too small (peak at
+        size + overflow, requests waiting) or too large (peak far below size).
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.counters = {"connects": 0, "checkouts": 0, "checkins": 0,
+                         "invalidations": 0, "checked_out": 0, "checked_out_peak": 0,
+                         "checkout_seconds": 0.0}
+        self.hooks = []
+
+        event.listen(engine, "connect", self.on_connect)
+        event.listen(engine, "checkout", self.on_checkout)
+        event.listen(engine, "checkin", self.on_checkin)
+        event.listen(engine, "invalidate", self.on_invalidate)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.counters["connects"] += 1
+        self.notify("connect")
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checkout_time"] = time.perf_counter()
+        with self.lock:
+            self.counters["checkouts"] += 1
+            self.counters["checked_out"] += 1
+            self.counters["checked_out_peak"] = max(self.counters["checked_out_peak"],
+                                                    self.counters["checked_out"])
+        self.notify("checkout")
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        # SQLAlchemy may check in a connection that no longer has a record (it was
+        #  invalidated or the pool was disposed); there is no checkout to account for.
+        if (connection_record is None):
+            return
+
+        checkout_time = connection_record.info.pop("checkout_time", None)
+        with self.lock:
+            self.counters["checkins"] += 1
+            # a connection that failed before it was checked out is checked in as well.
+            if (checkout_time is not None):
+                self.counters["checked_out"] -= 1
+                self.counters["checkout_seconds"] += time.perf_counter() - checkout_time
+        self.notify("checkin")
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.counters["invalidations"] += 1
+        self.notify("invalidate")
+
+    def notify(self, event_name):
+        """ Calls every hook with (event_name, status()). """
+
+        if (self.hooks):
+            status = self.status()
+            for hook in self.hooks:
+                hook(event_name, status)
+
+    def status(self):
+        """ Returns the counters plus the pool configuration and current state. """
+
+        pool = self.engine.pool
+        with self.lock:
+            status = {"url": self.engine.url.render_as_string(hide_password=True),
+                      "pool": type(pool).__name__, **self.counters}
+
+        # QueuePool (the PostgreSQL default) reports its size; other pools do not.
+        for name in ("size", "checkedin", "overflow", "timeout"):
+            method = getattr(pool, name, None)
+            if (callable(method)):
+                status[name] = method()
+        max_overflow = getattr(pool, "_max_overflow", None)
+        if (max_overflow is not None):
+            status["max_overflow"] = max_overflow
+
+        return status
+
+
+# PoolMetrics for every engine created by the app, by engine url.
+pool_metrics = {}
+# callables hook(event_name, status) added with add_pool_hook, called on every pool event.
+pool_hooks = []
+
+
+def track_engine(engine):
+    """ Starts collecting PoolMetrics for engine. """
+
+    metrics = PoolMetrics(engine)
+    metrics.hooks = pool_hooks
+    pool_metrics[metrics.status()["url"]] = metrics
+
+    return metrics
+
+
+def add_pool_hook(hook):
+    """ Registers hook(event_name, status) to be called on every connection pool event,
+        for example to send pool utilization to a metrics system.
+    """
+
+    pool_hooks.append(hook)
+
+
+def pool_status():
+    """ Returns the PoolMetrics status of every tracked engine. """
+
+    return [metrics.status() for metrics in pool_metrics.values()]
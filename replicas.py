@@ -0,0 +1,167 @@
+"""Read replica routing for the Cupcakes Flask app.
+
+Replicas are listed in DATABASE_REPLICA_URLS (comma separated) and become the Flask-SQLAlchemy
+binds replica_1, replica_2, ... Views decorated with @read_replica run their SELECT
+statements on one replica, picked round robin from the healthy ones when the request's
+session first reads. Everything else stays on the primary (SQLALCHEMY_DATABASE_URI):
+
+  - writes, flushes and SELECT .. FOR UPDATE, and every read after them in the session.
+  - every route without @read_replica, so the write functions in models.py.
+  - requests of a client that wrote in the last REPLICA_STICKY_SECONDS, marked by the
+    REPLICA_STICKY_COOKIE cookie set on its writes (read your writes).
+
+A replica is checked with SELECT 1 (and, on PostgreSQL with REPLICA_MAX_LAG_SECONDS, its
+replay lag) at most every REPLICA_HEALTH_CHECK_SECONDS. A replica that fails the check or
+drops a connection is skipped until its next check; with no healthy replica reads go to the
+primary.
+"""
+
+import functools
+import threading
+import time
+
+from flask import current_app, request
+from sqlalchemy import event, text
+from sqlalchemy.sql.selectable import Select
+
+
+def is_read_statement(clause):
+    """ True for a SELECT without FOR UPDATE. """
+
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+class ReplicaRouter:
+    """ Round robin over the healthy replica binds. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure(())
+
+    def configure(self, names, health_check_seconds=10, max_lag_seconds=0):
+        with self.lock:
+            self.names = tuple(names)
+            self.health_check_seconds = health_check_seconds
+            self.max_lag_seconds = max_lag_seconds
+            self.next_index = 0
+            # name -> (healthy, time of the check, reason)
+            self.health = {}
+            self.engines = {}
+
+    def choose(self, get_engine):
+        """ Returns (name, engine) of the next healthy replica, or None. get_engine(name)
+            returns the engine of a bind.
+        """
+
+        with self.lock:
+            names = self.names
+            start = self.next_index
+            self.next_index = (start + 1) % len(names) if names else 0
+
+        for offset in range(len(names)):
+            name = names[(start + offset) % len(names)]
+            engine = get_engine(name)
+            if (self.is_healthy(name, engine)):
+                return (name, engine)
+
+        return None
+
+    def is_healthy(self, name, engine):
+        with self.lock:
+            healthy, checked, reason = self.health.get(name, (None, 0, None))
+        if (healthy is not None and time.monotonic() - checked < self.health_check_seconds):
+            return healthy
+
+        if (not event.contains(engine, "handle_error", self.on_error)):
+            event.listen(engine, "handle_error", self.on_error)
+        with self.lock:
+            self.engines[name] = engine
+
+        healthy, reason = self.check(engine)
+        with self.lock:
+            self.health[name] = (healthy, time.monotonic(), reason)
+        return healthy
+
+    def check(self, engine):
+        """ Returns (healthy, reason) from a SELECT 1 and the replay lag of engine. """
+
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+                if (self.max_lag_seconds and engine.dialect.name == "postgresql"):
+                    lag = connection.execute(text(
+                        "SELECT CASE WHEN pg_is_in_recovery() "
+                        "THEN EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")).scalar()
+                    if (lag is not None and lag > self.max_lag_seconds):
+                        return (False, f"replay lag {lag:.1f}s")
+        except Exception as e:
+            return (False, f"{e.__class__.__name__}")
+
+        return (True, None)
+
+    def on_error(self, context):
+        """ handle_error event: a replica that dropped a connection is skipped until its
+            next health check.
+        """
+
+        if (context.is_disconnect):
+            with self.lock:
+                for name, engine in self.engines.items():
+                    if (engine is context.engine):
+                        self.health[name] = (False, time.monotonic(), "disconnected")
+
+    def status(self):
+        """ Returns [{name, healthy, checked_seconds_ago, reason}] for every replica. """
+
+        now = time.monotonic()
+        with self.lock:
+            return [{"name": name,
+                     "healthy": self.health.get(name, (None, 0, None))[0],
+                     "checked_seconds_ago": round(now - self.health[name][1], 1) if name in self.health else None,
+                     "reason": self.health.get(name, (None, 0, None))[2]}
+                    for name in self.names]
+
+
+def sticky_primary():
+    """ True when the client wrote within REPLICA_STICKY_SECONDS (read your writes). """
+
+    until = request.cookies.get(current_app.config["REPLICA_STICKY_COOKIE"])
+    try:
+        return until is not None and float(until) > time.time()
+    except ValueError:
+        return False
+
+
+def read_replica(view):
+    """ Decorator for read only views: their SELECT statements may run on a replica. """
+
+    @functools.wraps(view)
+    def replica_view(*args, **kwargs):
+        db = current_app.extensions["sqlalchemy"].db
+        if (db.replica_router.names and not sticky_primary()):
+            db.session.info["read_replica"] = True
+        return view(*args, **kwargs)
+
+    return replica_view
+
+
+def init_replicas(app, db):
+    """ Routes the read_replica views of app to the replica binds of its configuration and
+        adds the read your writes cookie to the responses of writes.
+    """
+
+    names = [name for name in (app.config.get("SQLALCHEMY_BINDS") or {})
+             if name.startswith("replica_")]
+    db.replica_router.configure(names,
+                                app.config.get("REPLICA_HEALTH_CHECK_SECONDS", 10),
+                                app.config.get("REPLICA_MAX_LAG_SECONDS", 0))
+
+    @app.after_request
+    def stick_to_primary(response):
+        sticky_seconds = app.config.get("REPLICA_STICKY_SECONDS", 0)
+        if (db.replica_router.names and sticky_seconds and response.status_code < 400
+                and request.method not in ("GET", "HEAD", "OPTIONS")):
+            response.set_cookie(app.config["REPLICA_STICKY_COOKIE"],
+                                str(time.time() + sticky_seconds), max_age=sticky_seconds,
+                                httponly=True, samesite="Lax")
+        return response
@@ -1,29 +1,318 @@
-from app import app
-from models import db, Cupcake
-
-
-db.drop_all()
-db.create_all()
-
-c1 = Cupcake(
-    flavor="cherry",
-    size="large",
-    rating=5,
-)
-
-c2 = Cupcake(
-    flavor="chocolate",
-    size="small",
-    rating=9,
-    image="https://www.bakedbyrachel.com/wp-content/uploads/2018/01/chocolatecupcakesccfrosting1_bakedbyrachel.jpg"
-)
-
-c3 = Cupcake(
-    flavor="golden yellow",
-    size="minis",
-    rating=10,
-    image="http://127.0.0.1:5000/static/images/cupcake.jpg"
-)
-
-db.session.add_all([c1, c2, c3])
-db.session.commit()
+"""Seed the cupcakes database.
+
+    flask seed                                  three demo cupcakes
+    flask seed --count 1000000                  plus a million synthetic cupcakes
+    flask seed --append --import cupcakes.csv   add the cupcakes in a CSV / NDJSON file
+
+The demo cupcakes are only added by default to fresh tables without --import; --demo adds
+them anyway.
+
+PostgreSQL (psycopg2) loads stream rows with COPY FROM STDIN; other databases use batched
+INSERTs. The cupcakes indexes are dropped before a load and recreated after it, and the
+rows / second of each load is reported. python seed.py [count] works as before.
+"""
+
+import csv
+import io
+import json
+import random
+import sys
+import time
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+
+from models import db, Cupcake, create_error_message, db_rebuild_cupcake_stats
+from validators import validate_cupcake_create
+
+FLAVORS = ("cherry", "chocolate", "golden yellow", "vanilla", "red velvet", "lemon",
+           "carrot", "strawberry", "salted caramel", "pumpkin spice", "mint chip",
+           "coconut", "banana", "blueberry", "cookies and cream", "peanut butter")
+FLAVOR_STYLES = ("", "double ", "dark ", "white ", "frosted ", "glazed ", "spiced ", "toasted ")
+SIZES = ("minis", "small", "medium", "large", "jumbo")
+
+DEFAULT_IMAGE = Cupcake.__table__.c.image.default.arg
+
+# columns written by a load, in COPY column order.
+LOAD_COLUMNS = ("flavor", "size", "rating", "image", "version", "updated_at")
+
+
+def generate_cupcakes(count, seed=0):
+    """ Generator of count synthetic cupcake dictionaries (flavor, size, rating, image).
+        The same seed always generates the same cupcakes, so benchmark datasets can be
+        rebuilt exactly.
+    """
+
+    rand = random.Random(seed)
+    for number in range(count):
+        yield {
+            "flavor": rand.choice(FLAVOR_STYLES) + rand.choice(FLAVORS),
+            "size": rand.choice(SIZES),
+            "rating": round(rand.uniform(1, 10), 1),
+            "image": f"https://example.com/cupcakes/{number}.jpg"
+        }
+
+
+def read_cupcake_file(path):
+    """ Generator of cupcake dictionaries from a CSV file with a flavor,size,rating,image
+        header, or from a newline delimited JSON file (.ndjson / .jsonl / .json) with one
+        object per line.
+    """
+
+    with open(path, newline="") as cupcake_file:
+        if (path.endswith((".ndjson", ".jsonl", ".json"))):
+            for line_number, line in enumerate(cupcake_file, 1):
+                if (line.strip()):
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        raise ValueError(f"{path} line {line_number} is not valid JSON.")
+        else:
+            yield from csv.DictReader(cupcake_file)
+
+
+def load_rows(cupcakes, source):
+    """ Generator of LOAD_COLUMNS tuples for cupcake dictionaries. Values are checked with
+        the same rules as POST /api/cupcakes; ValueError names the first bad cupcake.
+    """
+
+    updated_at = datetime.utcnow()
+    for number, cupcake_in in enumerate(cupcakes, 1):
+        validation = validate_cupcake_create(cupcake_in)
+        if (validation.errors):
+            raise ValueError(
+                f"{source} cupcake {number}: {create_error_message(cupcake_in, validation.errors)}")
+
+        cupcake = validation.values
+        yield (cupcake["flavor"], cupcake["size"], cupcake["rating"],
+               cupcake["image"] or DEFAULT_IMAGE, 1, updated_at)
+
+
+class CopyStream(io.TextIOBase):
+    """ Read-only file of CSV text for rows, produced as COPY reads it, so a load of any
+        size never holds more than batch_size rows in memory.
+    """
+
+    def __init__(self, rows, batch_size=10000):
+        self.rows = iter(rows)
+        self.batch_size = batch_size
+        self.buffer = ""
+        # the ValueError of a bad cupcake, which psycopg2 reports as QueryCanceled.
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def next_batch(self):
+        batch = io.StringIO()
+        writer = csv.writer(batch)
+        for count, row in enumerate(self.rows, 1):
+            writer.writerow(row)
+            if (count == self.batch_size):
+                break
+        return batch.getvalue()
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size):
+            try:
+                batch = self.next_batch()
+            except ValueError as e:
+                self.error = e
+                raise
+            if (not batch):
+                break
+            self.buffer += batch
+
+        if (size < 0):
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+def copy_rows(rows, batch_size):
+    """ Streams rows into cupcakes with PostgreSQL COPY FROM STDIN. ValueError names the
+        first bad cupcake, as with insert_rows.
+    """
+
+    stream = CopyStream(rows, batch_size)
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        try:
+            cursor.copy_expert(
+                f"COPY cupcakes ({', '.join(LOAD_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                stream)
+        except Exception:
+            # psycopg2 cancels the COPY with QueryCanceled when reading the stream fails.
+            if (stream.error is not None):
+                raise stream.error from None
+            raise
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def insert_rows(rows, batch_size):
+    """ Adds rows to cupcakes with one executemany INSERT per batch, in one transaction. """
+
+    with db.engine.begin() as connection:
+        batch = []
+        for row in rows:
+            batch.append(dict(zip(LOAD_COLUMNS, row)))
+            if (len(batch) == batch_size):
+                connection.execute(Cupcake.__table__.insert(), batch)
+                batch = []
+        if (batch):
+            connection.execute(Cupcake.__table__.insert(), batch)
+
+
+def load_cupcakes(cupcakes, source="cupcakes", batch_size=10000):
+    """ Bulk loads the cupcake dictionaries in cupcakes. The cupcakes indexes are dropped
+        for the load and recreated afterwards, also when the load fails.
+
+        Returns {"rows", "seconds", "method"}. cupcake_stats is not updated, call
+        db_rebuild_cupcake_stats when all loads are done.
+    """
+
+    engine = db.engine
+    use_copy = engine.dialect.name == "postgresql" and engine.dialect.driver == "psycopg2"
+    counted = {"rows": 0}
+
+    def counting(rows):
+        for row in rows:
+            counted["rows"] += 1
+            yield row
+
+    # end the transaction of db.session first: a lock it holds on cupcakes (even from a
+    #  SELECT) would make DROP INDEX on another connection wait forever.
+    db.session.remove()
+
+    start = time.perf_counter()
+    indexes = Cupcake.__table__.indexes
+    with engine.begin() as connection:
+        for index in indexes:
+            index.drop(connection, checkfirst=True)
+
+    try:
+        rows = counting(load_rows(cupcakes, source))
+        if (use_copy):
+            copy_rows(rows, batch_size)
+        else:
+            insert_rows(rows, batch_size)
+    finally:
+        with engine.begin() as connection:
+            for index in indexes:
+                index.create(connection, checkfirst=True)
+
+    return {"rows": counted["rows"], "seconds": time.perf_counter() - start,
+            "method": "COPY" if use_copy else "INSERT"}
+
+
+def seed_synthetic(count, seed=0, batch_size=10000):
+    """ Adds count synthetic cupcakes and rebuilds the cupcake_stats summary table. """
+
+    results = load_cupcakes(generate_cupcakes(count, seed), "generated", batch_size)
+    db_rebuild_cupcake_stats()
+
+    return results
+
+
+def reset_tables():
+    """ Drops and recreates every table. """
+
+    db.drop_all()
+    db.create_all()
+
+
+def add_demo_cupcakes():
+    """ Adds the three demo cupcakes. """
+
+    c1 = Cupcake(
+        flavor="cherry",
+        size="large",
+        rating=5,
+    )
+
+    c2 = Cupcake(
+        flavor="chocolate",
+        size="small",
+        rating=9,
+        image="https://www.bakedbyrachel.com/wp-content/uploads/2018/01/chocolatecupcakesccfrosting1_bakedbyrachel.jpg"
+    )
+
+    c3 = Cupcake(
+        flavor="golden yellow",
+        size="minis",
+        rating=10,
+        image="http://127.0.0.1:5000/static/images/cupcake.jpg"
+    )
+
+    db.session.add_all([c1, c2, c3])
+    db.session.commit()
+
+
+@click.command("seed")
+@click.option("--demo/--no-demo", default=None,
+              help="Add the three demo cupcakes (default on, off with --append or --import).")
+@click.option("--count", default=0, help="Number of synthetic cupcakes to generate.")
+@click.option("--random-seed", default=0, help="Seed for the synthetic cupcakes.")
+@click.option("--import", "import_paths", multiple=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help="CSV or NDJSON file of cupcakes to load. May be repeated.")
+@click.option("--append", is_flag=True, help="Keep the existing tables and cupcakes.")
+@click.option("--batch-size", default=10000, help="Rows per COPY / INSERT batch.")
+@with_appcontext
+def seed_command(demo, count, random_seed, import_paths, append, batch_size):
+    """ Seed the cupcakes database. The tables are dropped and recreated unless --append
+        is given. Each load commits on its own, so when one fails the earlier ones are
+        kept; cupcake_stats is rebuilt either way.
+    """
+
+    if (not append):
+        reset_tables()
+
+    if (demo is None):
+        demo = not (append or import_paths)
+    if (demo):
+        add_demo_cupcakes()
+
+    loads = []
+    if (count):
+        loads.append(("generated", generate_cupcakes(count, random_seed)))
+    for path in import_paths:
+        loads.append((path, read_cupcake_file(path)))
+
+    loaded = 0
+    try:
+        for source, cupcakes in loads:
+            try:
+                results = load_cupcakes(cupcakes, source, batch_size)
+            except ValueError as e:
+                kept = f" The {loaded} cupcakes loaded before it were kept." if loaded else ""
+                raise click.ClickException(f"{e} Nothing from {source} was loaded.{kept}")
+
+            loaded += results["rows"]
+            rate = results["rows"] / results["seconds"] if results["seconds"] else 0
+            click.echo(f"{source}: {results['rows']} cupcakes in {results['seconds']:.2f}s "
+                       f"({rate:,.0f} rows/second, {results['method']}).")
+
+    finally:
+        # also after a failed load: the loads before it are committed.
+        db_rebuild_cupcake_stats()
+        if (loads and db.engine.dialect.name == "postgresql"):
+            # fresh planner statistics for the new rows.
+            with db.engine.begin() as connection:
+                connection.execute(db.text("ANALYZE cupcakes"))
+
+
+if (__name__ == "__main__"):
+    from app import app
+
+    with app.app_context():
+        reset_tables()
+        add_demo_cupcakes()
+        if (len(sys.argv) > 1):
+            seed_synthetic(int(sys.argv[1]))
+        else:
+            db_rebuild_cupcake_stats()
@@ -0,0 +1,80 @@
+"""JSON serialization for Cupcakes API responses.
+
+dumps uses orjson when it is installed (pip install orjson) and otherwise the standard
+library encoder. Both write compact JSON (no indentation or spaces after separators) and
+return bytes, so responses are built without an extra encode step.
+"""
+
+import json
+import time
+
+from flask import current_app
+
+from instrumentation import record_serialization
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if (orjson is not None):
+    ENCODER = "orjson"
+
+    def dumps(data):
+        """ Returns data as compact JSON bytes. """
+
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+else:
+    ENCODER = "json"
+
+    compact_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(data):
+        """ Returns data as compact JSON bytes. """
+
+        return compact_encoder.encode(data).encode("utf-8")
+
+
+def json_response(data, status=200):
+    """ Returns a Flask application/json response with data serialized by dumps. Use it
+        instead of jsonify for the cupcake routes.
+    """
+
+    start = time.perf_counter()
+    body = dumps(data)
+    record_serialization(time.perf_counter() - start)
+
+    return current_app.response_class(body, status=status, mimetype="application/json")
+
+
+def rows_to_dicts(rows, keys):
+    """ Returns a list of {key: value} dictionaries for SQL row tuples, without creating
+        ORM instances. Columns after the last key (for example sort or version columns
+        selected for paging) are left out.
+    """
+
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def ndjson_chunks(items, chunk_size=500):
+    """ Generator of newline delimited JSON for items, chunk_size lines per bytes chunk so
+        a long stream is not written one small line at a time. The first line is a chunk
+        of its own, so the client gets the first byte as soon as the first item is read.
+    """
+
+    items = iter(items)
+    for item in items:
+        yield dumps(item) + b"\n"
+        break
+
+    lines = []
+    for item in items:
+        lines.append(dumps(item))
+        if (len(lines) == chunk_size):
+            yield b"\n".join(lines) + b"\n"
+            lines = []
+
+    if (lines):
+        yield b"\n".join(lines) + b"\n"
@@ -3,19 +3,24 @@
 const ROOT_APP = "http://127.0.0.1:5000";
 const ROOT_API = `${ROOT_APP}/api/cupcakes`;
 
-async function get_cupcakes() {
+// cupcakes per page loaded while scrolling.
+const PAGE_LIMIT = 24;
+
+async function get_cupcake_page(after) {
 
     /** function synopsis:
-     *   function calls the server to get all cupcakes.
+     *   function calls the server to get one page of cupcakes.
      * 
      *   Server will reply with a JSON response which contains data
      *   
      *   ROOT_API = http://127.0.0.1/api/cupcakes
-     *    get all cupcakes: get call to the root api.
+     *    get a page of cupcakes: get call to the root api with the next cursor
+     *    of the previous page (after), or none for the first page.
      * 
      *   {
      *      statusIsOK: true when OK, false when status was not 200
-     *      results: object cupcakes with an array of cupcake objects.
+     *      results: object with cupcakes, an array of cupcake objects, and next,
+     *               the cursor of the next page or null after the last page.
      *      message: the error message
      *   }
      */
@@ -27,16 +32,17 @@ async function get_cupcakes() {
     }
 
     try {
-        const res = await axios.get(`${ROOT_API}`);
+        const res = await axios.get(`${ROOT_API}`, { params: { after, limit: PAGE_LIMIT } });
 
-        if (res.status === 200) {
-            results_out["statusIsOK"] = true;
-            results_out["results"] = res.data;
-        } else {
+        if (res.status !== 200) {
             results_out["statusIsOK"] = false;
             results_out["message"] = `Status was not 200 (OK). response code = ${res.status}. `;
+            return results_out;
         }
 
+        results_out["statusIsOK"] = true;
+        results_out["results"] = { cupcakes: res.data.cupcakes, next: res.data.next || null };
+
     } catch (e) {
         results_out["statusIsOK"] = false;
         results_out["message"] = `An unexpected error (${e.message}) occurred while connecting to server. `;
@@ -48,33 +54,152 @@ async function get_cupcakes() {
 
 function build_cupcake_display($formElement, cupcake) {
 
-    const $newDiv = $('<div>').addClass('cupcake');
+    const $newDiv = $('<div>').addClass('cupcake').attr('data-cupcake-id', cupcake.id);
 
-    $('<img>').attr('src', cupcake.image).attr('alt', "no cupcake image").appendTo($newDiv);
+    // thumbnail from the image proxy; the full size image is the fallback when the
+    //  proxy cannot fetch it (see the error listener below).
+    $('<img>')
+        .attr('src', `${ROOT_APP}/images/${cupcake.id}?size=medium`)
+        .attr('data-fallback', cupcake.image)
+        .attr('alt', "no cupcake image")
+        .appendTo($newDiv);
     $('<span>').text(`${cupcake.flavor}  ${cupcake.size}  ${cupcake.rating}`).appendTo($newDiv);
-    $formElement.append($newDiv);
+
+    // a cupcake that is already shown is replaced in place.
+    const $current = $formElement.find(`[data-cupcake-id="${cupcake.id}"]`);
+    if ($current.length) {
+        $current.replaceWith($newDiv);
+    } else {
+        $formElement.append($newDiv);
+    }
 
 }
 
 
-async function build_cupcake_list() {
+// the server renders the first page. next_cursor is the cursor of the page to load
+//  when the end of the list scrolls into view, null once every page was loaded.
+let next_cursor = null;
+let loading_page = false;
+
+async function load_next_page() {
+
+    if (loading_page || next_cursor === null) {
+        return;
+    }
+    loading_page = true;
 
-    // 
-    cupcake_info = await get_cupcakes()
+    const cupcake_info = await get_cupcake_page(next_cursor);
     if (cupcake_info.statusIsOK) {
-        if (cupcake_info.results.cupcakes.length > 0) {
+        for (let cupcake of cupcake_info.results.cupcakes) {
+            build_cupcake_display($('#cupcake-list'), cupcake);
+        }
+        next_cursor = cupcake_info.results.next;
+    } else {
+        $('#messages').text(cupcake_info.message)
+    }
+
+    loading_page = false;
+
+    // keep going while the end of the list is still in view.
+    if (next_cursor !== null && end_in_view()) {
+        load_next_page();
+    }
 
-            for (let cupcake of cupcake_info.results.cupcakes) {
-                // do this for each element in array
-                build_cupcake_display($('td'), cupcake)
+}
+
+function end_in_view() {
+
+    const end = document.getElementById('catalog-end').getBoundingClientRect();
+    return end.top <= window.innerHeight;
+
+}
+
+async function reload_catalog() {
+
+    // every cupcake is read again from the first page.
+    $('#cupcake-list').empty();
+    next_cursor = "";
+    loading_page = false;
+    await load_next_page();
+
+}
+
+
+// cursor of the change feed, rendered into the page with the first page.
+let changes_cursor = null;
+const CHANGES_POLL_MS = 5000;
+
+async function sync_changes() {
+
+    /** function synopsis:
+     *   asks the server for the cupcakes created, updated or deleted since the last
+     *   sync (GET /api/cupcakes/changes?since=cursor) and applies only those to the
+     *   page. When the server answers reset (the cupcakes were reloaded) the list is
+     *   read again from the first page.
+     */
+
+    try {
+        let more = true;
+        while (more) {
+            const res = await axios.get(`${ROOT_API}/changes`, { params: { since: changes_cursor } });
+
+            if (res.data.reset) {
+                // take the cursor before reading the list so no change is missed.
+                changes_cursor = res.data.cursor;
+                await reload_catalog();
+            }
+
+            for (let change of res.data.changes) {
+                if (change.op === "delete") {
+                    $(`[data-cupcake-id="${change.id}"]`).remove();
+                } else if ($(`[data-cupcake-id="${change.id}"]`).length || next_cursor === null) {
+                    // cupcakes on pages not loaded yet arrive with their page.
+                    build_cupcake_display($('#cupcake-list'), change.cupcake);
+                }
             }
 
+            changes_cursor = res.data.cursor;
+            more = res.data.more;
         }
 
-    } else {
-        $('#messages').text(cupcake_info.message)
+    } catch (e) {
+        $('#messages').text(`An unexpected error (${e.message}) occurred while checking for changes. `)
     }
 
+    setTimeout(sync_changes, CHANGES_POLL_MS);
+
+}
+
+
+// wait this long after the last keystroke before asking for suggestions.
+const SUGGEST_DELAY_MS = 150;
+const suggest_timers = {};
+
+function suggest_values(field, q) {
+
+    /** function synopsis:
+     *   fills the datalist of the flavor or size input with the existing values that
+     *   start with q (GET /api/cupcakes/suggest), most used first. Requests wait for
+     *   a pause in typing and answers for text that was since changed are dropped.
+     */
+
+    clearTimeout(suggest_timers[field]);
+    suggest_timers[field] = setTimeout(async function () {
+        try {
+            const res = await axios.get(`${ROOT_API}/suggest`, { params: { q, field } });
+            if ($(`#form-${field}`).val().trim() !== q) {
+                return;
+            }
+
+            const $datalist = $(`#${field}-suggestions`).empty();
+            for (let suggestion of res.data.suggestions[field]) {
+                $datalist.append($('<option>').attr('value', suggestion.value));
+            }
+        } catch (e) {
+            // suggestions are optional; typing goes on without them.
+        }
+    }, SUGGEST_DELAY_MS);
+
 }
 
 
@@ -105,7 +230,7 @@ async function handleAdd(event) {
         );
 
         if (res.status === 201) {
-            build_cupcake_display($('td'), res.data.cupcake);
+            build_cupcake_display($('#cupcake-list'), res.data.cupcake);
 
             $('input').val('');
 
@@ -123,23 +248,50 @@ async function handleAdd(event) {
 $(function () {
 
     /* When DOM loads, 
-        call to get the cupcakes via api
+        load the next pages of cupcakes when the end of the list scrolls into view
+        keep the list current with the change feed
+        suggest existing flavors and sizes while typing
         add event listener for Add Cupcake button click.
     */
 
     //alert("JavaScript loaded");
 
-    // build the table to hold the div for each cupcake. div of divs just
-    //  does not seem to work for me because everything after the div is 
-    //  still floats after the div instead of being below all the divs.
+    const $list = $('#cupcake-list');
+    next_cursor = $list.data('next') || null;
+    changes_cursor = $list.data('changes-cursor');
+
+    if ('IntersectionObserver' in window) {
+        new IntersectionObserver(function (entries) {
+            if (entries[0].isIntersecting) {
+                load_next_page();
+            }
+        }).observe(document.getElementById('catalog-end'));
+    } else {
+        $(window).on('scroll', function () {
+            if (end_in_view()) {
+                load_next_page();
+            }
+        });
+    }
+
+    // full size image when the thumbnail cannot be loaded. error events do not bubble,
+    //  so listen in the capture phase.
+    document.addEventListener('error', function (event) {
+        const img = event.target;
+        if (img.tagName === 'IMG' && img.dataset.fallback && !img.dataset.fellBack) {
+            img.dataset.fellBack = "true";
+            img.src = img.dataset.fallback;
+        }
+    }, true);
+
+    setTimeout(sync_changes, CHANGES_POLL_MS);
 
-    $('<table>').appendTo('#contents')
-    $('<tbody>').appendTo('table')
-    $('<tr>').appendTo('tbody')
-    $('<td>').appendTo('tr')
-    build_cupcake_list();
+    // typeahead for flavor and size
+    $("#form-flavor, #form-size").on("input", function () {
+        suggest_values(this.name, $(this).val().trim());
+    });
 
     // listener for click of the submit form button
     $("#add-cupcake").on("click", handleAdd);
 
-});
\ No newline at end of file
+});
@@ -0,0 +1,221 @@
+"""In-process prefix index for flavor / size typeahead.
+
+PrefixIndex keeps the distinct values of one column in a list sorted by their casefolded
+text, so the values starting with a prefix are the slice found with two bisects. The slice
+is ranked by how many cupcakes have each value. Ranking a large slice (short prefixes at a
+million values) is too slow for a keystroke, so the top values of those prefixes are ranked
+as the index loads, cached, and kept in order as writes change counts.
+
+SuggestIndex holds a PrefixIndex per column. app.py loads it in the background when a
+worker serves its first request (SUGGEST_PRELOAD), otherwise it is loaded on first use. The
+write functions in models.py and async_app.py update it as they commit, and it is loaded
+again in the background every refresh_seconds, which picks up writes made by other worker
+processes. Counts may be briefly off around a refresh; they only order suggestions.
+"""
+
+import heapq
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+# the largest slice ranked on every request; larger ones use the top values cache.
+SCAN_LIMIT = 256
+
+# prefixes up to this long are ranked as the index is loaded.
+WARM_LENGTH = 4
+
+# sorts after every character, so (prefix + PREFIX_END,) is past every value with prefix.
+PREFIX_END = chr(0x10FFFF)
+
+
+class PrefixIndex:
+    """ Distinct values of one column and the number of cupcakes with each. """
+
+    def __init__(self, counts=None, max_limit=50):
+        self.max_limit = max_limit
+        self.lock = threading.Lock()
+        self.load(counts or {})
+
+    def load(self, counts):
+        """ Replaces the index with counts, {value: number of cupcakes}. """
+
+        counts = {value: count for value, count in counts.items() if value and count > 0}
+        keys = sorted((value.casefold(), value) for value in counts)
+        with self.lock:
+            self.counts = counts
+            self.keys = keys
+            # casefolded prefix -> top max_limit keys for prefixes with large slices.
+            self.top = {}
+            for prefix in self.warm_prefixes():
+                self.suggest_keys(prefix, self.max_limit)
+
+    def warm_prefixes(self):
+        """ Returns the prefixes of up to WARM_LENGTH characters, the ones with the largest
+            slices, so no request pays for ranking them after a load.
+        """
+
+        prefixes = {""}
+        for folded, value in self.keys:
+            prefixes.update(folded[:end] for end in range(1, WARM_LENGTH + 1))
+        return sorted(prefixes)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def adjust(self, value, delta):
+        """ Adds delta to the count of value, adding or removing value as needed. """
+
+        if (not value or delta == 0):
+            return
+
+        key = (value.casefold(), value)
+        with self.lock:
+            count = self.counts.get(value, 0) + delta
+            if (count > 0):
+                if (value not in self.counts):
+                    self.keys.insert(bisect_left(self.keys, key), key)
+                self.counts[value] = count
+            elif (value in self.counts):
+                del self.counts[value]
+                del self.keys[bisect_left(self.keys, key)]
+
+            self.update_top(key, delta)
+
+    def update_top(self, key, delta):
+        """ Keeps the cached top values of the prefixes of key in order after its count
+            changed by delta. A cached value whose count drops may be passed by a value
+            outside the cache, so those prefixes are ranked again on their next request.
+        """
+
+        counts = self.counts
+        for end in range(len(key[0]) + 1):
+            prefix = key[0][:end]
+            top = self.top.get(prefix)
+            if (top is None):
+                continue
+
+            if (key in top):
+                if (delta < 0):
+                    del self.top[prefix]
+                else:
+                    top.sort(key=lambda key: (-counts[key[1]], key))
+            elif (delta > 0):
+                last = top[-1]
+                if ((-counts[key[1]], key) < (-counts[last[1]], last)):
+                    top.append(key)
+                    top.sort(key=lambda key: (-counts[key[1]], key))
+                    del top[self.max_limit:]
+
+    def suggest(self, prefix, limit=10):
+        """ Returns [(value, count)] for up to limit values starting with prefix (case
+            insensitive), most cupcakes first, then alphabetically.
+        """
+
+        limit = min(limit, self.max_limit)
+        with self.lock:
+            return [(value, self.counts[value])
+                    for folded, value in self.suggest_keys(prefix.casefold(), limit)]
+
+    def suggest_keys(self, prefix, limit):
+        # the caller holds the lock.
+        keys = self.keys
+        start = bisect_left(keys, (prefix,))
+        end = bisect_left(keys, (prefix + PREFIX_END,), start)
+
+        if (end - start <= SCAN_LIMIT):
+            return self.rank(keys[start:end], limit)
+
+        top = self.top.get(prefix)
+        if (top is None):
+            top = self.top[prefix] = self.rank(keys[start:end], self.max_limit)
+        return top[:limit]
+
+    def rank(self, keys, limit):
+        # nlargest is stable, so equal counts keep their alphabetical order.
+        counts = self.counts
+        return heapq.nlargest(limit, keys, key=lambda key: counts[key[1]])
+
+
+class SuggestIndex:
+    """ A PrefixIndex for each of fields, loaded with load(field) -> {value: count}. """
+
+    def __init__(self, fields, load, refresh_seconds=300, max_limit=50):
+        self.fields = tuple(fields)
+        self.load = load
+        self.lock = threading.Lock()
+        self.indexes = None
+        self.loaded_at = 0
+        self.refreshing = False
+        self.configure(refresh_seconds, max_limit)
+
+    def configure(self, refresh_seconds=300, max_limit=50):
+        """ refresh_seconds is how often the index is loaded again, 0 for never. max_limit
+            is the most suggestions a request can ask for; it applies from the next load.
+        """
+
+        self.refresh_seconds = refresh_seconds
+        self.max_limit = max_limit
+
+    def build(self):
+        """ Loads every field. Returns {field: PrefixIndex}. """
+
+        return {field: PrefixIndex(self.load(field), self.max_limit) for field in self.fields}
+
+    def get_indexes(self):
+        """ Returns {field: PrefixIndex}, loading them on first use and starting a background
+            refresh when they are older than refresh_seconds.
+        """
+
+        with self.lock:
+            if (self.indexes is None):
+                self.indexes = self.build()
+                self.loaded_at = time.monotonic()
+            elif (self.refresh_seconds and not self.refreshing
+                    and time.monotonic() - self.loaded_at > self.refresh_seconds):
+                self.refreshing = True
+                threading.Thread(target=self.refresh, daemon=True).start()
+            return self.indexes
+
+    def refresh(self):
+        try:
+            indexes = self.build()
+            with self.lock:
+                if (self.indexes is not None):
+                    self.indexes = indexes
+                self.loaded_at = time.monotonic()
+        finally:
+            self.refreshing = False
+
+    def invalidate(self):
+        """ Drops the index; the next request loads it again. For writes that bypass
+            apply, such as a seed.
+        """
+
+        with self.lock:
+            self.indexes = None
+
+    def apply(self, removed=(), added=()):
+        """ Updates the counts for the serialized cupcakes removed and added by a committed
+            write. Does nothing before the index is loaded.
+        """
+
+        indexes = self.indexes
+        if (indexes is None):
+            return
+
+        for field, index in indexes.items():
+            deltas = Counter(cupcake[field] for cupcake in added)
+            deltas.subtract(cupcake[field] for cupcake in removed)
+            for value, delta in deltas.items():
+                index.adjust(value, delta)
+
+    def suggest(self, prefix, fields=None, limit=10):
+        """ Returns {field: [{value, count}]} for the values of fields (default all)
+            starting with prefix.
+        """
+
+        indexes = self.get_indexes()
+        return {field: [{"value": value, "count": count}
+                        for value, count in indexes[field].suggest(prefix, limit)]
+                for field in (fields or self.fields)}
@@ -1,11 +1,42 @@
-from unittest import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from unittest import TestCase, mock
 
-from app import app
-from models import db, Cupcake
+from app import app, catalog_cache, read_flight as app_read_flight, group_writer as app_group_writer
+from models import db, Cupcake, CupcakeStat, cupcake_cache, cupcake_filters, db_rebuild_cupcake_stats, db_add_cupcake, db_add_validated_cupcakes
+from cache import LRUCache, ReadThroughCache, InMemorySharedBackend
+from config import get_config, ProductionConfig
+from serializers import dumps, rows_to_dicts, ndjson_chunks
+from api_helpers import encode_cursor
+from assets import build_assets
+from compression import compress_chunks, brotli
+from images import image_cache, ImageCache, ImageError, THUMBNAIL_SIZES, fetch_image, is_public_address
+from suggest import PrefixIndex, SCAN_LIMIT
+from coalesce import SingleFlight, AsyncSingleFlight
+from group_commit import GroupCommitWriter
+from pool_metrics import PoolMetrics
+from seed import CopyStream, load_rows
+from validators import validate_cupcake_create, validate_cupcake_update, first_error, MISSING, BLANK, INVALID
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
 
 # Use test database and don't clutter tests with SQL
 app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///cupcakes_test'
 app.config['SQLALCHEMY_ECHO'] = False
+# suggest tests load the typeahead index themselves
+app.config['SUGGEST_PRELOAD'] = False
 
 # Make Flask errors be real errors, rather than HTML pages with error info
 app.config['TESTING'] = True
@@ -36,10 +67,13 @@ class CupcakeViewsTestCase(TestCase):
         """Make demo data."""
 
         Cupcake.query.delete()
+        cupcake_cache.clear()
 
         cupcake = Cupcake(**CUPCAKE_DATA)
         db.session.add(cupcake)
         db.session.commit()
+        # the demo data is added without the model functions, so rebuild the statistics.
+        db_rebuild_cupcake_stats()
 
         self.cupcake = cupcake
 
@@ -47,6 +81,8 @@ class CupcakeViewsTestCase(TestCase):
         """Clean up fouled transactions."""
 
         db.session.rollback()
+        # SQLite reuses ids, so drop this test's objects before the next one adds its own.
+        db.session.remove()
 
     def test_list_cupcakes(self):
         with app.test_client() as client:
@@ -67,6 +103,300 @@ class CupcakeViewsTestCase(TestCase):
                 ]
             })
 
+    def test_list_cupcakes_pages(self):
+        cupcake_2 = Cupcake(**CUPCAKE_DATA_2)
+        db.session.add(cupcake_2)
+        db.session.commit()
+        ids = [self.cupcake.id, cupcake_2.id]
+
+        with app.test_client() as client:
+            resp = client.get("/api/cupcakes?limit=1")
+
+            self.assertEqual(resp.status_code, 200)
+            data = resp.json
+            self.assertEqual([c["id"] for c in data["cupcakes"]], [ids[0]])
+            self.assertIn("next", data)
+
+            resp = client.get(f"/api/cupcakes?limit=1&after={data['next']}")
+
+            self.assertEqual(resp.status_code, 200)
+            data = resp.json
+            self.assertEqual([c["id"] for c in data["cupcakes"]], [ids[1]])
+            self.assertNotIn("next", data)
+
+    def test_list_cupcakes_fields(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cupcakes?fields=flavor,rating")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {
+                "cupcakes": [
+                    {
+                        "id": self.cupcake.id,
+                        "flavor": "TestFlavor",
+                        "rating": 5
+                    }
+                ]
+            })
+
+    def test_list_cupcakes_bad_params(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cupcakes?fields=flavor,price")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("price", resp.json["error"]["message"])
+
+            resp = client.get("/api/cupcakes?limit=0")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/api/cupcakes?after=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_list_cupcakes_filter_sort(self):
+        db.session.add_all([Cupcake(**CUPCAKE_DATA_2),
+                            Cupcake(**{**CUPCAKE_DATA, "flavor": "Lemon_Drop", "rating": 7})])
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/api/cupcakes?flavor=testflavor&sort=-rating")
+            self.assertEqual([c["flavor"] for c in resp.json["cupcakes"]],
+                             ["TestFlavor2", "TestFlavor"])
+
+            resp = client.get("/api/cupcakes?flavor_prefix=Lemon_&fields=flavor")
+            self.assertEqual([c["flavor"] for c in resp.json["cupcakes"]], ["Lemon_Drop"])
+
+            resp = client.get("/api/cupcakes?size=TestSize&rating_min=6&rating_max=9")
+            self.assertEqual([c["rating"] for c in resp.json["cupcakes"]], [7])
+
+            # keyset pagination continues in the sort order
+            ratings = []
+            url = "/api/cupcakes?sort=-rating&limit=2&fields=rating"
+            resp = client.get(url)
+            ratings += [c["rating"] for c in resp.json["cupcakes"]]
+            resp = client.get(f"{url}&after={resp.json['next']}")
+            ratings += [c["rating"] for c in resp.json["cupcakes"]]
+            self.assertEqual(ratings, [10, 7, 5])
+
+            # a cursor only works with the sort it was created for
+            resp = client.get("/api/cupcakes?sort=flavor&limit=2")
+            resp = client.get(f"/api/cupcakes?sort=rating&after={resp.json['next']}")
+            self.assertEqual(resp.status_code, 400)
+
+            # the cursor value must have the type of the sort column
+            for sort, value in (("rating", "high"), ("-rating", None), ("flavor", 5),
+                                ("size", ["TestSize"]), ("id", 1.5), ("image", True)):
+                cursor = encode_cursor({"sort": sort, "id": 1, "value": value})
+                resp = client.get(f"/api/cupcakes?sort={sort}&after={cursor}")
+                self.assertEqual(resp.status_code, 400)
+                self.assertEqual(resp.json["error"]["message"], f"Cursor '{cursor}' is not valid.")
+
+            cursor = encode_cursor({"sort": "rating", "id": 1, "value": 7})
+            resp = client.get(f"/api/cupcakes?sort=rating&after={cursor}")
+            self.assertEqual(resp.status_code, 200)
+
+            resp = client.get("/api/cupcakes?sort=price")
+            self.assertEqual(resp.status_code, 400)
+            resp = client.get("/api/cupcakes?rating_min=high")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_list_cupcakes_filters_use_indexes(self):
+        if (db.engine.dialect.name != "postgresql"):
+            self.skipTest("query plans are checked on PostgreSQL")
+
+        # the test table is tiny, so make the planner prefer an index when it can use one.
+        db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+
+        for filters, index_name in [({"flavor": "estFla"}, "ix_cupcakes_flavor_trgm"),
+                                    ({"flavor_prefix": "Test"}, "ix_cupcakes_flavor_prefix"),
+                                    ({"size": "TestSize"}, "ix_cupcakes_size_id"),
+                                    ({"rating_min": 4}, "ix_cupcakes_rating_id")]:
+            statement = db.session.query(Cupcake.id).filter(
+                *cupcake_filters(filters)).statement
+            sql = statement.compile(dialect=db.engine.dialect,
+                                    compile_kwargs={"literal_binds": True})
+            plan = "\n".join(row[0] for row in db.session.execute(
+                db.text(f"EXPLAIN {sql}")))
+
+            self.assertIn(index_name, plan)
+
+        db.session.rollback()
+
+    def test_export_cupcakes(self):
+        cupcake_2 = Cupcake(**CUPCAKE_DATA_2)
+        db.session.add(cupcake_2)
+        db.session.commit()
+        ids = [self.cupcake.id, cupcake_2.id]
+
+        with app.test_client() as client:
+            resp = client.get("/api/cupcakes/export?fields=flavor")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+
+            lines = resp.get_data(as_text=True).splitlines()
+            self.assertEqual([json.loads(line) for line in lines], [
+                {"id": ids[0], "flavor": "TestFlavor"},
+                {"id": ids[1], "flavor": "TestFlavor2"}
+            ])
+
+            resp = client.get("/api/cupcakes?format=ndjson")
+            self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 2)
+
+    def test_cupcake_stats(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            client.post("/api/cupcakes", json=CUPCAKE_DATA_2)
+            client.post("/api/cupcakes/bulk", json=[CUPCAKE_DATA, CUPCAKE_DATA])
+            # TestFlavor 5 -> TestFlavor2 10, then delete another TestFlavor
+            client.patch(f"/api/cupcakes/{cupcake_id}", json=CUPCAKE_DATA_2)
+            other_id = Cupcake.query.filter_by(flavor="TestFlavor").first().id
+            client.delete(f"/api/cupcakes/{other_id}")
+
+            resp = client.get("/api/cupcakes/stats")
+
+            self.assertEqual(resp.status_code, 200)
+            stats = resp.json["stats"]
+            self.assertEqual(stats["count"], 3)
+            self.assertEqual(stats["min"], 5)
+            self.assertEqual(stats["max"], 10)
+            self.assertAlmostEqual(stats["mean"], 25 / 3)
+            self.assertEqual(stats["histogram"], {"5.0": 1, "10.0": 2})
+            self.assertEqual(stats["flavors"]["TestFlavor"]["count"], 1)
+            self.assertEqual(stats["sizes"]["TestSize2"]["histogram"], {"10.0": 2})
+
+            # the incremental statistics match a full rebuild
+            db_rebuild_cupcake_stats()
+            self.assertEqual(client.get("/api/cupcakes/stats").json["stats"], stats)
+
+    def test_cupcake_stats_buckets(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            client.post("/api/cupcakes", json={**CUPCAKE_DATA, "rating": 5.1})
+            client.post("/api/cupcakes", json={**CUPCAKE_DATA, "rating": 5.35})
+            # a change within the bucket only changes the sum of ratings
+            client.patch(f"/api/cupcakes/{cupcake_id}", json={**CUPCAKE_DATA, "rating": 5.2})
+
+            # one row for the three ratings in the 5.0 bucket
+            self.assertEqual(CupcakeStat.query.count(), 1)
+            stats = client.get("/api/cupcakes/stats").json["stats"]
+            self.assertEqual(stats["histogram"], {"5.0": 3})
+            self.assertAlmostEqual(stats["mean"], (5.1 + 5.35 + 5.2) / 3)
+
+            db_rebuild_cupcake_stats()
+            rebuilt = client.get("/api/cupcakes/stats").json["stats"]
+            self.assertEqual(rebuilt["histogram"], {"5.0": 3})
+            self.assertAlmostEqual(rebuilt["mean"], stats["mean"])
+
+    def test_home_page(self):
+        app.config['CATALOG_PAGE_LIMIT'] = 1
+        try:
+            cupcake_id = self.cupcake.id
+            with app.test_client() as client:
+                client.post("/api/cupcakes", json=CUPCAKE_DATA_2)
+                catalog_cache.clear()
+                hits = catalog_cache.stats["hits"]
+
+                html = client.get("/").get_data(as_text=True)
+                # the first page is in the page, the second is loaded by cupcakes.js
+                self.assertIn(f'data-cupcake-id="{cupcake_id}"', html)
+                self.assertIn("TestFlavor  TestSize  5", html)
+                self.assertNotIn("TestFlavor2", html)
+                self.assertNotIn('data-next=""', html)
+
+                # the rendered page is cached until a cupcake is written
+                client.get("/")
+                self.assertEqual(catalog_cache.stats["hits"], hits + 1)
+
+                client.patch(f"/api/cupcakes/{cupcake_id}", json={**CUPCAKE_DATA, "flavor": "Plum"})
+                self.assertIn("Plum  TestSize  5", client.get("/").get_data(as_text=True))
+                self.assertEqual(catalog_cache.stats["hits"], hits + 1)
+        finally:
+            app.config['CATALOG_PAGE_LIMIT'] = get_config().CATALOG_PAGE_LIMIT
+
+    def test_suggest_cupcakes(self):
+        with app.test_client() as client:
+            client.post("/api/cupcakes", json={**CUPCAKE_DATA_2, "flavor": "Testberry"})
+            client.post("/api/cupcakes", json={**CUPCAKE_DATA_2, "flavor": "testberry"})
+            client.post("/api/cupcakes", json={**CUPCAKE_DATA_2, "flavor": "Lemon"})
+
+            resp = client.get("/api/cupcakes/suggest", query_string={"q": "TEST"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["suggestions"], {
+                "flavor": [{"value": "Testberry", "count": 1},
+                           {"value": "testberry", "count": 1},
+                           {"value": "TestFlavor", "count": 1}],
+                "size": [{"value": "TestSize2", "count": 3},
+                         {"value": "TestSize", "count": 1}]
+            })
+
+            # writes update the index
+            lemon_id = Cupcake.query.filter_by(flavor="Lemon").one().id
+            client.patch(f"/api/cupcakes/{lemon_id}", json={**CUPCAKE_DATA_2, "flavor": "TestFlavor"})
+            resp = client.get("/api/cupcakes/suggest",
+                              query_string={"q": "t", "field": "flavor", "limit": 1})
+            self.assertEqual(resp.json["suggestions"],
+                             {"flavor": [{"value": "TestFlavor", "count": 2}]})
+            client.delete(f"/api/cupcakes/{lemon_id}")
+            resp = client.get("/api/cupcakes/suggest", query_string={"q": "lem"})
+            self.assertEqual(resp.json["suggestions"]["flavor"], [])
+
+            resp = client.get("/api/cupcakes/suggest", query_string={"field": "image"})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_cupcake_changes(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cupcakes/changes")
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.json["reset"])
+            cursor = resp.json["cursor"]
+            old_id = self.cupcake.id
+
+            new_id = client.post("/api/cupcakes", json=CUPCAKE_DATA_2).json["cupcake"]["id"]
+            client.patch(f"/api/cupcakes/{new_id}", json={**CUPCAKE_DATA_2, "rating": 3})
+            client.delete(f"/api/cupcakes/{old_id}")
+
+            resp = client.get("/api/cupcakes/changes", query_string={"since": cursor})
+            data = resp.json
+            self.assertFalse(data["reset"])
+            self.assertFalse(data["more"])
+            # the create and update of the new cupcake are combined into one change
+            self.assertEqual([(change["op"], change["id"]) for change in data["changes"]],
+                             [("update", new_id), ("delete", old_id)])
+            self.assertEqual(data["changes"][0]["cupcake"]["rating"], 3)
+            self.assertIsNone(data["changes"][1]["cupcake"])
+
+            resp = client.get("/api/cupcakes/changes", query_string={"since": data["cursor"]})
+            self.assertEqual(resp.json["changes"], [])
+            self.assertEqual(resp.json["cursor"], data["cursor"])
+
+            resp = client.get("/api/cupcakes/changes", query_string={"since": cursor, "limit": 1})
+            self.assertTrue(resp.json["more"])
+
+            resp = client.get("/api/cupcakes/changes", query_string={"since": "99999999"})
+            self.assertTrue(resp.json["reset"])
+
+            resp = client.get("/api/cupcakes/changes", query_string={"since": "abc"})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_cupcake_changes_stream(self):
+        app.config['CHANGES_STREAM_POLL_SECONDS'] = 0.01
+        app.config['CHANGES_STREAM_MAX_SECONDS'] = 0.05
+        try:
+            with app.test_client() as client:
+                cursor = client.get("/api/cupcakes/changes").json["cursor"]
+                old_id = self.cupcake.id
+                client.delete(f"/api/cupcakes/{old_id}")
+
+                resp = client.get("/api/cupcakes/changes/stream",
+                                  headers={"Last-Event-ID": cursor, "Accept-Encoding": "gzip"})
+                self.assertEqual(resp.mimetype, "text/event-stream")
+                self.assertIsNone(resp.content_encoding)
+                text = resp.get_data(as_text=True)
+                self.assertIn("event: change\n", text)
+                self.assertIn(f'"op":"delete","id":{old_id}', text)
+        finally:
+            app.config['CHANGES_STREAM_POLL_SECONDS'] = get_config().CHANGES_STREAM_POLL_SECONDS
+            app.config['CHANGES_STREAM_MAX_SECONDS'] = get_config().CHANGES_STREAM_MAX_SECONDS
+
     def test_get_cupcake(self):
         with app.test_client() as client:
             url = f"/api/cupcakes/{self.cupcake.id}"
@@ -84,6 +414,102 @@ class CupcakeViewsTestCase(TestCase):
                 }
             })
 
+    def test_get_cupcakes_by_ids(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            client.post("/api/cupcakes", json=CUPCAKE_DATA_2)
+            other_id = Cupcake.query.filter_by(flavor="TestFlavor2").one().id
+
+            url = f"/api/cupcakes?ids={other_id},{cupcake_id + 1000},2a,{cupcake_id}"
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            single = client.get(f"/api/cupcakes/{cupcake_id}").json
+            self.assertEqual(resp.json, {"results": [
+                {"id": other_id, "response_code": 200,
+                 "cupcake": {"id": other_id, **CUPCAKE_DATA_2, "rating": 10.0}},
+                {"id": str(cupcake_id + 1000), "response_code": 404,
+                 "error": client.get(f"/api/cupcakes/{cupcake_id + 1000}").json["error"]},
+                {"id": "2a", "response_code": 404,
+                 "error": client.get("/api/cupcakes/2a").json["error"]},
+                {"id": cupcake_id, "response_code": 200, **single}
+            ]})
+
+            # served from the cache the second time, and conditional requests work.
+            loads = cupcake_cache.get_stats()["loads"]
+            resp = client.get(url, headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(cupcake_cache.get_stats()["loads"], loads)
+
+            resp = client.get("/api/cupcakes", query_string={"ids": ""})
+            self.assertEqual(resp.status_code, 400)
+            too_many = ",".join(["1"] * (app.config['CUPCAKES_IDS_MAX'] + 1))
+            resp = client.get("/api/cupcakes", query_string={"ids": too_many})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_get_cupcake_cached(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            url = f"/api/cupcakes/{cupcake_id}"
+            hits = cupcake_cache.get_stats()["hits"]
+
+            client.get(url)
+            resp = client.get(url)
+
+            self.assertEqual(resp.json["cupcake"]["flavor"], "TestFlavor")
+            self.assertEqual(cupcake_cache.get_stats()["hits"], hits + 1)
+
+            # the update invalidates the cached cupcake
+            client.patch(url, json=CUPCAKE_DATA_2)
+            resp = client.get(url)
+            self.assertEqual(resp.json["cupcake"]["flavor"], "TestFlavor2")
+
+            resp = client.get("/api/status/cache")
+            self.assertIn("evictions", resp.json["cache"])
+
+    def test_get_cupcake_conditional(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            url = f"/api/cupcakes/{cupcake_id}"
+            resp = client.get(url)
+            etag = resp.headers["ETag"]
+            self.assertIsNotNone(resp.headers.get("Last-Modified"))
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = client.get("/api/cupcakes")
+            self.assertIsNone(resp.headers.get("Last-Modified"))
+            list_etag = resp.headers["ETag"]
+            resp = client.get("/api/cupcakes", headers={"If-None-Match": list_etag})
+            self.assertEqual(resp.status_code, 304)
+
+            client.patch(url, json=CUPCAKE_DATA_2)
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            resp = client.get("/api/cupcakes", headers={"If-None-Match": list_etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_update_cupcake_if_match(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            url = f"/api/cupcakes/{cupcake_id}"
+            etag = client.get(url).headers["ETag"]
+
+            resp = client.patch(url, json=CUPCAKE_DATA_2, headers={"If-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+            # a second update based on the old version is rejected
+            resp = client.patch(url, json=CUPCAKE_DATA, headers={"If-Match": etag})
+            self.assertEqual(resp.status_code, 412)
+            self.assertEqual(resp.json, {
+                "error": {
+                    "message": f"Update Error: Cupcake id={cupcake_id} was changed by another request. No updates occurred."
+                }
+            })
+            self.assertEqual(Cupcake.query.get(cupcake_id).flavor, "TestFlavor2")
+
     def test_create_cupcake(self):
         with app.test_client() as client:
             url = "/api/cupcakes"
@@ -108,6 +534,68 @@ class CupcakeViewsTestCase(TestCase):
 
             self.assertEqual(Cupcake.query.count(), 2)
 
+    def test_create_cupcake_invalid(self):
+        with app.test_client() as client:
+            url = "/api/cupcakes"
+            resp = client.post(url, json={"flavor": "TestFlavor2", "size": " ",
+                                          "rating": "ten", "image": 5})
+
+            self.assertEqual(resp.status_code, 400)
+
+            # every bad field is reported, not only the first one
+            self.assertEqual(resp.json["fields"], {
+                "size": "A non-blank value is required.",
+                "rating": "'ten' is not a number.",
+                "image": "Must be a string."
+            })
+            self.assertIn("Non-blank values required", resp.json["error"])
+
+            resp = client.post(url, data="[1, 2]", content_type="application/json")
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json["fields"], {"_": "Cupcake data must be a JSON object."})
+
+            self.assertEqual(Cupcake.query.count(), 1)
+
+    def test_create_cupcakes_bulk(self):
+        with app.test_client() as client:
+            url = "/api/cupcakes/bulk"
+            resp = client.post(url, json=[CUPCAKE_DATA_2, CUPCAKE_DATA])
+
+            self.assertEqual(resp.status_code, 201)
+
+            data = resp.json
+            self.assertEqual([item["index"] for item in data["cupcakes"]], [0, 1])
+            self.assertIsInstance(data["cupcakes"][0]["id"], int)
+            self.assertEqual(Cupcake.query.get(
+                data["cupcakes"][0]["id"]).flavor, "TestFlavor2")
+
+            ndjson = "\n".join(json.dumps(cupcake)
+                               for cupcake in [CUPCAKE_DATA, CUPCAKE_DATA_2])
+            resp = client.post(url, data=ndjson,
+                               content_type="application/x-ndjson")
+
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(Cupcake.query.count(), 5)
+
+    def test_create_cupcakes_bulk_errors(self):
+        with app.test_client() as client:
+            url = "/api/cupcakes/bulk"
+            resp = client.post(url, json=[
+                CUPCAKE_DATA_2,
+                {**CUPCAKE_DATA, "rating": "ten"},
+                {**CUPCAKE_DATA, "size": " "}
+            ])
+
+            self.assertEqual(resp.status_code, 400)
+
+            data = resp.json
+            self.assertEqual(
+                [item["index"] for item in data["error"]["items"]], [1, 2])
+            self.assertIn("Non-blank values required",
+                          data["error"]["items"][1]["message"])
+            # nothing is added when any item has an error.
+            self.assertEqual(Cupcake.query.count(), 1)
+
     # CUPCAKE_DATA = {
     #     "flavor": "TestFlavor",
     #     "size": "TestSize",
@@ -166,6 +654,23 @@ class CupcakeViewsTestCase(TestCase):
                 }
             })
 
+    def test_update_cupcake_write_once(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            url = f"/api/cupcakes/{cupcake_id}"
+            etag = client.get(url).headers["ETag"]
+
+            # no changes: nothing is written and the version stays the same
+            resp = client.patch(url, json=CUPCAKE_DATA)
+            self.assertEqual(resp.headers["ETag"], etag)
+
+            resp = client.patch(url, json={**CUPCAKE_DATA, "rating": "7"})
+            self.assertEqual(resp.json["cupcake"]["rating"], 7.0)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+            resp = client.get("/api/cupcakes/stats")
+            self.assertEqual(resp.json["stats"]["histogram"], {"7.0": 1})
+
     def test_update_cupcake_missing_values(self):
         CUPCAKE_DATA_NO_RATING = {
             "flavor": "TestFlavor",
@@ -184,7 +689,8 @@ class CupcakeViewsTestCase(TestCase):
             self.assertEqual(
                 data, {
                     "error": {
-                        "message": "Update Error: All fields require a value. rating had a value of None. No updates occurred."
+                        "message": "Update Error: All fields require a value. rating had a value of None. No updates occurred.",
+                        "fields": {"rating": "A value is required."}
                     }
                 })
 
@@ -244,6 +750,89 @@ class CupcakeViewsTestCase(TestCase):
                     }
                 })
 
+    def test_update_cupcakes_bulk(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            url = "/api/cupcakes/bulk"
+            resp = client.patch(url, json=[
+                {**CUPCAKE_DATA_2, "id": cupcake_id},
+                {**CUPCAKE_DATA, "id": 200},
+                {**CUPCAKE_DATA, "id": "2a"}
+            ])
+
+            self.assertEqual(resp.status_code, 200)
+
+            results = resp.json["results"]
+            self.assertEqual([result["response_code"]
+                             for result in results], [200, 404, 404])
+            self.assertEqual(results[0]["cupcake"], {
+                "id": cupcake_id,
+                "flavor": "TestFlavor2",
+                "size": "TestSize2",
+                "rating": 10.0,
+                "image": "http://test.com/cupcake2.jpg"
+            })
+            self.assertEqual(results[1]["error"]["message"],
+                             "Update Error: Cupcake id=200 was not found. No updates occurred.")
+            self.assertEqual(Cupcake.query.get(cupcake_id).flavor, "TestFlavor2")
+
+    def test_update_cupcakes_bulk_errors(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            url = "/api/cupcakes/bulk"
+            resp = client.patch(url, json=[
+                {"id": cupcake_id, "flavor": "TestFlavor", "size": "TestSize",
+                    "image": "http://test.com/cupcake.jpg"}
+            ])
+            result = resp.json["results"][0]
+            self.assertEqual(result["response_code"], 400)
+            self.assertEqual(result["error"]["message"],
+                             "Update Error: All fields require a value. rating had a value of None. No updates occurred.")
+
+            resp = client.patch(url, json=[{**CUPCAKE_DATA, "id": cupcake_id, "rating": "ten"}])
+            result = resp.json["results"][0]
+            self.assertEqual(result["response_code"], 400)
+            self.assertIn(": TestFlavor. No updates occurred.",
+                          result["error"]["message"])
+
+            resp = client.patch(url, json=[{**CUPCAKE_DATA, "id": cupcake_id}])
+            result = resp.json["results"][0]
+            self.assertEqual(result["response_code"], 200)
+            self.assertEqual(result["cupcake"]["rating"], 5)
+
+    def test_delete_cupcakes_bulk(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            url = "/api/cupcakes/bulk"
+            resp = client.delete(url, json=[cupcake_id, 200, "3f"])
+
+            self.assertEqual(resp.status_code, 200)
+
+            results = resp.json["results"]
+            self.assertEqual([result["response_code"]
+                             for result in results], [200, 404, 404])
+            self.assertEqual(results[0]["message"]["deleted"]["flavor"], "TestFlavor")
+            self.assertEqual(results[1]["error"]["message"],
+                             "Cupcake id=200 was not found. No delete occurred. ")
+            self.assertEqual(results[2]["error"]["message"],
+                             "Cupcake id='3f' was not an integer. No delete occurred. ")
+            self.assertEqual(Cupcake.query.count(), 0)
+
+    def test_delete_cupcakes_bulk_error(self):
+        cupcake_id = self.cupcake.id
+        with app.test_client() as client:
+            with mock.patch("models.record_cupcake_changes", side_effect=RuntimeError("boom")):
+                resp = client.delete("/api/cupcakes/bulk", json=[cupcake_id, "3f"])
+
+            self.assertEqual(resp.status_code, 200)
+
+            results = resp.json["results"]
+            self.assertEqual([result["response_code"]
+                             for result in results], [400, 404])
+            self.assertEqual(results[0]["error"]["message"],
+                             f"An error occurred while deleting cupcake id={cupcake_id}. No delete occurred. ")
+            self.assertEqual(Cupcake.query.count(), 1)
+
     def test_delete_cupcake_id_not_found(self):
 
         with app.test_client() as client:
@@ -302,3 +891,817 @@ class CupcakeViewsTestCase(TestCase):
                     }
                 })
             self.assertEqual(Cupcake.query.count(), 0)
+
+
+class CacheTestCase(TestCase):
+    """Tests for the read-through cache."""
+
+    def test_lru_eviction_and_ttl(self):
+        now = [0]
+        cache = LRUCache(max_size=2, ttl=10, clock=lambda: now[0])
+
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+
+        # 2 was the least recently used
+        self.assertEqual(cache.get(2), (False, None))
+        self.assertEqual(cache.get(1), (True, "one"))
+        self.assertEqual(cache.stats["evictions"], 1)
+
+        now[0] = 10
+        self.assertEqual(cache.get(1), (False, None))
+        self.assertEqual(cache.stats["expirations"], 1)
+
+    def test_read_through_shared(self):
+        shared = InMemorySharedBackend()
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return {"id": 1}
+
+        cache = ReadThroughCache(shared=shared)
+        self.assertEqual(cache.get_or_load(1, loader), {"id": 1})
+
+        # a second process only has the shared backend
+        other = ReadThroughCache(shared=shared)
+        self.assertEqual(other.get_or_load(1, loader), {"id": 1})
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(other.get_stats()["shared_hits"], 1)
+
+        cache.invalidate(1)
+        self.assertIsNone(shared.get("cupcake:1"))
+
+        # not found is not cached
+        self.assertIsNone(cache.get_or_load(2, lambda: None))
+        self.assertEqual(cache.get_or_load(2, lambda: {"id": 2}), {"id": 2})
+
+    def test_shared_invalidation(self):
+        shared = InMemorySharedBackend()
+        cache = ReadThroughCache(shared=shared)
+        other = ReadThroughCache(shared=shared)
+        self.assertEqual(cache.get_or_load(1, lambda: {"flavor": "old"}), {"flavor": "old"})
+        self.assertEqual(other.get_or_load(1, lambda: {"flavor": "old"}), {"flavor": "old"})
+
+        # a write in another process drops the value from this process' local cache
+        other.invalidate(1)
+        self.assertEqual(cache.get_or_load(1, lambda: {"flavor": "new"}), {"flavor": "new"})
+        self.assertEqual(cache.get_stats()["stale_hits"], 1)
+        self.assertEqual(other.get_or_load(1, lambda: {"flavor": "newer"}), {"flavor": "new"})
+
+        # a slow reader storing a value loaded before another process' write is ignored
+        snapshot = cache.snapshot(2)
+        other.invalidate(2)
+        cache.store(2, {"flavor": "old"}, snapshot)
+        self.assertEqual(cache.get_or_load(2, lambda: {"flavor": "new"}), {"flavor": "new"})
+        third = ReadThroughCache(shared=shared)
+        self.assertEqual(third.get_or_load(2, lambda: {"flavor": "newest"}), {"flavor": "new"})
+
+
+class CoalesceTestCase(TestCase):
+    """Tests that concurrent identical reads share one query."""
+
+    def setUp(self):
+        Cupcake.query.delete()
+        cupcake_cache.clear()
+        db.session.add(Cupcake(**CUPCAKE_DATA))
+        db.session.commit()
+        db_rebuild_cupcake_stats()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def wait_for(self, condition):
+        for _ in range(500):
+            if (condition()):
+                return
+            time.sleep(0.01)
+        self.fail("timed out waiting for the concurrent requests")
+
+    def test_single_flight(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def load():
+            calls.append(1)
+            release.wait(5)
+            return object()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key", load)))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        self.wait_for(lambda: flight.stats["followers"] == 19)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(result is results[0] for result in results))
+
+        # the call is not cached, and errors reach every caller.
+        with self.assertRaises(ZeroDivisionError):
+            flight.do("key", lambda: 1 / 0)
+        self.assertEqual(flight.do("key", lambda: "again"), "again")
+
+    def test_async_single_flight(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def load():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"cupcakes": []}
+
+        async def stampede():
+            return await asyncio.gather(*[flight.do("key", load) for _ in range(50)])
+
+        results = asyncio.run(stampede())
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(flight.calls, {})
+
+    def test_stampede_runs_one_query(self):
+        release = threading.Event()
+        statements = []
+
+        def count_cupcake_reads(conn, cursor, statement, parameters, context, executemany):
+            if (statement.lstrip().upper().startswith("SELECT") and "cupcakes" in statement):
+                statements.append(statement)
+                release.wait(5)
+
+        def get(url, responses):
+            with app.test_client() as client:
+                resp = client.get(url)
+                responses.append((resp.status_code, resp.get_data()))
+
+        cupcake_id = Cupcake.query.one().id
+        engine = db.get_engine(app)
+        event.listen(engine, "before_cursor_execute", count_cupcake_reads)
+        try:
+            for url in ("/api/cupcakes?limit=5", f"/api/cupcakes/{cupcake_id}"):
+                cupcake_cache.clear()
+                release.set()
+                get(url, [])
+                queries = len(statements)
+                self.assertTrue(queries >= 1)
+                del statements[:]
+                cupcake_cache.clear()
+                release.clear()
+
+                followers = app_read_flight.stats["followers"]
+                responses = []
+                threads = [threading.Thread(target=get, args=(url, responses)) for _ in range(10)]
+                for thread in threads:
+                    thread.start()
+                self.wait_for(lambda: app_read_flight.stats["followers"] - followers == 9)
+                release.set()
+                for thread in threads:
+                    thread.join()
+
+                self.assertEqual(len(statements), queries)
+                self.assertEqual(len(responses), 10)
+                self.assertEqual(responses[0][0], 200)
+                self.assertTrue(all(response == responses[0] for response in responses))
+                del statements[:]
+        finally:
+            event.remove(engine, "before_cursor_execute", count_cupcake_reads)
+            release.set()
+
+
+class GroupCommitTestCase(TestCase):
+    """Tests for group commit of cupcake creation."""
+
+    def setUp(self):
+        Cupcake.query.delete()
+        cupcake_cache.clear()
+        db.session.commit()
+        db_rebuild_cupcake_stats()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['GROUP_COMMIT_ENABLED'] = get_config().GROUP_COMMIT_ENABLED
+
+    def test_batches(self):
+        batches = []
+
+        def write(items):
+            batches.append(items)
+            return [item * 2 for item in items]
+
+        writer = GroupCommitWriter(write, window_seconds=0.05, max_rows=8)
+        results = {}
+
+        def submit(number):
+            results[number] = writer.submit(number).result()
+
+        threads = [threading.Thread(target=submit, args=(number,)) for number in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {number: number * 2 for number in range(20)})
+        self.assertTrue(len(batches) < 20)
+        self.assertTrue(max(len(batch) for batch in batches) <= 8)
+
+    def test_timeout_writes_directly(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def write(items):
+            started.set()
+            release.wait()
+            return db_add_validated_cupcakes(items)
+
+        writer = GroupCommitWriter(write, app, window_seconds=0, timeout_seconds=0.05)
+        try:
+            # the first create holds the writer; it has started, so it gets a 503.
+            first = db_add_cupcake(CUPCAKE_DATA, writer)
+            self.assertTrue(started.is_set())
+            self.assertEqual(first["response_code"], 503)
+
+            # the second is still queued, so it is taken back and written here.
+            second = db_add_cupcake(CUPCAKE_DATA_2, writer)
+            self.assertTrue(second["successful"])
+            self.assertEqual(second["message"]["flavor"], CUPCAKE_DATA_2["flavor"])
+        finally:
+            release.set()
+
+        writer.timeout_seconds = 5
+        self.assertTrue(db_add_cupcake(CUPCAKE_DATA, writer)["successful"])
+        self.assertEqual(writer.stats["timeouts"], 2)
+        self.assertEqual(writer.stats["rows"], 2)
+
+    def test_bad_row_fails_alone(self):
+        results = db_add_validated_cupcakes(
+            [CUPCAKE_DATA, {**CUPCAKE_DATA, "no_such_column": 1}, CUPCAKE_DATA_2])
+
+        self.assertEqual([result["successful"] for result in results], [True, False, True])
+        self.assertEqual(results[1]["message"], "An error occurred.")
+        self.assertEqual(Cupcake.query.count(), 2)
+
+    def test_create_cupcake_api(self):
+        app.config['GROUP_COMMIT_ENABLED'] = True
+        rows = app_group_writer.stats["rows"]
+        responses = []
+
+        def create(number):
+            with app.test_client() as client:
+                resp = client.post("/api/cupcakes", json={**CUPCAKE_DATA, "rating": number})
+                responses.append((number, resp.status_code, resp.json))
+
+        threads = [threading.Thread(target=create, args=(number,)) for number in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(status for number, status, data in responses), [201] * 10)
+        for number, status, data in responses:
+            self.assertEqual(data["cupcake"]["rating"], number)
+            self.assertEqual(Cupcake.query.get(data["cupcake"]["id"]).rating, number)
+        self.assertEqual(len({data["cupcake"]["id"] for number, status, data in responses}), 10)
+        self.assertEqual(app_group_writer.stats["rows"] - rows, 10)
+
+        with app.test_client() as client:
+            resp = client.post("/api/cupcakes", json={"flavor": "TestFlavor"})
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("rating", resp.json["fields"])
+
+
+class ValidatorTestCase(TestCase):
+    """Tests for the cupcake payload validators."""
+
+    def test_create_coerces_values(self):
+        validation = validate_cupcake_create(
+            {"flavor": " cherry ", "size": "large", "rating": "7", "image": ""})
+
+        self.assertEqual(validation.errors, {})
+        self.assertEqual(validation.values,
+                         {"flavor": "cherry", "size": "large", "rating": 7.0, "image": None})
+
+    def test_update_requires_all_fields(self):
+        validation = validate_cupcake_update({"flavor": "cherry", "rating": True, "image": ""})
+
+        self.assertEqual(validation.errors, {
+            "size": (MISSING, "A value is required."),
+            "rating": (INVALID, "'True' is not a number."),
+            "image": (BLANK, "A non-blank value is required.")
+        })
+        self.assertEqual(first_error(validation.errors), ("size", MISSING))
+
+    def test_huge_integer_rating(self):
+        huge = 10 ** 400
+        validation = validate_cupcake_create({"flavor": "cherry", "size": "large", "rating": huge})
+        self.assertEqual(validation.errors, {"rating": (INVALID, f"'{huge}' is not a number.")})
+
+        body = json.dumps({**CUPCAKE_DATA, "rating": huge})
+        with app.test_client() as client:
+            resp = client.post("/api/cupcakes", data=body, content_type="application/json")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("rating", resp.json["fields"])
+
+            cupcake = Cupcake(**CUPCAKE_DATA)
+            db.session.add(cupcake)
+            db.session.commit()
+            resp = client.patch(f"/api/cupcakes/{cupcake.id}", data=body, content_type="application/json")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("rating", resp.json["error"]["fields"])
+
+
+class PrefixIndexTestCase(TestCase):
+    """Tests for the typeahead prefix index."""
+
+    def test_suggest(self):
+        index = PrefixIndex({"Chocolate": 3, "cherry": 5, "Cherry": 5, "Lemon": 9, "": 4})
+        self.assertEqual(index.suggest("ch"), [("Cherry", 5), ("cherry", 5), ("Chocolate", 3)])
+        self.assertEqual(index.suggest("", 2), [("Lemon", 9), ("Cherry", 5)])
+        self.assertEqual(index.suggest("x"), [])
+
+        index.adjust("Chocolate", 3)
+        index.adjust("Chai", 1)
+        index.adjust("cherry", -5)
+        self.assertEqual(index.suggest("ch"), [("Chocolate", 6), ("Cherry", 5), ("Chai", 1)])
+
+    def test_large_prefix_cache(self):
+        # more values than SCAN_LIMIT, so prefix "v" is answered from the top values cache.
+        counts = {f"v{number:04}": number % 7 + 1 for number in range(SCAN_LIMIT * 2)}
+        index = PrefixIndex(counts, max_limit=5)
+
+        def expected(prefix, limit=5):
+            ranked = sorted((value for value in counts if value.startswith(prefix)),
+                            key=lambda value: (-counts[value], value))
+            return [(value, counts[value]) for value in ranked[:limit]]
+
+        self.assertEqual(index.suggest("v"), expected("v"))
+        for value, delta in (("v0001", 20), ("v0006", -7), ("v0013", -1), ("v9999", 50),
+                             ("v0001", -20), ("v0200", 3)):
+            index.adjust(value, delta)
+            counts[value] = counts.get(value, 0) + delta
+            if (counts[value] <= 0):
+                del counts[value]
+            self.assertEqual(index.suggest("v"), expected("v"))
+            self.assertEqual(index.suggest("V0", 3), expected("v0", 3))
+
+
+class SerializerTestCase(TestCase):
+    """Tests for the JSON serializers."""
+
+    def test_dumps_compact(self):
+        self.assertEqual(dumps({"cupcake": {"id": 1, "rating": 5.0}}),
+                         b'{"cupcake":{"id":1,"rating":5.0}}')
+
+    def test_rows_to_dicts(self):
+        # extra trailing columns (sort value, version) are left out
+        rows = [(1, "cherry", "cherry", 3), (2, "mint", "mint", 1)]
+        self.assertEqual(rows_to_dicts(rows, ("id", "flavor")),
+                         [{"id": 1, "flavor": "cherry"}, {"id": 2, "flavor": "mint"}])
+
+    def test_ndjson_chunks(self):
+        chunks = list(ndjson_chunks([{"id": 1}, {"id": 2}, {"id": 3}, {"id": 4}], chunk_size=2))
+        # the first line is sent on its own, right away
+        self.assertEqual(chunks, [b'{"id":1}\n', b'{"id":2}\n{"id":3}\n', b'{"id":4}\n'])
+        self.assertEqual(list(ndjson_chunks([])), [])
+
+
+class SeedCommandTestCase(TestCase):
+    """Tests for the flask seed command."""
+
+    def test_seed_generated_and_import(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["seed", "--count", "50", "--batch-size", "20"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("generated: 50 cupcakes", result.output)
+        self.assertEqual(Cupcake.query.count(), 53)
+        # the next seed drops indexes; a transaction left open here would block it.
+        db.session.remove()
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "cupcakes.csv")
+            with open(csv_path, "w") as csv_file:
+                csv_file.write("flavor,size,rating,image\nplum,small,7,\nfig,large,8.5,http://test.com/fig.jpg\n")
+
+            result = runner.invoke(args=["seed", "--append", "--import", csv_path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(Cupcake.query.count(), 55)
+            self.assertEqual(Cupcake.query.filter_by(flavor="plum").one().image,
+                             "https://tinyurl.com/demo-cupcake")
+            db.session.remove()
+
+            ndjson_path = os.path.join(directory, "cupcakes.ndjson")
+            with open(ndjson_path, "w") as ndjson_file:
+                ndjson_file.write('{"flavor": "kiwi", "size": "small", "rating": 6}\n{"flavor": "", "size": "small", "rating": 6}\n')
+
+            result = runner.invoke(args=["seed", "--append", "--no-demo", "--import", ndjson_path])
+            self.assertNotEqual(result.exit_code, 0)
+            self.assertIn("cupcake 2: An error occurred. Non-blank values required", result.output)
+            self.assertEqual(Cupcake.query.count(), 55)
+            db.session.remove()
+
+        resp = app.test_client().get("/api/cupcakes/stats")
+        self.assertEqual(resp.json["stats"]["count"], 55)
+
+    def test_seed_failed_import_keeps_stats(self):
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "bad.csv")
+            with open(csv_path, "w") as csv_file:
+                csv_file.write("flavor,size,rating,image\nplum,small,ten,\n")
+
+            # the generated cupcakes are committed before the import fails
+            result = runner.invoke(args=["seed", "--count", "40", "--no-demo", "--import", csv_path])
+            self.assertNotEqual(result.exit_code, 0)
+            self.assertIn(f"Nothing from {csv_path} was loaded. The 40 cupcakes loaded before it were kept.",
+                          result.output)
+            db.session.remove()
+
+        self.assertEqual(Cupcake.query.count(), 40)
+        resp = app.test_client().get("/api/cupcakes/stats")
+        self.assertEqual(resp.json["stats"]["count"], 40)
+        db.session.remove()
+
+
+    def test_copy_stream_keeps_validation_error(self):
+        # psycopg2 reports an error raised while COPY reads as QueryCanceled, so copy_rows
+        #  raises the one the stream kept.
+        stream = CopyStream(load_rows([{"flavor": "kiwi", "size": "small", "rating": 6},
+                                       {"flavor": "", "size": "small", "rating": 6}], "test"))
+        with self.assertRaises(ValueError):
+            stream.read(8192)
+        self.assertIn("test cupcake 2: An error occurred.", str(stream.error))
+
+
+class ImageProxyTestCase(TestCase):
+    """Tests for the /images thumbnail proxy and its disk cache."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        image_cache.configure(self.directory.name, 256 * 1024 * 1024)
+
+        Cupcake.query.delete()
+        cupcake_cache.clear()
+        # a local static image stands in for a remote one
+        self.cupcake = Cupcake(flavor="cherry", size="large", rating=5,
+                               image="http://127.0.0.1:5000/static/images/cupcake.jpg")
+        db.session.add(self.cupcake)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        image_cache.configure(app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'])
+        self.directory.cleanup()
+
+    def test_thumbnail(self):
+        with app.test_client() as client:
+            url = f"/images/{self.cupcake.id}"
+            resp = client.get(url, query_string={"size": "small"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.mimetype.startswith("image/"))
+            self.assertTrue(resp.cache_control.public)
+            self.assertEqual(resp.cache_control.max_age, app.config['IMAGE_MAX_AGE'])
+            if (PILImage):
+                self.assertEqual(resp.mimetype, "image/jpeg")
+                width, height = PILImage.open(io.BytesIO(resp.data)).size
+                self.assertLessEqual(max(width, height), THUMBNAIL_SIZES["small"])
+
+            resp = client.get(url, query_string={"size": "small"},
+                              headers={"If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+
+            self.assertEqual(client.get(url, query_string={"size": "huge"}).status_code, 400)
+            self.assertEqual(client.get("/images/200").status_code, 404)
+            self.assertEqual(client.get("/images/2a").status_code, 404)
+
+    def test_thumbnail_after_eviction(self):
+        with app.test_client() as client:
+            url = f"/images/{self.cupcake.id}"
+            first = client.get(url, query_string={"size": "small"})
+
+            # thumbnails evicted while the url index is kept are made again.
+            for path, mtime, size in image_cache.files():
+                if (os.path.basename(os.path.dirname(path)) != "urls"):
+                    os.remove(path)
+            resp = client.get(url, query_string={"size": "small"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, first.data)
+
+    def test_private_addresses_refused(self):
+        self.assertTrue(is_public_address("93.184.216.34"))
+        for address in ("127.0.0.1", "10.1.2.3", "192.168.0.1", "169.254.169.254",
+                        "100.64.0.1", "0.0.0.0", "224.0.0.1", "::1", "fe80::1", "::ffff:10.0.0.1"):
+            self.assertFalse(is_public_address(address), address)
+
+        for url in ("http://127.0.0.1:5000/secret.jpg", "http://169.254.169.254/latest/meta-data",
+                    "http://[::1]/image.png", "http://localhost/image.png", "file:///etc/passwd"):
+            with self.assertRaises(ImageError, msg=url):
+                fetch_image(url)
+
+        self.cupcake.image = "http://10.0.0.1/cupcake.jpg"
+        db.session.commit()
+        with app.test_client() as client:
+            resp = client.get(f"/images/{self.cupcake.id}")
+            self.assertEqual(resp.status_code, 502)
+            self.assertEqual(resp.json["error"]["message"],
+                             "The cupcake image host is not a public address.")
+
+    def test_cache_eviction(self):
+        cache = ImageCache(self.directory.name, max_bytes=25)
+        cache.put("a" * 64, "small", "jpg", b"1" * 10)
+        cache.put("b" * 64, "small", "jpg", b"2" * 10)
+        os.utime(cache.thumbnail_path("a" * 64, "small", "jpg"), (1, 1))
+        self.assertIsNotNone(cache.get("b" * 64, "small", "jpg"))
+
+        # the least recently used file is removed to stay within max_bytes
+        cache.put("c" * 64, "small", "jpg", b"3" * 10)
+        self.assertIsNone(cache.get("a" * 64, "small", "jpg"))
+        self.assertEqual(cache.get("b" * 64, "small", "jpg"), b"2" * 10)
+        self.assertEqual(cache.get("c" * 64, "small", "jpg"), b"3" * 10)
+
+
+class CompressionTestCase(TestCase):
+    """Tests for response compression and the hashed static assets."""
+
+    def setUp(self):
+        Cupcake.query.delete()
+        cupcake_cache.clear()
+        db.session.add_all([Cupcake(**CUPCAKE_DATA) for _ in range(20)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['ASSETS_DIR'] = get_config().ASSETS_DIR
+
+    def test_gzip_json(self):
+        with app.test_client() as client:
+            identity = client.get("/api/cupcakes")
+            self.assertIsNone(identity.content_encoding)
+
+            resp = client.get("/api/cupcakes", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.content_encoding, "gzip")
+            self.assertIn("Accept-Encoding", resp.vary)
+            self.assertEqual(gzip.decompress(resp.data), identity.data)
+
+            # the weak ETag of the compressed page still gets a 304
+            self.assertTrue(resp.headers["ETag"].startswith("W/"))
+            resp = client.get("/api/cupcakes", headers={
+                "Accept-Encoding": "gzip", "If-None-Match": resp.headers["ETag"]})
+            self.assertEqual(resp.status_code, 304)
+
+            # below COMPRESSION_MIN_SIZE
+            resp = client.get("/api/cupcakes?limit=1", headers={"Accept-Encoding": "gzip"})
+            self.assertIsNone(resp.content_encoding)
+
+            # streamed responses are compressed too
+            identity = client.get("/api/cupcakes/export")
+            resp = client.get("/api/cupcakes/export", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(resp.content_encoding, "gzip")
+            self.assertEqual(gzip.decompress(resp.data), identity.data)
+
+    def test_compress_chunks_flushes(self):
+        chunks = [b'{"id": 1}\n', b'{"id": 2}\n']
+        encodings = ["gzip"] + (["br"] if brotli else [])
+        for encoding in encodings:
+            decompressor = (brotli.Decompressor() if encoding == "br"
+                            else zlib.decompressobj(31))
+            decompress = (decompressor.process if encoding == "br"
+                          else decompressor.decompress)
+
+            # each chunk decodes as soon as it is received, before the stream ends
+            compressed = compress_chunks(iter(chunks), encoding)
+            for chunk in chunks:
+                self.assertEqual(decompress(next(compressed)), chunk, encoding)
+            decompress(next(compressed))
+            self.assertEqual(list(compressed), [])
+
+    def test_hashed_assets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['ASSETS_DIR'] = directory
+            manifest = build_assets(app.static_folder, directory)
+            self.assertRegex(manifest["cupcakes.js"], r"^cupcakes\.[0-9a-f]{10}\.js$")
+
+            with app.test_client() as client:
+                url = f"/assets/{manifest['cupcakes.js']}"
+                self.assertIn(url, client.get("/").get_data(as_text=True))
+
+                resp = client.get(url, headers={"Accept-Encoding": "gzip"})
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.content_encoding, "gzip")
+                self.assertTrue(resp.cache_control.immutable)
+                with open(os.path.join(app.static_folder, "cupcakes.js"), "rb") as source:
+                    self.assertEqual(gzip.decompress(resp.data), source.read())
+                resp.close()
+
+                self.assertEqual(client.get("/assets/manifest.json").status_code, 404)
+
+        # no manifest, plain /static/ urls
+        with app.test_client() as client:
+            self.assertIn("/static/cupcakes.js", client.get("/").get_data(as_text=True))
+
+
+class InstrumentationTestCase(TestCase):
+    """Tests for the request metrics and the slow request profiler."""
+
+    def setUp(self):
+        app.config['INSTRUMENTATION_ENABLED'] = True
+
+    def tearDown(self):
+        app.config['INSTRUMENTATION_ENABLED'] = False
+        app.config['INSTRUMENTATION_PROFILE_SLOW_MS'] = 0
+
+    def test_metrics(self):
+        with app.test_client() as client:
+            client.get("/api/cupcakes")
+            resp = client.get("/metrics")
+            self.assertEqual(resp.status_code, 200)
+            text = resp.get_data(as_text=True)
+            self.assertIn('cupcakes_request_duration_seconds_count{method="GET",route="/api/cupcakes",status="200"}', text)
+            self.assertIn('cupcakes_request_sql_queries_bucket{route="/api/cupcakes",le="0"} 0', text)
+            self.assertIn('cupcakes_request_serialization_seconds_count{route="/api/cupcakes"}', text)
+
+            app.config['INSTRUMENTATION_ENABLED'] = False
+            self.assertEqual(client.get("/metrics").status_code, 404)
+
+    def test_slow_request_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['INSTRUMENTATION_PROFILE_SLOW_MS'] = 0.001
+            app.config['INSTRUMENTATION_PROFILE_DIR'] = directory
+            app.extensions.pop("cupcakes_profiler", None)
+            app.config['INSTRUMENTATION_PROFILE_INTERVAL_MS'] = 0.1
+
+            with app.test_client() as client:
+                # repeat until the profiler thread takes a sample during a request.
+                for _ in range(50):
+                    client.get("/api/cupcakes/stats")
+                    if (os.listdir(directory)):
+                        break
+
+            profiles = os.listdir(directory)
+            self.assertTrue(profiles)
+            with open(os.path.join(directory, profiles[0])) as profile:
+                stack, count = profile.readline().rsplit(" ", 1)
+            # samples are taken between before_request and after_request
+            self.assertIn("full_dispatch_request", stack)
+            self.assertTrue(int(count) >= 1)
+
+
+class ReplicaTestCase(TestCase):
+    """Tests for read replica routing, with a second SQLite database as the replica."""
+
+    def setUp(self):
+        """Make demo data: one cupcake on the primary, a different one on the replica."""
+
+        Cupcake.query.delete()
+        cupcake_cache.clear()
+        db.session.add(Cupcake(**CUPCAKE_DATA))
+        db.session.commit()
+        db_rebuild_cupcake_stats()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.use_replica(f"sqlite:///{os.path.join(self.directory.name, 'replica.db')}")
+        engine = db.get_engine(app, bind="replica_1")
+        db.Model.metadata.create_all(engine)
+        engine.execute(Cupcake.__table__.insert(), {**CUPCAKE_DATA, "flavor": "ReplicaFlavor"})
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        db.get_engine(app, bind="replica_1").dispose()
+        app.config['SQLALCHEMY_BINDS'] = {}
+        db.replica_router.configure(())
+        self.directory.cleanup()
+
+    def use_replica(self, url):
+        app.config['SQLALCHEMY_BINDS'] = {"replica_1": url}
+        db.replica_router.configure(["replica_1"], health_check_seconds=60)
+
+    def flavors(self, client):
+        resp = client.get("/api/cupcakes")
+        self.assertEqual(resp.status_code, 200)
+        return [cupcake["flavor"] for cupcake in resp.json["cupcakes"]]
+
+    def test_reads_use_replica(self):
+        with app.test_client() as client:
+            self.assertEqual(self.flavors(client), ["ReplicaFlavor"])
+
+            resp = client.get("/api/status/replicas")
+            self.assertEqual(resp.json["replicas"][0]["name"], "replica_1")
+            self.assertTrue(resp.json["replicas"][0]["healthy"])
+
+    def test_read_your_writes(self):
+        with app.test_client() as client:
+            resp = client.post("/api/cupcakes", json=CUPCAKE_DATA_2)
+            self.assertEqual(resp.status_code, 201)
+            self.assertIn(app.config['REPLICA_STICKY_COOKIE'], resp.headers["Set-Cookie"])
+
+            # the client that wrote reads the primary, other clients the replica.
+            self.assertEqual(self.flavors(client), ["TestFlavor", "TestFlavor2"])
+        with app.test_client() as client:
+            self.assertEqual(self.flavors(client), ["ReplicaFlavor"])
+
+    def test_detail_cache_fills_from_primary(self):
+        cupcake_id = Cupcake.query.filter_by(flavor="TestFlavor").one().id
+        with app.test_client() as client:
+            resp = client.get(f"/api/cupcakes/{cupcake_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["cupcake"]["flavor"], "TestFlavor")
+
+    def test_unhealthy_replica(self):
+        db.get_engine(app, bind="replica_1").dispose()
+        self.use_replica("sqlite:////nonexistent/directory/replica.db")
+        with app.test_client() as client:
+            self.assertEqual(self.flavors(client), ["TestFlavor"])
+
+            replica = client.get("/api/status/replicas").json["replicas"][0]
+            self.assertFalse(replica["healthy"])
+            self.assertEqual(replica["reason"], "OperationalError")
+
+
+class ConfigTestCase(TestCase):
+    """Tests for the configuration and connection pool settings."""
+
+    def test_get_config(self):
+        self.assertIs(get_config("production"), ProductionConfig)
+        self.assertTrue(ProductionConfig.DB_STATEMENT_TIMEOUT_MS > 0)
+        with self.assertRaises(ValueError):
+            get_config("staging")
+
+    def test_pool_options(self):
+        sa_url, options = db.apply_driver_hacks(
+            app, make_url("postgresql:///cupcakes"), {"max_overflow": 0})
+        self.assertEqual(options["pool_size"], app.config["DB_POOL_SIZE"])
+        # SQLALCHEMY_ENGINE_OPTIONS win over the DB_* settings
+        self.assertEqual(options["max_overflow"], 0)
+        self.assertEqual(options["pool_pre_ping"], app.config["DB_POOL_PRE_PING"])
+
+    def test_pool_status(self):
+        with app.test_client() as client:
+            client.get("/api/cupcakes")
+            resp = client.get("/api/status/pool")
+            self.assertEqual(resp.status_code, 200)
+            pool = resp.json["pools"][0]
+            self.assertTrue(pool["checkouts"] >= 1)
+            self.assertTrue(pool["checked_out_peak"] >= 1)
+
+        # a check in without a connection record is ignored
+        metrics = PoolMetrics(create_engine("sqlite://"))
+        metrics.on_checkin(None, None)
+        self.assertEqual(metrics.counters["checkins"], 0)
+
+
+class AsyncAppTestCase(TestCase):
+    """Tests that the async app returns the same responses as the Flask app."""
+
+    def setUp(self):
+        """Make demo data."""
+
+        if (db.engine.dialect.name != "postgresql"):
+            self.skipTest("the async app is tested on PostgreSQL (asyncpg)")
+
+        import async_app
+        self.async_app = async_app.app
+        self.async_app.config['ASYNC_DATABASE_URI'] = app.config['SQLALCHEMY_DATABASE_URI'].replace(
+            "postgresql:", "postgresql+asyncpg:", 1)
+
+        Cupcake.query.delete()
+        cupcake_cache.clear()
+
+        cupcake = Cupcake(**CUPCAKE_DATA)
+        db.session.add(cupcake)
+        db.session.commit()
+        db_rebuild_cupcake_stats()
+
+        self.cupcake_id = cupcake.id
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def test_same_responses(self):
+        paths = ["/api/cupcakes", "/api/cupcakes?limit=0", "/api/cupcakes?sort=-rating&fields=flavor",
+                 f"/api/cupcakes/{self.cupcake_id}", "/api/cupcakes/200", "/api/cupcakes/2a",
+                 "/api/cupcakes/stats"]
+
+        async def get_async_responses():
+            client = self.async_app.test_client()
+            responses = []
+            for path in paths:
+                resp = await client.get(path)
+                responses.append((resp.status_code, await resp.get_json(), resp.headers.get("ETag")))
+            return responses
+
+        async_responses = asyncio.run(get_async_responses())
+
+        with app.test_client() as client:
+            for path, async_response in zip(paths, async_responses):
+                resp = client.get(path)
+                self.assertEqual((resp.status_code, resp.json, resp.headers.get("ETag")),
+                                 async_response, path)
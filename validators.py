@@ -0,0 +1,124 @@
+"""Validation of cupcake create and update payloads.
+
+The cupcake schema is compiled once, at import, into a validator function per operation.
+A validator checks every field of a payload, coerces the values to their column types and
+returns all field errors together, so bad input is rejected before a database session is
+used. Validators keep no state between calls and are safe to share between threads.
+"""
+
+import math
+from collections import namedtuple
+
+# name, type ("string" or "number"), required on create, maximum length for strings.
+SchemaField = namedtuple("SchemaField", "name type required max_length")
+
+CUPCAKE_SCHEMA = (
+    SchemaField("flavor", "string", True, 64),
+    SchemaField("size", "string", True, 64),
+    SchemaField("rating", "number", True, None),
+    SchemaField("image", "string", False, None),
+)
+
+# error kinds, in the order the first error of a payload is picked for its message.
+MISSING = "missing"
+BLANK = "blank"
+INVALID = "invalid"
+ERROR_ORDER = (MISSING, BLANK, INVALID)
+
+# validate returns values (coerced, stripped) and errors: {field: (kind, message)}.
+Validation = namedtuple("Validation", "values errors")
+
+NOT_AN_OBJECT = "Cupcake data must be a JSON object."
+
+
+def compile_field(field, require_all):
+    """ Returns check(value) -> (error kind or None, message or coerced value) for field.
+        require_all (updates) makes every field required; otherwise a blank optional
+        field becomes None so the column default applies.
+    """
+
+    required = field.required or require_all
+    max_length = field.max_length
+
+    def check_blank(value):
+        if (value is None):
+            return (MISSING, "A value is required.") if required else (None, None)
+        if (type(value) == str):
+            value = value.strip()
+            if (len(value) == 0):
+                return (BLANK, "A non-blank value is required.") if required else (None, None)
+        return (None, value)
+
+    if (field.type == "number"):
+        def check(value):
+            kind, value = check_blank(value)
+            if (kind or value is None):
+                return (kind, value)
+            # bool is an int, but true is not a rating.
+            if (type(value) == bool):
+                return (INVALID, f"'{value}' is not a number.")
+            try:
+                number = float(value)
+            # OverflowError: an integer too large for a float, such as 400 digits of JSON.
+            except (TypeError, ValueError, OverflowError):
+                return (INVALID, f"'{value}' is not a number.")
+            if (not math.isfinite(number)):
+                return (INVALID, f"'{value}' is not a number.")
+            return (None, number)
+
+    else:
+        def check(value):
+            kind, value = check_blank(value)
+            if (kind or value is None):
+                return (kind, value)
+            if (type(value) != str):
+                return (INVALID, "Must be a string.")
+            if (max_length is not None and len(value) > max_length):
+                return (INVALID, f"Must be at most {max_length} characters.")
+            return (None, value)
+
+    return check
+
+
+def compile_validator(schema, require_all=False):
+    """ Returns validate(data) -> Validation for the schema. """
+
+    checks = tuple((field.name, compile_field(field, require_all)) for field in schema)
+
+    def validate(data):
+        if (type(data) != dict):
+            return Validation({}, {"_": (INVALID, NOT_AN_OBJECT)})
+
+        values = {}
+        errors = {}
+        for name, check in checks:
+            kind, result = check(data.get(name))
+            if (kind):
+                errors[name] = (kind, result)
+            else:
+                values[name] = result
+
+        return Validation(values, errors)
+
+    return validate
+
+
+validate_cupcake_create = compile_validator(CUPCAKE_SCHEMA)
+validate_cupcake_update = compile_validator(CUPCAKE_SCHEMA, require_all=True)
+
+
+def first_error(errors):
+    """ Returns (field, kind) of the error used for the summary message: missing values
+        first, then blank values, then invalid values, each in schema order.
+    """
+
+    for kind in ERROR_ORDER:
+        for name, (error_kind, message) in errors.items():
+            if (error_kind == kind):
+                return (name, kind)
+
+
+def field_messages(errors):
+    """ Returns {field: message} for every error, the "fields" of an error response. """
+
+    return {name: message for name, (kind, message) in errors.items()}